@@ -1,35 +1,52 @@
 """
 This file takes the model outputs and analyzes them
 """
+import json
+import os
 import re
+from concurrent.futures import ProcessPoolExecutor
 
 import numpy as np
 from pyprojroot import here
 import seaborn as sns
 import pandas as pd
-import matplotlib.pyplot as plt
+from matplotlib.figure import Figure
+from bootstrap import bootstrapped_ci
+from baseline import random_baseline_summary
+from storage import write_outputs
+from answer_extraction import extract_answers
+from results_catalog import ResultsCatalog, file_hash, stat_columns
+from instrumentation import Metrics, get_metrics, set_metrics, stage, make_metrics_path, format_summary
+from seeding import make_rng, make_run_key
 
 guess_labels = ["a", "b", "c", "d"]
 
+# the three kinds of answers extract_guess looks for, in its order of preference: "the answer is X" anywhere,
+# "the speaker is saying X)" anywhere, and "X)" at the start of the response
+guess_patterns = [
+    re.compile(r"the answer is ([a-d])"),
+    re.compile(r"the speaker is saying ([a-d])\)"),
+    re.compile(r"^([a-d])\)"),
+]
+
+# bump parser_version whenever a change to the parsing, scoring or statistics would change the processed responses or
+# summary statistics, and figures_version whenever a change to draw_figures would change the figures, so that
+# incremental analysis knows to redo them
+parser_version = 5
+figures_version = 2
+
 
 def extract_guess(response):
     """
     Figure out which response the model chose
     """
     response = response.strip().lower()
-    # look for "the answer is X"
-    match = re.findall(r"the answer is ([a-d])", response)
-    if len(match) == 0:
-        # look for "the speaker is saying X"
-        match = re.findall(r"the speaker is saying ([a-d])\)", response)
-        if len(match) == 0:
-            # if there still isn't a match, check for an answer with just the letter
-            match = re.findall(r"^([a-d])\)", response)
-
-            if len(match) == 0:
-                return None
-
-    return match[0]
+    for pattern in guess_patterns:
+        # the first match of the most preferred kind of answer the response has
+        match = pattern.search(response)
+        if match is not None:
+            return match[1]
+    return None
 
 
 def rank_guess(guess, rating_info, task_type):
@@ -44,126 +61,298 @@ def rank_guess(guess, rating_info, task_type):
         return int(rating_info[guess_labels.index(guess)])
 
 
-def bootstrapped_ci(scores, n=100000):
+def parse_values(values: pd.Series) -> np.ndarray:
     """
-    Construct a bootstrapped confidence interval
+    Parse a column of stringified value arrays like "[3 1 4 2]" into an (n, 4) integer array in one go
     """
-    # do the bootstrapped resampling
-    all_bs = np.random.choice(scores, size=(n, len(scores)))
-    # compute means within each instance
-    means = np.mean(all_bs, axis=1)
-
-    # compute the overall mean and a confidence interval
-    mean = np.mean(means)
-    ci_lower = np.percentile(means, 2.5)
-    ci_upper = np.percentile(means, 97.5)
+    return np.fromstring(" ".join(values.str[1:-1]), dtype=int, sep=" ").reshape(len(values), -1)
 
-    # return the mean and confidence interval
-    return mean, ci_lower, ci_upper
 
-
-def random_baseline(ratings, n_questions=100):
+def rank_guesses(guesses: pd.Series, df_responses: pd.DataFrame, task_type: str) -> np.ndarray:
     """
-    Suppose we randomly selected answers, what ranks would we end up with?
+    Get the rating corresponding to each chosen guess (the same as applying rank_guess to each one), with NaN where
+    there is no guess
     """
-    # choose ratings at random
-    rand_ratings = []
-    for q in range(n_questions):
-        random_rating = int(np.random.choice(ratings))
-        rand_ratings.append(random_rating)
+    guess_indices = guesses.map({label: i for i, label in enumerate(guess_labels)}).to_numpy(dtype=float)
+    parsed = ~np.isnan(guess_indices)
+    ranks = np.full(len(guesses), np.nan)
+    if task_type == "inverse":
+        # the rating is whether the guess is the true answer
+        ranks[parsed] = df_responses["index"].to_numpy()[parsed].astype(int) == guess_indices[parsed] + 1
+    else:
+        # the rating is the quality of the chosen paraphrase
+        values = parse_values(df_responses["values"])
+        ranks[parsed] = values[np.flatnonzero(parsed), guess_indices[parsed].astype(int)]
+    return ranks
 
-    # return all the random ratings
-    return rand_ratings
 
-# specify global variables
-corpus_set = "test"
-gpt_version = "davinci"
-prompt_type = "options_only"
-task_type = "standard"  # "inverse" or "standard"
-K = 10
-temp = 0.2
+def option_probabilities(option_logprobs: pd.Series) -> np.ndarray:
+    """
+    Turn a column of JSON lists of option log-probabilities (from a scored run, with null for options that weren't
+    scored) into an (n, 4) array of probabilities normalized over the options, with NaN rows where none were scored
+    """
+    logprobs = np.array([[np.nan if logprob is None else logprob for logprob in json.loads(row)]
+                         for row in option_logprobs], dtype=float)
+    probabilities = np.nan_to_num(np.exp(logprobs - np.fmax.reduce(logprobs, axis=1, keepdims=True)), nan=0.0)
+    with np.errstate(invalid="ignore"):
+        return probabilities / probabilities.sum(axis=1, keepdims=True)
 
-if __name__ == "__main__":
 
+def expected_appropriateness(df_responses: pd.DataFrame, task_type: str) -> np.ndarray:
+    """
+    Get the expected appropriateness score of each item of a scored run, weighting each option's score by its
+    probability
+    """
+    probabilities = option_probabilities(df_responses["option_logprobs"])
     if task_type == "inverse":
-        df_responses = pd.read_csv(here(f"data/model-outputs/model_responses_inverse_set={corpus_set}-gpt={gpt_version}-prompt={prompt_type}-k={K}-temp={temp}.csv"))
+        # only the true answer scores 1
+        option_scores = np.eye(len(guess_labels))[df_responses["index"].to_numpy().astype(int) - 1]
     else:
-        df_responses = pd.read_csv(here(f"data/model-outputs/model_responses_set={corpus_set}-gpt={gpt_version}-prompt={prompt_type}-k={K}-temp={temp}.csv"))
+        option_scores = parse_values(df_responses["values"])
+    return (probabilities * option_scores).sum(axis=1)
 
-    # drop the religious metaphor that was accidentally included in the test set
-    df_responses = df_responses[df_responses["ID"] != 67]
 
-    non_parsed_guesses = 0
-    guess_ranks = []
-    raw_guesses = []
+def random_baseline(ratings, n_questions=100, rng=None):
+    """
+    Suppose we randomly selected answers, what ranks would we end up with?
+    """
+    rng = np.random.default_rng(rng)
+    return [int(rating) for rating in rng.choice(ratings, size=n_questions)]
 
-    print(f"Analyzing {len(df_responses)} responses")
 
-    for index, row in df_responses.iterrows():
+def get_figure_paths(task_type: str, corpus_set: str, gpt_version: str, prompt_type: str, K: int, temp: float) -> list:
+    """
+    Get the paths of the appropriateness and response figures draw_figures saves for a condition, named like its
+    model outputs so that conditions that only differ in their task or corpus don't overwrite each other's figures
+    """
+    inverse = "_inverse" if task_type == "inverse" else ""
+    return [here(f"figures/{name}_distribution{inverse}_set={corpus_set}-gpt={gpt_version}-prompt={prompt_type}-k={K}-temp={temp}.png")
+            for name in ["appropriateness", "response"]]
 
-        if not isinstance(row["model_response"], str):
-            non_parsed_guesses += 1
-            guess_ranks.append(None)
-            raw_guesses.append(None)
-            print("nan response")
-            continue
 
-        guess = extract_guess(row["model_response"])
-        if guess is None:
-            non_parsed_guesses += 1
-            guess_ranks.append(None)
-            raw_guesses.append(None)
-            print(f"couldn't parse guess: {row['model_response']}")
-            continue
+def draw_figures(guess_ranks: list, raw_guesses: list, task_type: str, corpus_set: str, gpt_version: str,
+                 prompt_type: str, K: int, temp: float):
+    """
+    Save the histograms of appropriateness scores and of the chosen responses for one condition.
+    Each figure is its own Figure object rather than pyplot's global one, so this is safe to run in parallel.
+    """
+    appropriateness_path, response_path = get_figure_paths(task_type, corpus_set, gpt_version, prompt_type, K, temp)
 
-        if task_type == "inverse":
-            rank = rank_guess(guess, int(row["index"]), task_type = task_type)
-        else:
-            rank = rank_guess(guess, np.fromstring(row["values"][1:-1], sep=" "), task_type = task_type)
+    fig = Figure()
+    hist = sns.histplot(np.array(guess_ranks), discrete=True, ax=fig.subplots())
+    hist.set_title(f"Appropriateness Distribution: {gpt_version} with {prompt_type} prompts",
+                   fontsize=12)
+    if task_type != "inverse":
+        hist.set_xticks([1, 2, 3, 4])
+    hist.set_xlabel("Appropriateness Score")
+    fig.savefig(appropriateness_path)
 
-        guess_ranks.append(rank)
-        raw_guesses.append(guess)
+    fig = Figure()
+    hist = sns.countplot(x=sorted(raw_guesses), ax=fig.subplots())
+    hist.set_title(f"Response Distribution: {gpt_version} with {prompt_type} prompts",
+                   fontsize=12)
+    hist.set_xlabel("Response")
+    fig.savefig(response_path)
 
-    df_responses["appropriateness_score"] = guess_ranks
-    df_responses["raw_guess"] = raw_guesses
-    df_responses.to_csv(here(f"data/model-outputs/processed/model_responses_set={corpus_set}-gpt={gpt_version}-prompt={prompt_type}-k={K}-temp={temp}-processed.csv"))
 
-    guess_ranks = [x for x in guess_ranks if x is not None]
-    raw_guesses = [x for x in raw_guesses if x is not None]
+def analyze_condition(corpus_set: str, gpt_version: str, prompt_type: str, task_type: str, K: int, temp: float,
+                      save_parquet: bool = False, catalog: ResultsCatalog = None, incremental: bool = False) -> dict:
+    """
+    Score the model's responses for one condition, save the processed responses (also to the Parquet dataset if
+    save_parquet is set) and figures, and return the summary statistics.
+    If a results catalog is given, the responses are found through it and the summary statistics are recorded in it.
+    With incremental set (which needs a catalog), a condition whose responses, parser version and figures version all
+    match what the catalog recorded is skipped, and one where only the figures are out of date just has them redrawn.
+    """
+    run = {"task_type": task_type, "corpus_set": corpus_set, "gpt_version": gpt_version, "prompt_type": prompt_type,
+           "K": K, "temp": temp}
+    raw_path = catalog.get_path(**run, stage="raw") if catalog is not None else None
+    if raw_path is None:
+        if task_type == "inverse":
+            raw_path = here(f"data/model-outputs/model_responses_inverse_set={corpus_set}-gpt={gpt_version}-prompt={prompt_type}-k={K}-temp={temp}.csv")
+        else:
+            raw_path = here(f"data/model-outputs/model_responses_set={corpus_set}-gpt={gpt_version}-prompt={prompt_type}-k={K}-temp={temp}.csv")
+    if task_type == "inverse":
+        processed_path = here(f"data/model-outputs/processed/model_responses_inverse_set={corpus_set}-gpt={gpt_version}-prompt={prompt_type}-k={K}-temp={temp}-processed.csv")
+    else:
+        processed_path = here(f"data/model-outputs/processed/model_responses_set={corpus_set}-gpt={gpt_version}-prompt={prompt_type}-k={K}-temp={temp}-processed.csv")
+
+    input_hash = file_hash(raw_path)
+    if incremental and catalog is not None:
+        entry = catalog.get(**run, stage="processed")
+        if entry is not None and entry["input_hash"] == input_hash and entry["parser_version"] == parser_version \
+                and os.path.exists(processed_path):
+            summary = {
+                "mean": entry["mean"],
+                "ci_lower": entry["ci_lower"],
+                "ci_upper": entry["ci_upper"],
+                "non_parsed_guesses": int(entry["n_parse_failures"]),
+                "p_val": entry["p_val"],
+                **{column: None if pd.isna(entry[column]) else entry[column]
+                   for column in ["expected_mean", "expected_ci_lower", "expected_ci_upper"]},
+            }
+            if entry["figures_version"] == figures_version and \
+                    all(os.path.exists(path) for path in get_figure_paths(**run)):
+                print(f"{os.path.basename(raw_path)} is up to date")
+                return summary
+
+            # only the figures are out of date, so redraw them from the processed responses
+            print(f"{os.path.basename(raw_path)}: redrawing figures")
+            df_processed = pd.read_csv(processed_path)
+            draw_figures([int(x) for x in df_processed["appropriateness_score"].dropna()],
+                         list(df_processed["raw_guess"].dropna()), **run)
+            catalog.record(**run, stage="processed", path=processed_path,
+                           **{column: entry[column] for column in stat_columns}, input_hash=input_hash,
+                           parser_version=parser_version, figures_version=figures_version)
+            return summary
+
+    with stage("read"):
+        df_responses = pd.read_csv(raw_path)
+
+    # drop the religious metaphor that was accidentally included in the test set (the inverse corpus has no IDs)
+    if "ID" in df_responses.columns:
+        df_responses = df_responses[df_responses["ID"] != 67]
+
+    print(f"Analyzing {len(df_responses)} responses")
 
-    mean, ci_lower, ci_upper = bootstrapped_ci(guess_ranks)
+    # parse all the responses and score the guesses
+    with stage("parse", n_responses=len(df_responses)):
+        extractions = extract_answers(df_responses["model_response"], df_responses.get("prompt"))
+        guesses = extractions["label"]
+        ranks = rank_guesses(guesses, df_responses, task_type)
+    for response, failure in zip(df_responses["model_response"][guesses.isna()],
+                                 extractions["failure"][guesses.isna()]):
+        print(f"couldn't parse guess ({failure}): {response}")
+    non_parsed_guesses = int(guesses.isna().sum())
+    get_metrics().count("parse_failures", non_parsed_guesses)
+    print(f"parse failures by type: {extractions['failure'].value_counts().to_dict()}")
+
+    df_responses["appropriateness_score"] = ranks
+    df_responses["raw_guess"] = guesses.to_numpy()
+    df_responses["parse_source"] = extractions["source"].to_numpy()
+    df_responses["parse_failure"] = extractions["failure"].to_numpy()
+    # scored runs have the probability of every option, so their expected appropriateness can be computed directly
+    if "option_logprobs" in df_responses.columns:
+        df_responses["expected_appropriateness"] = expected_appropriateness(df_responses, task_type)
+    with stage("save"):
+        df_responses.to_csv(processed_path)
+        if save_parquet:
+            write_outputs(df_responses, task_type, corpus_set, gpt_version, prompt_type, K, temp, processed=True)
+
+    guess_ranks = [int(x) for x in ranks[~np.isnan(ranks)]]
+    raw_guesses = list(guesses.dropna())
+
+    with stage("bootstrap"):
+        mean, ci_lower, ci_upper = bootstrapped_ci(guess_ranks, rng=make_rng(make_run_key(**run), "bootstrap"))
     print(f"mean rank: {mean}, [{ci_lower}, {ci_upper}]")
 
     print(f"{non_parsed_guesses} guesses not parsed")
+    expected_mean, expected_ci_lower, expected_ci_upper = None, None, None
+    if "expected_appropriateness" in df_responses.columns:
+        with stage("bootstrap_expected_appropriateness"):
+            expected_mean, expected_ci_lower, expected_ci_upper = bootstrapped_ci(
+                df_responses["expected_appropriateness"].dropna().to_numpy(),
+                rng=make_rng(make_run_key(**run), "bootstrap_expected_appropriateness"))
+        print(f"mean expected appropriateness: {expected_mean}, [{expected_ci_lower}, {expected_ci_upper}]")
 
-    random_means = []
     if task_type == "inverse":
         rating_options = [0, 0, 0, 1]
     else:
         rating_options = [1, 2, 3, 4]
-    for i in range(10000):
-        random_ratings = random_baseline(rating_options, n_questions=len(guess_ranks))
-        random_means.append(np.mean(random_ratings))
-    random_ci_lower = np.percentile(random_means, 2.5)
-    random_ci_upper = np.percentile(random_means, 97.5)
-    p_val = len([m for m in random_means if abs(m - 2.5) > abs(mean - 2.5)]) / len(random_means)
-    print(f"mean random rating {np.mean(random_means)}, [{random_ci_lower}, {random_ci_upper}]")
+    with stage("baseline"):
+        baseline = random_baseline_summary(mean, rating_options, n_questions=len(guess_ranks))
+    p_val = baseline["p_val"]
+    print(f"mean random rating {baseline['random_mean']}, [{baseline['random_ci_lower']}, {baseline['random_ci_upper']}]")
     print(f"p-value: {p_val}")
 
     print(guess_ranks)
-    hist = sns.histplot(np.array(guess_ranks), discrete=True)
-    hist.set_title(f"Appropriateness Distribution: {gpt_version} with {prompt_type} prompts",
-                   fontsize=12)
-    if task_type != "inverse":
-        hist.set_xticks([1, 2, 3, 4])
-    hist.set_xlabel("Appropriateness Score")
-    hist.get_figure().savefig(here(f"figures/appropriateness_distribution_gpt={gpt_version}-prompt={prompt_type}-k={K}-temp={temp}.png"))
+    print(raw_guesses)
+    with stage("figures"):
+        draw_figures(guess_ranks, raw_guesses, **run)
+
+    if catalog is not None:
+        catalog.record(**run, stage="processed", path=processed_path, n_rows=len(df_responses),
+                       n_parse_failures=non_parsed_guesses, mean=mean, ci_lower=ci_lower, ci_upper=ci_upper,
+                       p_val=p_val, expected_mean=expected_mean, expected_ci_lower=expected_ci_lower,
+                       expected_ci_upper=expected_ci_upper, input_hash=input_hash, parser_version=parser_version,
+                       figures_version=figures_version)
+
+    return {
+        "mean": mean,
+        "ci_lower": ci_lower,
+        "ci_upper": ci_upper,
+        "non_parsed_guesses": non_parsed_guesses,
+        "p_val": p_val,
+        # the expected appropriateness (weighting every option by its probability) is only there for scored runs
+        "expected_mean": expected_mean,
+        "expected_ci_lower": expected_ci_lower,
+        "expected_ci_upper": expected_ci_upper,
+    }
+
+
+def analyze_cell(cell: dict, save_parquet: bool = False, catalog: ResultsCatalog = None,
+                 incremental: bool = False, metrics_path: str = None) -> dict:
+    """
+    Analyze the condition described by a dictionary of its parameters, returning the parameters and the statistics.
+    If a metrics path is given, the analysis's measurements and their summary are appended to that file (the metrics
+    of the process it runs in can't be seen from the process that started it).
+    """
+    if metrics_path is not None:
+        set_metrics(Metrics(metrics_path, **cell))
+    try:
+        summary = analyze_condition(cell["corpus_set"], cell["gpt_version"], cell["prompt_type"], cell["task_type"],
+                                    cell["K"], cell["temp"], save_parquet=save_parquet, catalog=catalog,
+                                    incremental=incremental)
+    finally:
+        # the summary is written even if the analysis fails, so the time it took before failing isn't lost
+        if metrics_path is not None:
+            get_metrics().close()
+    return {**cell, **summary}
+
+
+def analyze_conditions(cells: list, n_processes: int = None, save_parquet: bool = False,
+                       catalog: ResultsCatalog = None, incremental: bool = False,
+                       metrics_path: str = None) -> pd.DataFrame:
+    """
+    Analyze many conditions (each a dictionary of its parameters) at once on a pool of processes (by default, one per
+    core), and collect their statistics into a table with one row per condition, in the order given
+    """
+    with ProcessPoolExecutor(max_workers=n_processes) as executor:
+        futures = [executor.submit(analyze_cell, cell, save_parquet=save_parquet, catalog=catalog,
+                                   incremental=incremental, metrics_path=metrics_path) for cell in cells]
+        return pd.DataFrame([future.result() for future in futures])
 
-    plt.clf()
 
-    print(raw_guesses)
-    hist = sns.countplot(sorted(raw_guesses))
-    hist.set_title(f"Response Distribution: {gpt_version} with {prompt_type} prompts",
-                   fontsize=12)
-    hist.set_xlabel("Response")
-    hist.get_figure().savefig(here(f"figures/response_distribution_gpt={gpt_version}-prompt={prompt_type}-k={K}-temp={temp}.png"))
+# specify global variables
+corpus_set = "test"
+gpt_version = "davinci"
+prompt_type = "options_only"
+task_type = "standard"  # "inverse" or "standard"
+K = 10
+temp = 0.2
+save_parquet = False
+# skip the analysis if nothing has changed since the last one
+incremental = True
+# analyze every run in the results catalog on a pool of processes instead of just the condition above, and save the
+# summary table of all of them
+analyze_all = False
+n_processes = None
+
+if __name__ == "__main__":
+
+    catalog = ResultsCatalog()
+    metrics_path = make_metrics_path("analyze_model_responses")
+    if analyze_all:
+        cells = catalog.find(stage="raw")[["task_type", "corpus_set", "gpt_version", "prompt_type", "K", "temp"]]
+        df_summary = analyze_conditions(cells.to_dict("records"), n_processes=n_processes,
+                                        save_parquet=save_parquet, catalog=catalog, incremental=incremental,
+                                        metrics_path=metrics_path)
+        df_summary.to_csv(here("data/model-outputs/analysis-summary.csv"), index=False)
+        print(df_summary.to_string())
+    else:
+        metrics = Metrics(metrics_path, task_type=task_type, corpus_set=corpus_set, gpt_version=gpt_version,
+                          prompt_type=prompt_type, K=K, temp=temp)
+        set_metrics(metrics)
+        analyze_condition(corpus_set, gpt_version, prompt_type, task_type, K, temp, save_parquet=save_parquet,
+                          catalog=catalog, incremental=incremental)
+        print(format_summary(metrics.close()))
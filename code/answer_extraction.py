@@ -0,0 +1,142 @@
+"""
+This file figures out which option (a-d) a model response chose. Each kind of answer the responses give has its own
+precompiled pattern, searched only until a kind decides the answer, conflicts are resolved the same way every time,
+responses that restate an option without its letter are matched back to the option, and responses that can't be parsed
+are labelled with the reason.
+"""
+import re
+from collections import namedtuple
+
+import pandas as pd
+
+guess_labels = ["a", "b", "c", "d"]
+
+# the kinds of answers, from most to least explicit. when a response has several kinds, the most explicit one wins.
+answer_sources = ["answer_is", "speaker_is_saying", "leading_letter", "inline_letter"]
+
+# a pattern for every kind of answer, capturing its letter. the phrases start with a literal, which the regex engine
+# scans for directly, and the letters are only looked for if no phrase gave the answer.
+candidate_patterns = {
+    "answer_is": re.compile(r"the answer is:?\s*\(?([a-d])(?![a-z])"),
+    "speaker_is_saying": re.compile(r"the speaker is saying:?\s*\(?([a-d])\)"),
+    "leading_letter": re.compile(r"\A\s*\(?([a-d])\)"),
+    "inline_letter": re.compile(r"(?<![a-z(])\(?([a-d])\)\s"),
+}
+
+# the separator between few-shot examples: anything a response has after it is the model making up another example
+example_separator = "###"
+
+# an option line at the end of a prompt, like "b) A tree is an umbrella."
+option_pattern = re.compile(r"^([a-d])\) (.*)$", flags=re.MULTILINE)
+
+# responses where the model says it can't answer
+declined_pattern = re.compile(r"\b(?:unable to|cannot|can't|can not) answer|\bi don't know\b|\bnot sure\b")
+
+# how many responses extract_answers turns into Python strings at a time
+extraction_chunk_size = 10000
+
+# the reasons a response can't be parsed
+failure_types = [
+    "empty",  # the response is missing or blank
+    "declined",  # the model says it can't answer
+    "ambiguous",  # the response gives different options equally explicitly (e.g. "the speaker is saying" for each)
+    "unfinished_rationale",  # the response reasons over several lines but never gives an answer
+    "no_matching_option",  # the response answers in its own words, which aren't any of the options
+]
+
+Extraction = namedtuple("Extraction", ["label", "source", "failure"])
+
+
+def normalize(text: str) -> str:
+    """
+    Lowercase text, collapse its whitespace and drop trailing punctuation, for comparing responses to options
+    """
+    return " ".join(text.lower().split()).rstrip(".!? ")
+
+
+def parse_options(prompt: str) -> list:
+    """
+    Get the text of the options a)-d) of the question at the end of a prompt (normalized), or None if there are none
+    """
+    if not isinstance(prompt, str):
+        return None
+    # the few-shot examples have options too, so only look at the question after the last one
+    options = dict(option_pattern.findall(prompt.rsplit(example_separator, 1)[-1]))
+    if any(label not in options for label in guess_labels):
+        return None
+    return [normalize(options[label]) for label in guess_labels]
+
+
+def match_option(response: str, options: list) -> Extraction:
+    """
+    Match a response that restates an option without its letter back to that option
+    """
+    text = normalize(response)
+    # options the corpus doesn't have (e.g. "na") can't be matched
+    options = [option if len(option) > 3 else None for option in options]
+    matches = [label for label, option in zip(guess_labels, options) if option is not None and option == text]
+    if len(matches) == 0:
+        matches = [label for label, option in zip(guess_labels, options) if option is not None and option in text]
+    if len(set(matches)) == 1:
+        return Extraction(matches[0], "option_text", None)
+    if len(set(matches)) > 1:
+        return Extraction(None, None, "ambiguous")
+    return None
+
+
+def extract_answer(response, options: list = None) -> Extraction:
+    """
+    Figure out which option a response chose. Returns the letter, the kind of answer it was found from, and (if
+    nothing could be parsed) the reason.
+    Only the part of the response before it starts making up another few-shot example counts. If "the answer is"
+    appears more than once, the last one wins, since a response that reasons its way to an answer ends with it. Any
+    other kind of answer that gives different letters (like a rationale that says "the speaker is saying" for each of
+    the options) is ambiguous. If there is no letter and the question's options are given, a response that restates
+    one of them is matched back to it.
+    """
+    if not isinstance(response, str) or response.strip() == "":
+        return Extraction(None, None, "empty")
+    response = response.split(example_separator, 1)[0].strip()
+    text = response.lower()
+
+    candidates = candidate_patterns["answer_is"].findall(text)
+    if len(candidates) > 0:
+        return Extraction(candidates[-1], "answer_is", None)
+    for source in ["speaker_is_saying", "leading_letter", "inline_letter"]:
+        # none of the more explicit kinds matched, so none of their text can overlap with this kind's matches
+        candidates = set(candidate_patterns[source].findall(text))
+        if len(candidates) == 1:
+            return Extraction(candidates.pop(), source, None)
+        if len(candidates) > 1:
+            return Extraction(None, None, "ambiguous")
+
+    if options is not None:
+        extraction = match_option(response, options)
+        if extraction is not None:
+            return extraction
+
+    if declined_pattern.search(text):
+        return Extraction(None, None, "declined")
+    if "\n" in response:
+        return Extraction(None, None, "unfinished_rationale")
+    return Extraction(None, None, "no_matching_option")
+
+
+def extract_answers(responses: pd.Series, prompts: pd.Series = None) -> pd.DataFrame:
+    """
+    Run extract_answer on a column of responses, using the options from the matching prompts if they are given.
+    Returns a dataframe with the same index and the columns label, source and failure.
+    """
+    # iterate over plain Python objects rather than the column's (possibly Arrow-backed) values, a chunk at a time so
+    # they don't all have to be in memory at once
+    extractions = [extract_answer(response)
+                   for start in range(0, len(responses), extraction_chunk_size)
+                   for response in responses.iloc[start:start + extraction_chunk_size].to_numpy(dtype=object)]
+    if prompts is not None:
+        # the options are only needed for responses without a letter, so only those prompts are parsed
+        unmatched = [i for i, extraction in enumerate(extractions)
+                     if extraction.failure in ["declined", "unfinished_rationale", "no_matching_option"]]
+        for i, response, prompt in zip(unmatched, responses.iloc[unmatched].to_numpy(dtype=object),
+                                       prompts.iloc[unmatched].to_numpy(dtype=object)):
+            extractions[i] = extract_answer(response, parse_options(prompt))
+    return pd.DataFrame(extractions, index=responses.index, columns=Extraction._fields)
@@ -0,0 +1,96 @@
+"""
+This file contains the backends that prompts can be sent to: the OpenAI API, or a model running locally on the CPU.
+Each one makes the functions run_queries sends batches of prompts through.
+"""
+import threading
+
+from query_engine import make_openai_completion, make_openai_next_token_scorer, make_openai_echo_scorer
+
+
+class Backend:
+    """
+    A model that batches of prompts can be sent to
+    """
+    # the name the model's responses are cached under
+    name = None
+    # whether requests count against the API rate limits
+    rate_limited = True
+
+    def make_completion(self, temperature: float, max_tokens: int = 256, n: int = 1):
+        """
+        Make a function that takes a batch of prompts and returns one response per prompt: the text if n is 1,
+        otherwise a list of n sampled texts
+        """
+        raise NotImplementedError
+
+    def make_next_token_scorer(self, labels: list, top_logprobs: int = 5):
+        """
+        Make a function that takes a batch of prompts and returns, for each one, the log-probability of each label as
+        the next token (None where it isn't known)
+        """
+        raise NotImplementedError(f"{type(self).__name__} can't score next tokens")
+
+    def make_echo_scorer(self, continuation_length: int):
+        """
+        Make a function that takes a batch of prompts and returns, for each one, the total log-probability of its last
+        continuation_length characters
+        """
+        raise NotImplementedError(f"{type(self).__name__} can't echo-score prompts")
+
+
+class OpenAIBackend(Backend):
+    """
+    A model behind the OpenAI completions endpoint
+    """
+
+    def __init__(self, engine: str):
+        self.name = engine
+
+    def make_completion(self, temperature: float, max_tokens: int = 256, n: int = 1):
+        return make_openai_completion(self.name, temperature=temperature, max_tokens=max_tokens, n=n)
+
+    def make_next_token_scorer(self, labels: list, top_logprobs: int = 5):
+        return make_openai_next_token_scorer(self.name, labels, top_logprobs=top_logprobs)
+
+    def make_echo_scorer(self, continuation_length: int):
+        return make_openai_echo_scorer(self.name, continuation_length=continuation_length)
+
+
+class LocalBackend(Backend):
+    """
+    A Hugging Face causal language model running on the CPU (see local_model.py). The model is loaded the first time
+    it is used. Generation stops at the stop string, since anything after it is the model making up another example.
+    """
+    rate_limited = False
+
+    def __init__(self, model_name: str, stop: str = "###", **model_kwargs):
+        self.name = f"local/{model_name}"
+        self.model_name = model_name
+        self.stop = stop
+        self.model_kwargs = model_kwargs
+        self.model = None
+        self.lock = threading.Lock()
+
+    def get_model(self):
+        with self.lock:
+            if self.model is None:
+                # imported here so that torch is only loaded when a local model is actually used
+                from local_model import LocalModel
+                self.model = LocalModel(self.model_name, **self.model_kwargs)
+        return self.model
+
+    def make_completion(self, temperature: float, max_tokens: int = 256, n: int = 1):
+        def complete(prompts: list) -> list:
+            return self.get_model().generate(prompts, temperature, max_tokens=max_tokens, n=n, stop=self.stop)
+        return complete
+
+    def make_next_token_scorer(self, labels: list, top_logprobs: int = 5):
+        # the local model gives the whole distribution, so there's no need to limit it to the top tokens
+        def score(prompts: list) -> list:
+            return self.get_model().next_token_logprobs(prompts, labels)
+        return score
+
+    def make_echo_scorer(self, continuation_length: int):
+        def score(prompts: list) -> list:
+            return self.get_model().echo_logprobs(prompts, continuation_length)
+        return score
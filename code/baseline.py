@@ -0,0 +1,105 @@
+"""
+This file contains random baselines and permutation tests for the appropriateness scores, computed exactly (by
+convolving the distributions of integer ratings) or with a single vectorized draw
+"""
+import numpy as np
+
+
+def convolve_power(pmf: np.ndarray, n: int) -> np.ndarray:
+    """
+    Get the distribution of the sum of n independent draws from pmf (indexed by value) by repeated squaring
+    """
+    result = np.array([1.0])
+    while n > 0:
+        if n % 2 == 1:
+            result = np.convolve(result, pmf)
+        pmf = np.convolve(pmf, pmf)
+        n //= 2
+    return result
+
+
+def exact_null_distribution(ratings, n_questions: int) -> tuple:
+    """
+    Get the exact distribution of the mean rating when each of n_questions answers is chosen uniformly at random
+    from ratings (which may repeat, e.g. [0, 0, 0, 1]). Returns the possible means and their probabilities.
+    """
+    ratings = np.asarray(ratings, dtype=int)
+    min_rating = ratings.min()
+    single_pmf = np.bincount(ratings - min_rating) / len(ratings)
+    sum_pmf = convolve_power(single_pmf, n_questions)
+    means = (np.arange(len(sum_pmf)) + min_rating * n_questions) / n_questions
+    return means, sum_pmf
+
+
+def null_quantile(means: np.ndarray, probabilities: np.ndarray, q: float) -> float:
+    """
+    Get the q-th quantile (between 0 and 1) of a discrete distribution
+    """
+    cdf = np.cumsum(probabilities)
+    return means[min(np.searchsorted(cdf, q - 1e-12), len(means) - 1)]
+
+
+def random_baseline_summary(observed_mean: float, ratings, n_questions: int, alpha: float = 0.05) -> dict:
+    """
+    Compare an observed mean rating to choosing answers at random: get the mean and confidence interval of the random
+    baseline, and the (two-sided) probability that a random chooser lands further from the chance level than the
+    observed mean.
+    """
+    means, probabilities = exact_null_distribution(ratings, n_questions)
+    chance_level = np.mean(ratings)
+    further_out = np.abs(means - chance_level) > abs(observed_mean - chance_level) + 1e-12
+    return {
+        "random_mean": chance_level,
+        "random_ci_lower": null_quantile(means, probabilities, alpha / 2),
+        "random_ci_upper": null_quantile(means, probabilities, 1 - alpha / 2),
+        "p_val": probabilities[further_out].sum(),
+    }
+
+
+def simulate_null_means(ratings, n_questions: int, n_simulations: int = 10000, rng=None) -> np.ndarray:
+    """
+    Simulate the mean rating of a random chooser n_simulations times in one vectorized draw
+    """
+    rng = np.random.default_rng(rng)
+    return rng.choice(np.asarray(ratings), size=(n_simulations, n_questions)).mean(axis=1)
+
+
+def paired_permutation_test(scores_a, scores_b, n_permutations: int = None, rng=None) -> tuple:
+    """
+    Test whether two conditions differ on the same items by randomly flipping the sign of each paired difference.
+    With integer scores and n_permutations left as None, the p-value is exact. Returns the mean difference and the
+    two-sided p-value.
+    """
+    differences = np.asarray(scores_a, dtype=float) - np.asarray(scores_b, dtype=float)
+    observed = differences.sum()
+
+    if n_permutations is None and np.all(differences == np.round(differences)):
+        # each item adds +|d| or -|d| with equal probability, so the null distribution of the sum is a convolution
+        magnitudes = np.abs(differences).astype(int)
+        total = magnitudes.sum()
+        pmf = np.zeros(2 * total + 1)
+        pmf[total] = 1.0
+        for magnitude in magnitudes[magnitudes > 0]:
+            pmf = 0.5 * (np.roll(pmf, magnitude) + np.roll(pmf, -magnitude))
+        sums = np.arange(-total, total + 1)
+        p_val = pmf[np.abs(sums) >= abs(observed) - 1e-9].sum()
+    else:
+        rng = np.random.default_rng(rng)
+        signs = rng.choice([-1.0, 1.0], size=(n_permutations or 10000, len(differences)))
+        null_sums = signs @ differences
+        p_val = np.mean(np.abs(null_sums) >= abs(observed) - 1e-9)
+
+    return observed / len(differences), p_val
+
+
+def compare_conditions(df_a, df_b, on: str = None, score_column: str = "appropriateness_score", **kwargs) -> tuple:
+    """
+    Run a paired permutation test between two processed response files, matching items on the given column. By
+    default items are matched on their statement, since the corpus's IDs aren't unique. The column has to identify
+    each item in both files, so that every item is paired exactly once.
+    """
+    if on is None:
+        on = "Statement" if "Statement" in df_a.columns else "statement"
+    df_paired = df_a[[on, score_column]].merge(df_b[[on, score_column]], on=on, suffixes=("_a", "_b"),
+                                               validate="one_to_one").dropna()
+    return paired_permutation_test(df_paired[f"{score_column}_a"], df_paired[f"{score_column}_b"], **kwargs)
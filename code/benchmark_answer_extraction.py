@@ -0,0 +1,61 @@
+"""
+This file compares answer_extraction.extract_answers to the original parser (extract_guess) on every saved model
+response in data/model-outputs: how fast each one is, how many responses each one parses, and why the rest fail
+"""
+import glob
+import os
+import time
+
+import pandas as pd
+from pyprojroot import here
+from analyze_model_responses import extract_guess
+from answer_extraction import extract_answers
+
+# how many times to time each parser (the fastest time is reported)
+n_repeats = 5
+
+
+def time_parser(parse, n_repeats: int = 5) -> tuple:
+    """
+    Run a parser several times, returning its output and its fastest time in seconds
+    """
+    times = []
+    for _ in range(n_repeats):
+        start = time.perf_counter()
+        output = parse()
+        times.append(time.perf_counter() - start)
+    return output, min(times)
+
+
+def extract_guess_or_none(response):
+    """
+    The original parser applied to one response, with missing responses treated as unparsed
+    """
+    return extract_guess(response) if isinstance(response, str) else None
+
+
+if __name__ == "__main__":
+
+    paths = sorted(glob.glob(os.path.join(here("data/model-outputs"), "*.csv")))
+    df_responses = pd.concat([pd.read_csv(path, usecols=["prompt", "model_response"]) for path in paths],
+                             ignore_index=True)
+    responses, prompts = df_responses["model_response"], df_responses["prompt"]
+    print(f"{len(responses)} responses from {len(paths)} files")
+
+    # the original parser, applied one response at a time, is the reference
+    row_wise, row_wise_time = time_parser(lambda: responses.map(extract_guess_or_none), n_repeats)
+    extractions, extraction_time = time_parser(lambda: extract_answers(responses, prompts), n_repeats)
+    for name, seconds in [("extract_guess", row_wise_time), ("extract_answers", extraction_time)]:
+        print(f"{name}: {len(responses) / seconds:,.0f} responses/s")
+
+    old_parsed = row_wise.notna()
+    new_parsed = extractions["label"].notna()
+    both_parsed = old_parsed & new_parsed
+    print(f"parsed by extract_guess: {old_parsed.sum()} ({old_parsed.mean():.1%})")
+    print(f"parsed by extract_answers: {new_parsed.sum()} ({new_parsed.mean():.1%})")
+    print(f"recovered (only parsed by extract_answers): {(new_parsed & ~old_parsed).sum()} "
+          f"({(new_parsed & ~old_parsed).sum() / max((~old_parsed).sum(), 1):.1%} of the original failures)")
+    print(f"no longer parsed: {(old_parsed & ~new_parsed).sum()}")
+    print(f"parsed by both with different answers: {(row_wise[both_parsed] != extractions['label'][both_parsed]).sum()}")
+    print(f"answers by source:\n{extractions['source'].value_counts().to_string()}")
+    print(f"failures by type:\n{extractions['failure'].value_counts().to_string()}")
@@ -0,0 +1,168 @@
+"""
+This file benchmarks the CPU-bound stages of the pipeline (building prompts, parsing responses, bootstrapping, the
+random baseline and aggregating the tables) on the checked-in corpus and model outputs, and on copies of them scaled up
+10x and 100x. It reports the throughput and peak memory of every stage and compares them to a stored baseline, so an
+optimization (or a regression) shows up as a change from the baseline. It runs offline, on the CPU.
+"""
+import glob
+import json
+import os
+import platform
+import time
+import tracemalloc
+
+import numpy as np
+import pandas as pd
+from pyprojroot import here
+from analyze_model_responses import extract_guess, rank_guesses
+from answer_extraction import extract_answers
+from baseline import random_baseline_summary
+from bootstrap import bootstrapped_ci
+from create_tables import summarize_conditions
+from query_gpt3 import make_corpus_prompts
+
+
+def scale_up(df: pd.DataFrame, scale: int) -> pd.DataFrame:
+    """
+    Make a synthetic dataframe scale times the size of df by repeating its rows
+    """
+    return pd.concat([df] * scale, ignore_index=True)
+
+
+def load_inputs() -> dict:
+    """
+    Read the checked-in corpus, raw responses and processed responses that the stages are run on
+    """
+    raw_paths = sorted(glob.glob(os.path.join(here("data/model-outputs"), "*.csv")))
+    processed_paths = sorted(glob.glob(os.path.join(here("data/model-outputs/processed"), "*.csv")))
+    return {
+        "corpus": pd.read_csv(here("data/katz-corpus/katz-corpus-test.csv")),
+        "responses": pd.concat([pd.read_csv(path, usecols=["prompt", "model_response"]) for path in raw_paths],
+                               ignore_index=True),
+        "processed": {os.path.basename(path): pd.read_csv(path) for path in processed_paths},
+    }
+
+
+def make_stages(inputs: dict, scale: int) -> dict:
+    """
+    Set up every stage on the inputs scaled up by the given factor. Returns, for each stage, the number of items it
+    processes and a function that runs it.
+    """
+    df_corpus = scale_up(inputs["corpus"], scale)
+    df_responses = scale_up(inputs["responses"], scale)
+    responses_by_condition = {name: scale_up(df, scale) for name, df in inputs["processed"].items()}
+    df_scored = next(df for name, df in responses_by_condition.items() if "inverse" not in name)
+    scores = df_scored["appropriateness_score"].dropna().to_numpy()
+
+    def make_prompts():
+        # the same path query_condition builds a condition's prompts through
+        for prompt_type in ["basic", "QUD"]:
+            make_corpus_prompts(df_corpus, "standard", "test", prompt_type, K=10)
+
+    def parse_row_wise():
+        for response in df_responses["model_response"]:
+            if isinstance(response, str):
+                extract_guess(response)
+
+    def parse_and_rank():
+        # the analysis's parse stage
+        guesses = extract_answers(df_scored["model_response"], df_scored["prompt"])["label"]
+        rank_guesses(guesses, df_scored, "standard")
+
+    return {
+        "make_prompts": (2 * len(df_corpus), make_prompts),
+        "extract_guess": (len(df_responses), parse_row_wise),
+        "extract_answers": (len(df_responses),
+                            lambda: extract_answers(df_responses["model_response"], df_responses["prompt"])),
+        "rank_guesses": (len(df_scored), parse_and_rank),
+        "bootstrapped_ci": (len(scores), lambda: bootstrapped_ci(scores)),
+        "random_baseline": (len(scores),
+                            lambda: random_baseline_summary(scores.mean(), [1, 2, 3, 4], n_questions=len(scores))),
+        "create_tables": (sum(len(df) for df in responses_by_condition.values()),
+                          lambda: summarize_conditions(responses_by_condition)),
+    }
+
+
+def measure(run, n_repeats: int = 3) -> dict:
+    """
+    Time a stage several times (keeping the fastest time), then run it once more under tracemalloc for its peak memory.
+    The memory is measured separately since tracing allocations slows everything down. A first, untimed run warms up
+    whatever the stage loads or caches the first time (like the few-shot corpora).
+    """
+    run()
+    times = []
+    for _ in range(n_repeats):
+        start = time.perf_counter()
+        run()
+        times.append(time.perf_counter() - start)
+    tracemalloc.start()
+    run()
+    peak_bytes = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+    return {"seconds": min(times), "peak_mb": peak_bytes / 1024 ** 2}
+
+
+def run_benchmarks(scales: list, n_repeats: int = 3) -> dict:
+    """
+    Benchmark every stage at every scale, returning the results keyed by "stage@scale"
+    """
+    inputs = load_inputs()
+    results = {}
+    for scale in scales:
+        for name, (n_items, run) in make_stages(inputs, scale).items():
+            result = measure(run, n_repeats=n_repeats)
+            result["items"] = n_items
+            result["items_per_second"] = n_items / result["seconds"]
+            results[f"{name}@{scale}x"] = result
+            print(f"{name}@{scale}x: {n_items} items in {result['seconds']:.3f}s "
+                  f"({result['items_per_second']:,.0f}/s), peak {result['peak_mb']:.1f} MB")
+    return results
+
+
+def compare_to_baseline(results: dict, baseline: dict, threshold: float = 1.25) -> list:
+    """
+    Compare the results to a baseline, printing the change in throughput and peak memory of every stage. Returns the
+    stages whose throughput dropped, or whose peak memory grew, by more than the threshold factor.
+    """
+    regressions = []
+    for key, result in results.items():
+        if key not in baseline:
+            print(f"{key}: not in the baseline")
+            continue
+        speedup = result["items_per_second"] / baseline[key]["items_per_second"]
+        memory_ratio = result["peak_mb"] / max(baseline[key]["peak_mb"], 1e-6)
+        flag = ""
+        if speedup < 1 / threshold or memory_ratio > threshold:
+            regressions.append(key)
+            flag = "  <-- regression"
+        print(f"{key}: {speedup:.2f}x throughput, {memory_ratio:.2f}x peak memory{flag}")
+    return regressions
+
+
+# the factors to scale the checked-in data up by
+scales = [1, 10, 100]
+# how many times to time each stage (the fastest time is reported)
+n_repeats = 3
+baseline_path = "data/benchmarks/baseline.json"
+# overwrite the stored baseline with this run's results instead of comparing to it
+save_baseline = False
+# how much slower (or bigger) than the baseline a stage has to get to count as a regression
+regression_threshold = 1.25
+
+if __name__ == "__main__":
+
+    results = run_benchmarks(scales, n_repeats=n_repeats)
+
+    if save_baseline or not os.path.exists(here(baseline_path)):
+        os.makedirs(os.path.dirname(here(baseline_path)), exist_ok=True)
+        with open(here(baseline_path), "w") as f:
+            json.dump({"machine": platform.platform(), "python": platform.python_version(),
+                       "numpy": np.__version__, "pandas": pd.__version__, "results": results}, f, indent=2)
+            f.write("\n")
+        print(f"saved the baseline to {baseline_path}")
+    else:
+        with open(here(baseline_path), "r") as f:
+            baseline = json.load(f)
+        print(f"compared to the baseline from {baseline['machine']}:")
+        regressions = compare_to_baseline(results, baseline["results"], threshold=regression_threshold)
+        print(f"{len(regressions)} regressions: {regressions}" if len(regressions) > 0 else "no regressions")
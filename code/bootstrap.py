@@ -0,0 +1,169 @@
+"""
+This file contains a memory-efficient bootstrap for the mean of discrete scores (e.g. 1-4 appropriateness ratings)
+"""
+from statistics import NormalDist
+
+import numpy as np
+from baseline import convolve_power
+
+# the widest range of resample sums whose distribution is worked out exactly (wider ones are drawn as binomial chains)
+max_enumerated_sums = 10000
+# the most distinct values to draw as a binomial chain (scores with more are resampled directly, a chunk at a time)
+max_chained_values = 32
+# how many scores to resample at once when resampling directly
+resample_chunk_size = 10 ** 7
+
+
+def resample_sum_distribution(values: np.ndarray, counts: np.ndarray) -> tuple:
+    """
+    Get the exact distribution of the sum of a bootstrap resample (len(scores) draws with replacement) when the scores
+    are integers, by convolving the distribution of a single draw with itself. Returns the possible sums and their
+    cumulative probabilities, or None if the scores aren't integers or the sums have too wide a range to enumerate.
+    """
+    n_scores = counts.sum()
+    if not np.all(values == np.round(values)) or (values[-1] - values[0]) * n_scores > max_enumerated_sums:
+        return None
+    min_value = int(values[0])
+    single_pmf = np.bincount(values.astype(int) - min_value, weights=counts) / n_scores
+    sum_pmf = convolve_power(single_pmf, n_scores)
+    return min_value * n_scores + np.arange(len(sum_pmf)), np.cumsum(sum_pmf)
+
+
+def sample_sums(sums: np.ndarray, cdf: np.ndarray, uniforms: np.ndarray) -> np.ndarray:
+    """
+    Turn uniform draws into draws of the sum by inverting its cumulative distribution
+    """
+    return sums[np.minimum(np.searchsorted(cdf, uniforms, side="right"), len(sums) - 1)]
+
+
+def bootstrap_means(scores, n: int = 100000, rng=None) -> np.ndarray:
+    """
+    Draw n bootstrap resamples of the mean of scores.
+    Rather than materializing an (n, len(scores)) matrix of resampled scores, this draws the sum of each resample
+    directly: for integer scores from the exact distribution of the sum (one uniform draw per resample), and otherwise
+    by drawing how many times each distinct score value appears in each resample (a multinomial, drawn as a chain of
+    binomials). Scores with too many distinct values for a chain (e.g. expected ratings) are resampled directly, but a
+    chunk of resamples at a time, so memory stays bounded.
+    """
+    rng = np.random.default_rng(rng)
+    values, counts = np.unique(np.asarray(scores, dtype=float), return_counts=True)
+    n_scores = counts.sum()
+
+    distribution = resample_sum_distribution(values, counts)
+    if distribution is not None:
+        return sample_sums(*distribution, rng.random(n)) / n_scores
+
+    if len(values) > max_chained_values:
+        scores = np.asarray(scores, dtype=float)
+        chunk_size = max(1, resample_chunk_size // n_scores)
+        chunk_sizes = [min(chunk_size, n - start) for start in range(0, n, chunk_size)]
+        return np.concatenate([scores[rng.integers(0, n_scores, size=(size, n_scores))].mean(axis=1)
+                               for size in chunk_sizes])
+
+    totals = np.zeros(n)
+    remaining_draws = np.full(n, n_scores)
+    remaining_count = n_scores
+    for value, count in zip(values[:-1], counts[:-1]):
+        # conditional on the draws so far, the number of copies of this value is binomial
+        value_draws = rng.binomial(remaining_draws, count / remaining_count)
+        totals += value * value_draws
+        remaining_draws -= value_draws
+        remaining_count -= count
+    totals += values[-1] * remaining_draws
+
+    return totals / n_scores
+
+
+def bca_percentiles(scores, means: np.ndarray, alpha: float = 0.05) -> tuple:
+    """
+    Compute the bias-corrected and accelerated (BCa) percentiles to read the confidence interval off of
+    """
+    values, counts = np.unique(np.asarray(scores, dtype=float), return_counts=True)
+    n_scores = counts.sum()
+    observed_mean = values @ counts / n_scores
+
+    # bias correction: how far the bootstrap distribution is shifted from the observed mean
+    proportion_below = np.clip(np.mean(means < observed_mean), 1 / len(means), 1 - 1 / len(means))
+    z0 = NormalDist().inv_cdf(proportion_below)
+
+    # acceleration from the jackknife, where leaving out any copy of the same value gives the same mean
+    jackknife_means = (values @ counts - values) / (n_scores - 1)
+    jackknife_average = jackknife_means @ counts / n_scores
+    deviations = jackknife_average - jackknife_means
+    denominator = 6 * (counts @ deviations ** 2) ** 1.5
+    acceleration = counts @ deviations ** 3 / denominator if denominator > 0 else 0.0
+
+    percentiles = []
+    for z_alpha in [NormalDist().inv_cdf(alpha / 2), NormalDist().inv_cdf(1 - alpha / 2)]:
+        adjusted = NormalDist().cdf(z0 + (z0 + z_alpha) / (1 - acceleration * (z0 + z_alpha)))
+        percentiles.append(100 * adjusted)
+    return tuple(percentiles)
+
+
+def bootstrapped_ci(scores, n: int = 100000, rng=None, method: str = "percentile", alpha: float = 0.05) -> tuple:
+    """
+    Construct a bootstrapped confidence interval for the mean of scores, using either the percentile or BCa method
+    """
+    scores = np.asarray(scores, dtype=float)
+    means = bootstrap_means(scores, n=n, rng=rng)
+
+    if method == "percentile":
+        lower_percentile, upper_percentile = 100 * alpha / 2, 100 * (1 - alpha / 2)
+    elif method == "bca":
+        lower_percentile, upper_percentile = bca_percentiles(scores, means, alpha=alpha)
+    else:
+        raise ValueError(f"Invalid bootstrap method: {method}")
+
+    mean = np.mean(scores)
+    ci_lower, ci_upper = np.percentile(means, [lower_percentile, upper_percentile])
+
+    return mean, ci_lower, ci_upper
+
+
+def bootstrap_means_many(score_lists: list, n: int = 100000, rng=None) -> np.ndarray:
+    """
+    Draw n bootstrap resamples of the mean of each of several lists of scores at once, returning an (n_conditions, n)
+    array. rng is either one generator shared by all the conditions or a list with one generator per condition. With
+    one generator and integer scores, the uniform draws for every condition are made in one go; otherwise each
+    condition is drawn as by bootstrap_means (so with a generator per condition, each row is exactly what
+    bootstrap_means would draw from that generator).
+    """
+    score_lists = [np.asarray(scores, dtype=float) for scores in score_lists]
+    if isinstance(rng, (list, tuple)):
+        return np.stack([bootstrap_means(scores, n=n, rng=condition_rng)
+                         for scores, condition_rng in zip(score_lists, rng)])
+
+    rng = np.random.default_rng(rng)
+    distributions = [resample_sum_distribution(*np.unique(scores, return_counts=True)) for scores in score_lists]
+    if any(distribution is None for distribution in distributions):
+        return np.stack([bootstrap_means(scores, n=n, rng=rng) for scores in score_lists])
+
+    uniforms = rng.random((len(score_lists), n))
+    n_scores = np.array([scores.size for scores in score_lists])
+    return np.stack([sample_sums(*distribution, row_uniforms)
+                     for distribution, row_uniforms in zip(distributions, uniforms)]) / n_scores[:, None]
+
+
+def bootstrap_many(score_lists: list, n: int = 100000, rng=None, method: str = "percentile",
+                   alpha: float = 0.05) -> np.ndarray:
+    """
+    Bootstrap the mean of several conditions at once, drawing all of their resamples into one array (see
+    bootstrap_means_many) and reading every interval off of it together. Returns an array with one
+    (mean, ci_lower, ci_upper) row per condition.
+    """
+    score_lists = [np.asarray(scores, dtype=float) for scores in score_lists]
+    results = np.empty((len(score_lists), 3))
+    if len(score_lists) == 0:
+        return results
+    means = bootstrap_means_many(score_lists, n=n, rng=rng)
+    results[:, 0] = [np.mean(scores) for scores in score_lists]
+
+    if method == "percentile":
+        results[:, 1:] = np.percentile(means, [100 * alpha / 2, 100 * (1 - alpha / 2)], axis=1).T
+    elif method == "bca":
+        # each condition has its own percentiles to read its interval off of
+        for i, scores in enumerate(score_lists):
+            results[i, 1:] = np.percentile(means[i], bca_percentiles(scores, means[i], alpha=alpha))
+    else:
+        raise ValueError(f"Invalid bootstrap method: {method}")
+    return results
@@ -1,80 +1,59 @@
 """
-This file computes the total number of tokens in the prompts, along with an upper bound on the number of tokens in the
-responses.
+This file computes the total number of tokens in the prompts, along with the expected and upper-bound number of tokens
+in the responses (from the lengths of past responses), and the estimated cost of the whole grid.
 """
 import numpy as np
-import pandas as pd
-from pyprojroot import here
-from transformers import GPT2Tokenizer
-from prompt_generation import make_k_shot_prompt, make_rationale_prompt
-from pyprojroot import here
+from query_gpt3 import make_condition_prompts, plan_condition, max_tokens
+from cost_planner import historical_response_tokens, combine_plans, format_plan
+from token_counting import TokenCounter
+from instrumentation import Metrics, set_metrics, stage, make_metrics_path, format_summary
 
 # global variables
-task_description = "Choose the most appropriate paraphrase of the first sentence."
 prompt_types = ["basic", "non_explanation", "QUD", "similarity", "contrast"]
 gpt_versions = ["curie", "davinci"]
+task_type = "standard"
 corpus_set = "test"
 temp = 0.9
 K = 10
 
-gpt_version_codes = {
-    "curie": "text-curie-001",
-    "davinci": "text-davinci-002"
-}
-
 if __name__ == "__main__":
 
-    # read the relevant corpus
-    if corpus_set == "dev":
-        df_corpus = pd.read_csv(here(f"data/katz-corpus/katz-corpus-dev.csv"))
-    elif corpus_set == "test":
-        df_corpus = pd.read_csv(here(f"data/katz-corpus/katz-corpus-test.csv"))
-    else:
+    if corpus_set not in ["dev", "test"]:
         raise ValueError(f"Invalid corpus set: {corpus_set}")
 
-    tokenizer = GPT2Tokenizer.from_pretrained("gpt2")
-
-    total_tokens = 0
-    for index, row in df_corpus.iterrows():
-
-        for prompt_type in prompt_types:
-            for gpt_version in gpt_versions:
-
-                # create the relevant prompt
-                if prompt_type == "basic":
-                    prompt = make_k_shot_prompt(row["prompt"], task_description, k=K)
-                elif prompt_type == "non_explanation":
-                    prompt = make_rationale_prompt(row["prompt"], task_description, rationale_type=prompt_type,
-                                                   k=K, step_by_step=False)
-                else:
-                    prompt = make_rationale_prompt(row["prompt"], task_description, rationale_type=prompt_type,
-                                                   k=K, step_by_step=True)
-
-                # computer the number of tokens in the prompt
-                n_tokens = len(tokenizer(prompt)["input_ids"])
+    metrics = Metrics(make_metrics_path("compute_prompt_tokens"))
+    set_metrics(metrics)
+    token_counter = TokenCounter("gpt2")
 
-                total_tokens += n_tokens
-
-    prompt_types[2] = "QUD_v3"
-
-    # computer the upper bound of the number of output tokens
+    plans = []
     longest_response = 0
-    for gpt_version in gpt_versions:
-        for prompt_type in prompt_types:
-            df_responses = pd.read_csv(here("data/model-outputs-old/model_responses_corpus={}-set={}-gpt={}-prompt={}-k={}-temp={}-processed.csv"
-                                            .format("katz", corpus_set, gpt_version, prompt_type, K, temp))).dropna(axis=0, subset="model_response")
-
-            df_responses["length"] = df_responses["model_response"].apply(lambda x: len(tokenizer(x)["input_ids"]))
-            max_length = df_responses["length"].max()
-            if max_length > longest_response:
-                longest_response = max_length
+    upper_bound_output_tokens = 0
+    for prompt_type in prompt_types:
+        for gpt_version in gpt_versions:
+            # plan the condition, tokenizing the shared few-shot blocks only once
+            with stage("make_prompts", prompt_type=prompt_type, gpt_version=gpt_version):
+                df_corpus, prompts_parts = make_condition_prompts(task_type, corpus_set, prompt_type, K)
+            with stage("plan", prompt_type=prompt_type, gpt_version=gpt_version):
+                plan = plan_condition(task_type, corpus_set, prompt_type, gpt_version, temp, K, token_counter,
+                                      prompts_parts=prompts_parts)
+            print(f"{prompt_type}, {gpt_version}: {format_plan(plan)}")
+            plans.append(plan)
+
+            # the upper bound on output tokens: every response is as long as the longest past response
+            response_tokens = historical_response_tokens(token_counter, prompt_type, gpt_version, task_type)
+            condition_longest = int(response_tokens.max()) if len(response_tokens) > 0 else max_tokens
+            longest_response = max(longest_response, condition_longest)
+            upper_bound_output_tokens += condition_longest * len(df_corpus)
+
+    total = combine_plans(plans)
+    total_tokens = total["input_tokens"]
 
     print(f"Longest response: {longest_response}")
-
-    output_upper_bound = longest_response * len(prompt_types) * len(gpt_versions) * 151
-    print(f"upper bound on output tokens: {output_upper_bound}")
+    print(f"upper bound on output tokens: {upper_bound_output_tokens}")
+    print(f"expected output tokens: {total['expected_output_tokens']}")
     print(f"total input tokens: {total_tokens}")
 
-    print(f"overall budget: {total_tokens + output_upper_bound}")
-    print(f"per model: {(total_tokens + output_upper_bound) / len(gpt_versions)}")
-
+    print(f"overall budget: {total_tokens + upper_bound_output_tokens}")
+    print(f"per model: {(total_tokens + upper_bound_output_tokens) / len(gpt_versions)}")
+    print(f"estimated cost: ${total['expected_dollars']:.2f} (up to ${total['high_dollars']:.2f})")
+    print(format_summary(metrics.close()))
@@ -0,0 +1,139 @@
+"""
+This file estimates what a set of queries will cost (tokens, dollars, requests and wall-clock time) before any of them
+are sent, so that runs that would go over budget can be refused up front
+"""
+import glob
+import os
+
+import numpy as np
+import pandas as pd
+from pyprojroot import here
+from query_engine import make_batches, estimate_tokens
+
+# dollars per 1,000 tokens (prompt and completion tokens cost the same for these models, and local models are free)
+prices_per_1k_tokens = {
+    "curie": 0.002,
+    "davinci": 0.02,
+    "gpt2": 0.0,
+    "gpt2_medium": 0.0,
+    "gpt_neo_125M": 0.0,
+}
+
+# the typical time for one request to come back, in seconds, used to estimate how long a run takes
+typical_latency = {
+    "curie": 2.0,
+    "davinci": 6.0,
+}
+
+
+class BudgetExceededError(Exception):
+    """
+    Raised when the estimated cost of a run is over the configured budget
+    """
+
+
+def historical_response_tokens(token_counter, prompt_type: str, gpt_version: str = None,
+                               task_type: str = "standard") -> np.ndarray:
+    """
+    Get the token lengths of all the saved responses for a prompt type, preferring responses from the same model
+    """
+    inverse_part = "_inverse" if task_type == "inverse" else ""
+    paths = glob.glob(os.path.join(here("data/model-outputs"),
+                                   f"model_responses{inverse_part}_set=*-prompt={prompt_type}-*.csv"))
+    same_model_paths = [path for path in paths if f"-gpt={gpt_version}-" in os.path.basename(path)]
+    if len(same_model_paths) > 0:
+        paths = same_model_paths
+
+    responses = []
+    for path in paths:
+        responses.extend(pd.read_csv(path)["model_response"].dropna())
+    return np.array(token_counter.count_many(responses), dtype=int)
+
+
+def plan_queries(
+        prompts_parts: list,
+        token_counter,
+        prompt_type: str,
+        gpt_version: str,
+        task_type: str = "standard",
+        n_samples: int = 1,
+        max_tokens: int = 256,
+        n_workers: int = 8,
+        requests_per_minute: float = 60,
+        tokens_per_minute: float = 250000,
+        max_batch_size: int = 1,
+        batch_token_budget: int = None,
+    ) -> dict:
+    """
+    Estimate the tokens, cost, number of requests and wall-clock time for sending the given prompts (each given as
+    its parts, see prompt_generation.join_parts)
+    """
+    input_tokens = np.array(token_counter.count_prompts(prompts_parts))
+
+    # expected output tokens come from the distribution of past response lengths, capped at max_tokens
+    response_tokens = np.minimum(historical_response_tokens(token_counter, prompt_type, gpt_version, task_type),
+                                 max_tokens)
+    if len(response_tokens) > 0:
+        mean_response_tokens = response_tokens.mean()
+        high_response_tokens = np.percentile(response_tokens, 95)
+    else:
+        # with no history to go on, assume every response uses all of its tokens
+        mean_response_tokens = high_response_tokens = max_tokens
+    n_responses = len(prompts_parts) * n_samples
+    expected_output_tokens = mean_response_tokens * n_responses
+    high_output_tokens = high_response_tokens * n_responses
+
+    price = prices_per_1k_tokens.get(gpt_version, max(prices_per_1k_tokens.values())) / 1000
+    prompts = ["".join(parts) for parts in prompts_parts]
+    n_requests = len(make_batches(prompts, token_budget=batch_token_budget, max_batch_size=max_batch_size,
+                                  tokens_per_response=max_tokens * n_samples))
+
+    # the run takes as long as the slowest of: the request rate limit, the token rate limit (which counts the full
+    # max_tokens for every response), and the request latency spread over the workers
+    rate_limited_tokens = sum(estimate_tokens(prompt) for prompt in prompts) + max_tokens * n_responses
+    expected_seconds = max(
+        60 * n_requests / requests_per_minute,
+        60 * rate_limited_tokens / tokens_per_minute,
+        n_requests * typical_latency.get(gpt_version, 5.0) / n_workers,
+    )
+
+    return {
+        "n_prompts": len(prompts_parts),
+        "n_requests": n_requests,
+        "input_tokens": int(input_tokens.sum()),
+        "expected_output_tokens": int(round(expected_output_tokens)),
+        "high_output_tokens": int(round(high_output_tokens)),
+        "expected_dollars": (input_tokens.sum() + expected_output_tokens) * price,
+        "high_dollars": (input_tokens.sum() + high_output_tokens) * price,
+        "expected_seconds": expected_seconds,
+    }
+
+
+def combine_plans(plans: list) -> dict:
+    """
+    Add up the plans for several conditions (the time assumes they share one set of rate limits)
+    """
+    if len(plans) == 0:
+        return {"n_prompts": 0, "n_requests": 0, "input_tokens": 0, "expected_output_tokens": 0,
+                "high_output_tokens": 0, "expected_dollars": 0.0, "high_dollars": 0.0, "expected_seconds": 0.0}
+    return {key: sum(plan[key] for plan in plans) for key in plans[0]}
+
+
+def format_plan(plan: dict) -> str:
+    """
+    Describe a plan in a line of text
+    """
+    return (f"{plan['n_prompts']} prompts in {plan['n_requests']} requests, "
+            f"{plan['input_tokens']} input tokens + ~{plan['expected_output_tokens']} output tokens "
+            f"(up to {plan['high_output_tokens']}), "
+            f"~${plan['expected_dollars']:.2f} (up to ${plan['high_dollars']:.2f}), "
+            f"~{plan['expected_seconds'] / 60:.1f} minutes")
+
+
+def check_budget(plan: dict, max_dollars: float = None):
+    """
+    Refuse to run if the high estimate of the cost is over max_dollars
+    """
+    if max_dollars is not None and plan["high_dollars"] > max_dollars:
+        raise BudgetExceededError(f"Estimated cost of up to ${plan['high_dollars']:.2f} is over the budget of "
+                                  f"${max_dollars:.2f}: {format_plan(plan)}")
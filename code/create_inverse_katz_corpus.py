@@ -1,37 +1,72 @@
 """
 This file creates an "inverse Katz corpus" which contains literal sentences and options for metaphorical paraphrases
 """
-import re
+import numpy as np
 import pandas as pd
 from pyprojroot import here
 from prompt_generation import make_inverse_katz_prompt
+from seeding import make_rng
 
-def create_distractors(row, df):
+
+class DistractorSampler:
     """
-    Create distractor metaphors for a given
-    :param row: the row we are creating distractors for
-    :param df: the whole dataframe to generate the distractors from
-    :return:
+    Draws distractor metaphors for every statement in a corpus at once. The singular/plural split and the
+    stem/predicate split of every statement are computed once up front, and each statement's distractors are drawn
+    from the other statements with the same number (so the verb agrees with the stem).
     """
-    true_metaphor = row["Statement"]
-    # determine if the metaphor is singular or plural
-    if " are " in true_metaphor:
-        plural = True
-        verb = " are "
-    else:
-        plural = False
-        verb = " is "
-
-    df["plural"] = df["Statement"].apply(lambda x: True if " are " in x else False)
-
-    # get distractors
-    df_number_matched = df[(df["plural"] == plural) & (df["Statement"] != true_metaphor)]
-    distractor_sentences = df_number_matched.sample(n=3)["Statement"].values
-    stem = true_metaphor.split(verb)[0]
-    distractor_ends = [x.split(verb)[1] for x in distractor_sentences]
-    distractor_options = [stem + verb + x for x in distractor_ends]
-
-    return distractor_options
+
+    def __init__(self, statements):
+        self.statements = np.asarray(statements, dtype=object)
+        # determine if each metaphor is singular or plural, and split it into the stem and predicate
+        self.plural = np.array([" are " in statement for statement in self.statements])
+        self.verbs = np.where(self.plural, " are ", " is ")
+        split_statements = [statement.split(verb) for statement, verb in zip(self.statements, self.verbs)]
+        self.stems = np.array([parts[0] for parts in split_statements], dtype=object)
+        self.predicates = np.array([parts[1] if len(parts) > 1 else None for parts in split_statements], dtype=object)
+
+    def sample_indices(self, n_distractors: int = 3, rng=None) -> np.ndarray:
+        """
+        For every statement, draw n_distractors distinct other statements with the same number. Returns an array of
+        statement indices with one row per statement.
+        """
+        rng = np.random.default_rng(rng)
+        distractor_indices = np.empty((len(self.statements), n_distractors), dtype=int)
+        for plural in [False, True]:
+            group = np.flatnonzero(self.plural == plural)
+            if len(group) == 0:
+                continue
+            if len(group) <= n_distractors:
+                raise ValueError(f"Need more than {n_distractors} {'plural' if plural else 'singular'} statements to "
+                                 f"draw distractors, but there are only {len(group)}")
+            distractor_indices[group] = group[sample_others(len(group), n_distractors, rng)]
+        return distractor_indices
+
+    def create_distractors(self, n_distractors: int = 3, rng=None) -> list:
+        """
+        Create n_distractors distractor metaphors for every statement: its own stem with another statement's predicate
+        """
+        distractor_indices = self.sample_indices(n_distractors, rng=rng)
+        return [[self.stems[i] + self.verbs[i] + self.predicates[j] for j in distractor_indices[i]]
+                for i in range(len(self.statements))]
+
+
+def sample_others(group_size: int, n_draws: int, rng) -> np.ndarray:
+    """
+    For each of group_size items, draw n_draws distinct items from the rest of the group (not itself), in random
+    order, with one vectorized draw per column.
+    Each draw picks uniformly among the items not excluded yet, then shifts the pick past every excluded item at or
+    below it (in ascending order) to map it back to an index in the whole group.
+    """
+    excluded = np.arange(group_size)[:, None]
+    draws = []
+    for j in range(n_draws):
+        draw = rng.integers(0, group_size - 1 - j, size=group_size)
+        for column in range(excluded.shape[1]):
+            draw += draw >= excluded[:, column]
+        draws.append(draw)
+        excluded = np.sort(np.column_stack([excluded, draw]), axis=1)
+    return np.column_stack(draws)
+
 
 train_size = 30
 dev_size = 100
@@ -44,24 +79,20 @@ if __name__ == "__main__":
     # exclude the rows we want to exclude
     df_katz = df_katz[df_katz["Include"] == 1]
 
-    inverse_rows = []
-    for index, row in df_katz.iterrows():
-        distractors = create_distractors(row, df_katz)
-        row = {
-            "statement": row["Good (4)"],
-            "true_answer": row["Statement"]
-        }
-        for i, distractor in enumerate(distractors):
-            row[f"distractor_{i+1}"] = distractor
-
-        inverse_rows.append(row)
-
-    df_inverse_katz = pd.DataFrame(inverse_rows)
+    # draw distractors for every statement in one pass
+    distractor_rng = make_rng("inverse_corpus", "distractors")
+    distractors = DistractorSampler(df_katz["Statement"]).create_distractors(n_distractors=3, rng=distractor_rng)
+    df_inverse_katz = pd.DataFrame({
+        "statement": df_katz["Good (4)"].to_numpy(),
+        "true_answer": df_katz["Statement"].to_numpy(),
+    })
+    for i in range(3):
+        df_inverse_katz[f"distractor_{i+1}"] = [row_distractors[i] for row_distractors in distractors]
 
     # make the prompts and save the true answer locations
     prompts, indices = [], []
     for index, row in df_inverse_katz.iterrows():
-        prompt, index = make_inverse_katz_prompt(row)
+        prompt, index = make_inverse_katz_prompt(row, rng=make_rng("inverse_corpus", "options", row["true_answer"]))
         prompts.append(prompt)
         indices.append(index)
 
@@ -69,7 +100,7 @@ if __name__ == "__main__":
     df_inverse_katz["index"] = indices
 
     # split the data into train and dev
-    df_inverse_katz = df_inverse_katz.sample(frac=1)
+    df_inverse_katz = df_inverse_katz.sample(frac=1, random_state=make_rng("inverse_corpus", "split"))
     df_train = df_inverse_katz.iloc[:train_size]
     df_dev = df_inverse_katz.iloc[train_size:train_size+dev_size]
     df_test = df_inverse_katz.iloc[train_size+dev_size:]
@@ -4,7 +4,10 @@ This file aggregates the model results and creates LaTeX-formatted tables
 import pandas as pd
 import numpy as np
 from pyprojroot import here
-from analyze_model_responses import bootstrapped_ci
+from bootstrap import bootstrap_many
+from storage import read_outputs
+from results_catalog import ResultsCatalog
+from seeding import make_rng, make_run_key
 
 prompt_types = ["basic", "non_explanation", "subject_predicate", "QUD", "similarity"]
 
@@ -26,27 +29,75 @@ model_names = {
 K = 10
 temp = 0.2
 
+# "csv" to read each processed CSV, "parquet" to read the whole grid from the Parquet dataset in one go (run storage.py
+# first to convert the CSVs), or "catalog" to use the statistics recorded in the results catalog without reading any
+# responses (run results_catalog.py first to index the existing results)
+results_format = "csv"
+
+
+def summarize_conditions(responses_by_condition: dict, runs: dict = None) -> tuple:
+    """
+    Count the unparsed guesses of each condition's processed responses and bootstrap all their scores in one go.
+    runs maps each condition to its run's parameters, so that its bootstrap draws from the same stream as
+    analyze_model_responses and the results catalog do (and the tables show the same intervals); without it, each
+    condition's stream is keyed by the condition itself.
+    Returns the (mean, ci_lower, ci_upper) of each condition and the number of unparsed guesses of each condition.
+    """
+    non_parsed_guesses, all_scores, rngs = {}, [], []
+    for condition, df_responses in responses_by_condition.items():
+        non_parsed_guesses[condition] = len(np.where(df_responses["appropriateness_score"].isna())[0])
+        all_scores.append(df_responses["appropriateness_score"].dropna())
+        rngs.append(make_rng(make_run_key(**runs[condition]) if runs is not None else condition, "bootstrap"))
+    results = bootstrap_many(all_scores, rng=rngs)
+    return dict(zip(responses_by_condition, results)), non_parsed_guesses
+
+
 if __name__ == "__main__":
 
     table_str = f"Model "
-    all_results = {}
 
     for prompt_type in prompt_types:
         table_str += f"& {prompt_names[prompt_type]} "
     mean_table_str = table_str[:-1] + "\\\\\\hline\n"
     error_table_str = table_str[:-1] + "\\\\\\hline\n"
 
+    # read in the scores for every condition, then bootstrap them all in one go
+    conditions = [(model_type, prompt_type) for model_type in model_types for prompt_type in prompt_types]
+    if results_format == "catalog":
+        df_runs = ResultsCatalog().find(stage="processed", task_type="standard", corpus_set="test",
+                                        gpt_version=model_types, prompt_type=prompt_types, K=K, temp=temp)
+        df_runs = df_runs.set_index(["gpt_version", "prompt_type"])
+        missing = [condition for condition in conditions if condition not in df_runs.index]
+        if len(missing) > 0:
+            raise ValueError(f"Conditions missing from the results catalog: {missing}")
+        all_results = {condition: tuple(df_runs.loc[condition, ["mean", "ci_lower", "ci_upper"]])
+                       for condition in conditions}
+        non_parsed_guesses = {condition: int(df_runs.loc[condition, "n_parse_failures"]) for condition in conditions}
+    elif results_format == "parquet":
+        df_grid = read_outputs("standard", processed=True, columns=["gpt_version", "prompt_type", "appropriateness_score"],
+                               filters={"corpus_set": "test", "gpt_version": model_types, "prompt_type": prompt_types,
+                                        "K": K, "temp": temp})
+        df_by_condition = dict(list(df_grid.groupby(["gpt_version", "prompt_type"])))
+    if results_format != "catalog":
+        responses_by_condition = {}
+        for model_type, prompt_type in conditions:
+            if results_format == "parquet":
+                responses_by_condition[(model_type, prompt_type)] = df_by_condition[(model_type, prompt_type)]
+            else:
+                responses_by_condition[(model_type, prompt_type)] = pd.read_csv(here(f"data/model-outputs/processed/model_responses_set=test-gpt={model_type}-prompt={prompt_type}-k={K}-temp={temp}-processed.csv"))
+        runs = {(model_type, prompt_type): {"task_type": "standard", "corpus_set": "test", "gpt_version": model_type,
+                                            "prompt_type": prompt_type, "K": K, "temp": temp}
+                for model_type, prompt_type in conditions}
+        all_results, non_parsed_guesses = summarize_conditions(responses_by_condition, runs)
+
     for model_type in model_types:
         mean_table_str += f"{model_names[model_type]} "
         error_table_str += f"{model_names[model_type]} "
         for prompt_type in prompt_types:
-            df_responses = pd.read_csv(here(f"data/model-outputs/processed/model_responses_set=test-gpt={model_type}-prompt={prompt_type}-k={K}-temp={temp}-processed.csv"))
-
-            non_parsed_guesses = len(np.where(df_responses["appropriateness_score"].isna())[0])
-            mean_score, ci_lower, ci_upper = bootstrapped_ci(df_responses["appropriateness_score"].dropna())
+            mean_score, ci_lower, ci_upper = all_results[(model_type, prompt_type)]
 
             mean_table_str += "& {:.2f} [{:.2f}, {:.2f}] ".format(mean_score, ci_lower, ci_upper)
-            error_table_str += f"& {non_parsed_guesses} "
+            error_table_str += f"& {non_parsed_guesses[(model_type, prompt_type)]} "
 
         mean_table_str += "\\\\\n"
         error_table_str += "\\\\\n"
@@ -0,0 +1,190 @@
+"""
+This file contains lightweight instrumentation for the pipeline: how long each stage takes, distributions of values like
+request latency, and counters like tokens, retries and cache hits. Every measurement of a run is written as a JSON line
+to the run's metrics file as it happens, followed by a summary line at the end.
+
+Code records into the module-wide metrics (see get_metrics/set_metrics), which just keep the numbers in memory unless a
+run has set up metrics with a file. Code that works on one of several conditions at once (like the threads of a grid
+run) adds the condition's fields to every record it writes with record_fields.
+"""
+import contextvars
+import functools
+import json
+import os
+import threading
+import time
+from collections import Counter, defaultdict
+from contextlib import contextmanager
+
+import numpy as np
+from pyprojroot import here
+
+metrics_dir = "data/metrics"
+
+# the percentiles reported for stage times and observed values
+percentiles = [50, 90, 99]
+
+# the fields added to every record written from the current context (see record_fields)
+context_fields = contextvars.ContextVar("context_fields", default={})
+
+
+class Metrics:
+    """
+    The measurements of one run. It is thread-safe, so all the workers of a run can record into it.
+    """
+
+    def __init__(self, path: str = None, **run):
+        self.path = None if path is None else str(path)
+        if self.path is not None and os.path.dirname(self.path):
+            os.makedirs(os.path.dirname(self.path), exist_ok=True)
+        self.run = run
+        self.start = time.perf_counter()
+        self.stage_seconds = defaultdict(list)
+        self.observations = defaultdict(list)
+        self.counters = Counter()
+        self.lock = threading.Lock()
+
+    def write(self, record: dict):
+        """
+        Append a record to the metrics file (if there is one)
+        """
+        if self.path is None:
+            return
+        line = json.dumps({"time": time.time(), **self.run, **context_fields.get(), **record}) + "\n"
+        with self.lock:
+            with open(self.path, "a", encoding="utf-8") as f:
+                f.write(line)
+
+    @contextmanager
+    def stage(self, name: str, **fields):
+        """
+        Time the code inside the with block as a stage of the run. Any fields are written along with the time.
+        """
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            seconds = time.perf_counter() - start
+            with self.lock:
+                self.stage_seconds[name].append(seconds)
+            self.write({"type": "stage", "stage": name, "seconds": seconds, **fields})
+
+    def observe(self, name: str, value: float, **fields):
+        """
+        Record one value of a distribution, like the latency of a request
+        """
+        with self.lock:
+            self.observations[name].append(value)
+        self.write({"type": "observation", "name": name, "value": value, **fields})
+
+    def count(self, name: str, n: int = 1):
+        """
+        Add to a counter, like the number of tokens sent or cache hits
+        """
+        with self.lock:
+            self.counters[name] += n
+
+    def summary(self) -> dict:
+        """
+        Summarize the run so far: the total time and percentiles of every stage and observed value, and the counters
+        """
+        def describe(values):
+            return {"n": len(values), "total": float(np.sum(values)),
+                    **{f"p{q}": float(np.percentile(values, q)) for q in percentiles}}
+
+        with self.lock:
+            return {
+                "seconds": time.perf_counter() - self.start,
+                "stages": {name: describe(seconds) for name, seconds in self.stage_seconds.items()},
+                "observations": {name: describe(values) for name, values in self.observations.items()},
+                "counters": dict(self.counters),
+            }
+
+    def close(self) -> dict:
+        """
+        Write the summary of the run to the metrics file and return it
+        """
+        summary = self.summary()
+        self.write({"type": "summary", **summary})
+        return summary
+
+
+def format_summary(summary: dict) -> str:
+    """
+    Describe a run's summary in a few lines of text
+    """
+    lines = [f"total: {summary['seconds']:.2f}s"]
+    for name, stats in summary["stages"].items():
+        lines.append(f"{name}: {stats['total']:.2f}s over {stats['n']} calls")
+    for name, stats in summary["observations"].items():
+        lines.append(f"{name}: " + ", ".join(f"p{q} {stats[f'p{q}']:.3g}" for q in percentiles) +
+                     f" ({stats['n']} values)")
+    for name, value in summary["counters"].items():
+        lines.append(f"{name}: {value}")
+    return "\n".join(lines)
+
+
+def make_metrics_path(name: str) -> str:
+    """
+    Get a fresh path in the metrics directory for a run with the given name
+    """
+    return str(here(f"{metrics_dir}/{name}-{time.strftime('%Y%m%d-%H%M%S')}.jsonl"))
+
+
+# the metrics that get recorded into when a run hasn't set up its own
+default_metrics = Metrics()
+
+
+def get_metrics() -> Metrics:
+    """
+    Get the module-wide metrics
+    """
+    return default_metrics
+
+
+def set_metrics(metrics: Metrics):
+    """
+    Swap out the module-wide metrics (e.g. for a run that writes them to a file)
+    """
+    global default_metrics
+    default_metrics = metrics
+
+
+def stage(name: str, **fields):
+    """
+    Time a stage with the module-wide metrics: `with stage("parse"): ...`
+    """
+    return get_metrics().stage(name, **fields)
+
+
+def timed(name: str = None):
+    """
+    Time every call of a function with the module-wide metrics (looked up at call time): `@timed()`
+    """
+    def decorator(fn):
+        @functools.wraps(fn)
+        def wrapper(*args, **kwargs):
+            with get_metrics().stage(name or fn.__name__):
+                return fn(*args, **kwargs)
+        return wrapper
+    return decorator
+
+
+@contextmanager
+def record_fields(**fields):
+    """
+    Add fields (e.g. the condition being queried) to every record written from inside the with block. Threads only
+    see them if they run in a copy of the context (see submit_in_context).
+    """
+    token = context_fields.set({**context_fields.get(), **fields})
+    try:
+        yield
+    finally:
+        context_fields.reset(token)
+
+
+def submit_in_context(executor, fn, *args, **kwargs):
+    """
+    Submit a call to an executor, running it in a copy of the current context so that it records with the same fields
+    """
+    return executor.submit(contextvars.copy_context().run, fn, *args, **kwargs)
@@ -0,0 +1,216 @@
+"""
+This file runs a Hugging Face causal language model locally on the CPU, so the pipeline can be run offline and on open
+models. Prompts are grouped into batches of similar lengths, each batch is left-padded and decoded together, and the
+token prefix that a batch's prompts share (e.g. the task description and, with a fixed shot order, the few-shot
+examples) is run through the model only once, and kept in a cache for the batches after it.
+"""
+import math
+import threading
+
+import torch
+from transformers import AutoModelForCausalLM, AutoTokenizer
+from instrumentation import get_metrics
+from prefix_cache import PrefixCache, common_prefix_length
+
+
+def expand_past(past_key_values: tuple, batch_size: int) -> tuple:
+    """
+    Repeat the attention keys and values computed for one sequence across a batch (without copying them)
+    """
+    return tuple(tuple(tensor.expand(batch_size, *tensor.shape[1:]) for tensor in layer) for layer in past_key_values)
+
+
+class LocalModel:
+    """
+    A causal language model running on the CPU. It is thread-safe: calls from several threads take turns.
+    """
+
+    def __init__(self, model_name: str = "gpt2", max_batch_size: int = 16, max_batch_tokens: int = 16384,
+                 n_threads: int = None, seed: int = 0, prefix_cache_bytes: int = 1024 ** 3):
+        self.model_name = model_name
+        self.tokenizer = AutoTokenizer.from_pretrained(model_name)
+        self.model = AutoModelForCausalLM.from_pretrained(model_name)
+        self.model.eval()
+        if n_threads is not None:
+            torch.set_num_threads(n_threads)
+        # GPT-style models have no padding token, and the padding is masked out anyway
+        self.pad_token_id = self.tokenizer.eos_token_id
+        self.max_batch_size = max_batch_size
+        self.max_batch_tokens = max_batch_tokens
+        self.generator = torch.Generator().manual_seed(seed)
+        self.prefix_cache = PrefixCache(max_bytes=prefix_cache_bytes)
+        self.lock = threading.Lock()
+
+    def encode(self, prompts: list) -> list:
+        """
+        Tokenize each prompt
+        """
+        return self.tokenizer(list(prompts))["input_ids"]
+
+    def make_batches(self, lengths: list) -> list:
+        """
+        Group sequences of the given lengths into batches of similar lengths, so little of each batch is padding.
+        A batch is at most max_batch_size sequences and, padded to its longest sequence, max_batch_tokens tokens.
+        Returns lists of indices into lengths.
+        """
+        batches, batch = [], []
+        for i in sorted(range(len(lengths)), key=lambda i: lengths[i]):
+            # the sequences are in order of length, so the newest one is always the longest in the batch
+            if len(batch) > 0 and (len(batch) >= self.max_batch_size or
+                                   (len(batch) + 1) * lengths[i] > self.max_batch_tokens):
+                batches.append(batch)
+                batch = []
+            batch.append(i)
+        if len(batch) > 0:
+            batches.append(batch)
+        return batches
+
+    def prefix_past(self, prefix_ids: list) -> tuple:
+        """
+        Get the attention keys and values of a token prefix, running only the tokens after the longest cached prefix
+        it shares through the model
+        """
+        cached_length, past = self.prefix_cache.longest(prefix_ids)
+        if cached_length == len(prefix_ids):
+            return past
+        position_ids = torch.arange(cached_length, len(prefix_ids)).unsqueeze(0)
+        past = self.model(torch.tensor([prefix_ids[cached_length:]]), past_key_values=past, position_ids=position_ids,
+                          use_cache=True).past_key_values
+        self.prefix_cache.put(prefix_ids, past)
+        return past
+
+    def start_batch(self, token_ids: list, suffix_length: int = 1) -> tuple:
+        """
+        Set up a batch for decoding: the attention keys and values of the prefix the sequences share, and the rest of
+        each sequence, left-padded, with its attention mask and positions. At least the last suffix_length tokens of
+        every sequence are left out of the prefix, so the model gives the distribution after each of them.
+        """
+        batch_size = len(token_ids)
+        # every sequence needs at least one token of its own to get the distribution over its next token
+        prefix_length = max(0, min(common_prefix_length(token_ids), min(len(ids) for ids in token_ids) - suffix_length))
+        if prefix_length > 0:
+            past = expand_past(self.prefix_past(token_ids[0][:prefix_length]), batch_size)
+        else:
+            past = None
+
+        suffixes = [ids[prefix_length:] for ids in token_ids]
+        width = max(len(suffix) for suffix in suffixes)
+        input_ids = torch.full((batch_size, width), self.pad_token_id, dtype=torch.long)
+        attention_mask = torch.zeros((batch_size, prefix_length + width), dtype=torch.long)
+        attention_mask[:, :prefix_length] = 1
+        for i, suffix in enumerate(suffixes):
+            input_ids[i, width - len(suffix):] = torch.tensor(suffix)
+            attention_mask[i, prefix_length + width - len(suffix):] = 1
+        # the padding sits between the prefix and the rest of the sequence, so the positions skip over it
+        position_ids = (attention_mask.cumsum(dim=1) - 1).clamp(min=0)[:, prefix_length:]
+        return past, input_ids, attention_mask, position_ids
+
+    @torch.no_grad()
+    def generate_batch(self, token_ids: list, temperature: float, max_tokens: int = 256, stop: str = None) -> list:
+        """
+        Continue each token sequence of a batch by up to max_tokens tokens, sampling at the given temperature (or
+        greedily at temperature 0), until the end of text or the stop string. Returns the text of each continuation.
+        """
+        past, input_ids, attention_mask, position_ids = self.start_batch(token_ids)
+        batch_size = len(token_ids)
+        generated = [[] for _ in range(batch_size)]
+        finished = torch.zeros(batch_size, dtype=torch.bool)
+
+        for _ in range(max_tokens):
+            outputs = self.model(input_ids=input_ids, past_key_values=past, attention_mask=attention_mask,
+                                 position_ids=position_ids, use_cache=True)
+            past = outputs.past_key_values
+            logits = outputs.logits[:, -1, :]
+            if temperature > 0:
+                probabilities = torch.softmax(logits / temperature, dim=-1)
+                next_tokens = torch.multinomial(probabilities, 1, generator=self.generator).squeeze(1)
+            else:
+                next_tokens = logits.argmax(dim=-1)
+            next_tokens = next_tokens.masked_fill(finished, self.pad_token_id)
+
+            for i in torch.nonzero(~finished).flatten().tolist():
+                generated[i].append(next_tokens[i].item())
+            finished |= next_tokens == self.tokenizer.eos_token_id
+            if stop is not None:
+                for i in torch.nonzero(~finished).flatten().tolist():
+                    finished[i] = stop in self.tokenizer.decode(generated[i][-8:])
+            if finished.all():
+                break
+
+            input_ids = next_tokens.unsqueeze(1)
+            attention_mask = torch.cat([attention_mask, torch.ones((batch_size, 1), dtype=torch.long)], dim=1)
+            position_ids = position_ids[:, -1:] + 1
+
+        get_metrics().count("completion_tokens", sum(len(ids) for ids in generated))
+        texts = [self.tokenizer.decode(ids, skip_special_tokens=True) for ids in generated]
+        if stop is not None:
+            texts = [text.split(stop, 1)[0] for text in texts]
+        return texts
+
+    def generate(self, prompts: list, temperature: float, max_tokens: int = 256, n: int = 1,
+                 stop: str = None) -> list:
+        """
+        Generate n continuations of each prompt, batching prompts of similar lengths together.
+        Returns one continuation per prompt if n is 1, otherwise a list of n continuations per prompt.
+        """
+        # every sample is its own sequence in the batch
+        token_ids = [ids for ids in self.encode(prompts) for _ in range(n)]
+        get_metrics().count("prompt_tokens", sum(len(ids) for ids in token_ids))
+        texts = [None] * len(token_ids)
+        with self.lock:
+            for batch in self.make_batches([len(ids) for ids in token_ids]):
+                for i, text in zip(batch, self.generate_batch([token_ids[i] for i in batch], temperature,
+                                                              max_tokens=max_tokens, stop=stop)):
+                    texts[i] = text
+        if n == 1:
+            return texts
+        return [texts[i * n:(i + 1) * n] for i in range(len(prompts))]
+
+    @torch.no_grad()
+    def next_token_logprobs(self, prompts: list, labels: list) -> list:
+        """
+        Get the log-probability of each label as the next token after each prompt, adding up variants like " a" and
+        "a)". Returns one list of log-probabilities per prompt.
+        """
+        variants = [list({self.tokenizer.encode(variant)[0] for variant in [f" {label}", label]}) for label in labels]
+        token_ids = self.encode(prompts)
+        get_metrics().count("prompt_tokens", sum(len(ids) for ids in token_ids))
+        label_logprobs = [None] * len(prompts)
+        with self.lock:
+            for batch in self.make_batches([len(ids) for ids in token_ids]):
+                past, input_ids, attention_mask, position_ids = self.start_batch([token_ids[i] for i in batch])
+                logits = self.model(input_ids=input_ids, past_key_values=past, attention_mask=attention_mask,
+                                    position_ids=position_ids).logits[:, -1, :]
+                logprobs = torch.log_softmax(logits, dim=-1)
+                for row, i in enumerate(batch):
+                    label_logprobs[i] = [torch.logsumexp(logprobs[row, label_ids], dim=0).item()
+                                         for label_ids in variants]
+        return [[logprob if math.isfinite(logprob) else None for logprob in logprobs]
+                for logprobs in label_logprobs]
+
+    @torch.no_grad()
+    def echo_logprobs(self, prompts: list, continuation_length: int) -> list:
+        """
+        Get the total log-probability of the tokens that make up the last continuation_length characters of each
+        prompt (the continuation being scored, e.g. an option letter), like echoing the prompt back from the OpenAI
+        endpoint: a token that straddles the boundary belongs to the continuation. Returns one total per prompt.
+        """
+        encodings = self.tokenizer(list(prompts), return_offsets_mapping=True)
+        token_ids = encodings["input_ids"]
+        get_metrics().count("prompt_tokens", sum(len(ids) for ids in token_ids))
+        # how many tokens at the end of each prompt are scored (never the first, since nothing comes before it)
+        n_scored = [min(sum(end > len(prompt) - continuation_length for start, end in offsets), len(ids) - 1)
+                    for prompt, ids, offsets in zip(prompts, token_ids, encodings["offset_mapping"])]
+        totals = [None] * len(prompts)
+        with self.lock:
+            for batch in self.make_batches([len(ids) for ids in token_ids]):
+                past, input_ids, attention_mask, position_ids = self.start_batch(
+                    [token_ids[i] for i in batch], suffix_length=max(n_scored[i] for i in batch) + 1)
+                logprobs = torch.log_softmax(self.model(input_ids=input_ids, past_key_values=past,
+                                                        attention_mask=attention_mask,
+                                                        position_ids=position_ids).logits, dim=-1)
+                for row, i in enumerate(batch):
+                    # the sequences are right-aligned, so the distribution over each scored token is just before it
+                    scored_ids = torch.tensor(token_ids[i][len(token_ids[i]) - n_scored[i]:]).unsqueeze(1)
+                    totals[i] = logprobs[row, -n_scored[i] - 1:-1].gather(1, scored_ids).sum().item()
+        return totals
@@ -0,0 +1,83 @@
+"""
+This file contains a cache of the attention keys and values of token prefixes, for models that run locally (see
+local_model.py). It only uses the tensors' own methods, so it doesn't need torch to be imported.
+"""
+from collections import OrderedDict
+
+
+def common_prefix_length(token_ids: list) -> int:
+    """
+    Get the number of tokens at the start that all the token sequences share
+    """
+    length = min(len(ids) for ids in token_ids)
+    for i in range(length):
+        token = token_ids[0][i]
+        if any(ids[i] != token for ids in token_ids):
+            return i
+    return length
+
+
+def past_nbytes(past_key_values: tuple) -> int:
+    """
+    Get the memory taken up by attention keys and values
+    """
+    return sum(tensor.numel() * tensor.element_size() for layer in past_key_values for tensor in layer)
+
+
+def slice_past(past_key_values: tuple, length: int) -> tuple:
+    """
+    Get the attention keys and values of the first length tokens (a view, without copying)
+    """
+    return tuple(tuple(tensor[:, :, :length] for tensor in layer) for layer in past_key_values)
+
+
+class PrefixCache:
+    """
+    A cache of the attention keys and values of token prefixes, so a prefix shared by many prompts (the task description
+    and the few-shot examples) only goes through the model once. The least recently used prefixes are evicted once the
+    cache takes up more than max_bytes.
+    """
+
+    def __init__(self, max_bytes: int = 1024 ** 3):
+        self.max_bytes = max_bytes
+        self.entries = OrderedDict()
+        self.size = 0
+        self.hits = 0
+        self.misses = 0
+
+    def longest(self, prefix_ids: list) -> tuple:
+        """
+        Find the cached prefix that shares the most tokens with prefix_ids, returning the number of tokens they share
+        and the attention keys and values of those tokens (0 and None if nothing is shared)
+        """
+        best_length, best_key = 0, None
+        for key in self.entries:
+            length = common_prefix_length([key, prefix_ids])
+            if length > best_length:
+                best_length, best_key = length, key
+        if best_key is None:
+            self.misses += 1
+            return 0, None
+        self.hits += 1
+        self.entries.move_to_end(best_key)
+        return best_length, slice_past(self.entries[best_key], best_length)
+
+    def put(self, prefix_ids: list, past_key_values: tuple):
+        """
+        Cache the attention keys and values of a prefix, evicting the least recently used prefixes to make room
+        """
+        key = tuple(prefix_ids)
+        size = past_nbytes(past_key_values)
+        if key in self.entries or size > self.max_bytes:
+            return
+        self.entries[key] = past_key_values
+        self.size += size
+        while self.size > self.max_bytes:
+            evicted_key, evicted = self.entries.popitem(last=False)
+            self.size -= past_nbytes(evicted)
+
+    def stats(self) -> dict:
+        """
+        Get the number of cached prefixes, their size, and the hit and miss counts
+        """
+        return {"entries": len(self.entries), "size_bytes": self.size, "hits": self.hits, "misses": self.misses}
@@ -1,13 +1,87 @@
 """
-This file preprocesses the Katz corpus
+This file preprocesses the Katz corpus, or any corpus of metaphors in the same format: it makes the multiple-choice
+prompt for each statement and splits the statements into train, dev and test sets. The corpus is streamed through in
+chunks, so corpora far bigger than memory can be preprocessed, and each chunk's rows are appended to the split files as
+they're done.
 """
+import numpy as np
 import pandas as pd
 from pyprojroot import here
-from prompt_generation import make_katz_prompt
+from prompt_generation import make_katz_prompts
+from seeding import hash_uniforms, keys_to_ints
 
-# determine how big the train and dev sets should be
-train_size = 30
-dev_size = 100
+
+def format_values(values: np.ndarray) -> pd.Series:
+    """
+    Write an (n, 4) array of goodness scores the way the corpus files store them, e.g. "[3 1 4 2]"
+    """
+    formatted = "[" + pd.Series(values[:, 0]).astype(str)
+    for column in range(1, values.shape[1]):
+        formatted = formatted + " " + pd.Series(values[:, column]).astype(str)
+    return formatted + "]"
+
+
+def assign_splits(df: pd.DataFrame, split_fractions: dict, fixed_splits: dict = None,
+                  statement_keys: np.ndarray = None) -> np.ndarray:
+    """
+    Assign each statement to a split by hashing it, so a statement always ends up in the same split (whatever chunk it
+    is in) and the splits get the given fractions of the corpus. Statements whose row is in fixed_splits (a row index
+    to split mapping) go to that split instead. The statements' keys (see seeding.keys_to_ints) can be passed in if
+    they've already been computed.
+    """
+    if statement_keys is None:
+        statement_keys = keys_to_ints(df["Statement"])
+    thresholds = np.cumsum(list(split_fractions.values()))
+    draws = hash_uniforms(statement_keys, 1, "corpus", "split")[:, 0]
+    splits = np.array(list(split_fractions), dtype=object)[
+        np.minimum(np.searchsorted(thresholds, draws, side="right"), len(thresholds) - 1)]
+    if fixed_splits is not None:
+        fixed = df.index.map(fixed_splits).to_numpy(dtype=object)
+        splits = np.where(pd.isna(fixed), splits, fixed)
+    return splits
+
+
+def preprocess_corpus(corpus_path: str, output_prefix: str, chunk_size: int = 10000, split_fractions: dict = None,
+                      fixed_splits: dict = None) -> dict:
+    """
+    Make the prompts and values for every included statement of a corpus, reading it chunk by chunk, and append each
+    chunk's statements to the file of their split ({output_prefix}-{split}.csv). Each statement's options are shuffled
+    by hashing the statement, so the prompts don't depend on the chunk size either.
+    Returns the number of statements written to each split.
+    """
+    split_paths = {split: here(f"{output_prefix}-{split}.csv") for split in split_fractions}
+    counts = {split: 0 for split in split_fractions}
+    for i, df_chunk in enumerate(pd.read_csv(here(corpus_path), chunksize=chunk_size)):
+        # exclude the rows we want to exclude
+        if "Include" in df_chunk.columns:
+            df_chunk = df_chunk[df_chunk["Include"] == 1].copy()
+
+        # generate the prompts and values (the statements are only hashed once, for both the options and the split)
+        statement_keys = keys_to_ints(df_chunk["Statement"])
+        orders = np.argsort(hash_uniforms(statement_keys, 4, "corpus", "options"), axis=1)
+        prompts, values = make_katz_prompts(df_chunk, orders)
+        df_chunk["prompt"] = prompts
+        df_chunk["values"] = format_values(values).to_numpy()
+
+        # append the chunk to the split files (starting them over with the first chunk)
+        splits = assign_splits(df_chunk, split_fractions, fixed_splits, statement_keys=statement_keys)
+        for split, path in split_paths.items():
+            df_split = df_chunk[splits == split]
+            df_split.to_csv(path, mode="w" if i == 0 else "a", header=i == 0, index=False)
+            counts[split] += len(df_split)
+    return counts
+
+
+# the corpus to preprocess, and where to save the splits (as {output_prefix}-{split}.csv)
+corpus_path = "data/katz-corpus/katz-corpus-full.csv"
+output_prefix = "data/katz-corpus/katz-corpus"
+# how many rows to read at a time
+chunk_size = 10000
+# the fraction of the statements that go into each split (about the sizes of the Katz splits)
+split_fractions = {"train": 0.1, "dev": 0.35, "test": 0.55}
+# keep the Katz corpus's original (randomly sampled) splits rather than hashing its statements into new ones (only
+# for katz-corpus-full.csv, since the splits are row numbers of that file)
+use_katz_splits = True
 
 # train, dev, and test indices (sampled randomly)
 train_indices = [83, 138, 35, 55, 239, 262, 112, 81, 273, 245, 72, 135, 143, 0, 268, 175, 267, 39, 98, 305, 265, 110,
@@ -24,27 +98,11 @@ test_indices = [31, 6, 61, 26, 186, 254, 24, 90, 230, 244, 5, 263, 248, 300, 18,
                 33, 206, 209, 286, 120, 30, 184, 315, 74, 141, 193, 40, 32, 180, 29, 95, 304, 169, 224, 179, 183, 14,
                 12, 240, 281, 194, 269, 278, 232, 136, 71, 303, 140, 62, 307, 137, 285, 283, 291, 160, 158, 292, 20,
                 258, 260, 34, 299, 308, 11, 88, 237, 94, 73, 296, 25, 161, 207, 60, 148, 241]
+katz_splits = {**{index: "train" for index in train_indices}, **{index: "dev" for index in dev_indices},
+               **{index: "test" for index in test_indices}}
 
 if __name__ == "__main__":
 
-    # read in the data
-    df_katz = pd.read_csv(here("data/katz-corpus/katz-corpus-full.csv"))
-
-    # exclude the rows we want to exclude
-    df_katz = df_katz[df_katz["Include"] == 1]
-
-    # generate the prompts and values
-    prompts_with_values = df_katz.apply(lambda x: make_katz_prompt(x), axis=1)
-    prompts = [x[0] for x in prompts_with_values]
-    values = [x[1] for x in prompts_with_values]
-    df_katz["prompt"], df_katz["values"] = prompts, values
-
-    # create train, dev, and test data
-    df_katz_train = df_katz.loc[train_indices]
-    df_katz_dev = df_katz.loc[dev_indices]
-    df_katz_test = df_katz.loc[test_indices]
-
-    # save the data
-    df_katz_train.to_csv(here("data/katz-corpus/katz-corpus-train.csv"), index=False)
-    df_katz_dev.to_csv(here("data/katz-corpus/katz-corpus-dev.csv"), index=False)
-    df_katz_test.to_csv(here("data/katz-corpus/katz-corpus-test.csv"), index=False)
+    counts = preprocess_corpus(corpus_path, output_prefix, chunk_size=chunk_size, split_fractions=split_fractions,
+                               fixed_splits=katz_splits if use_katz_splits else None)
+    print(f"statements per split: {counts}")
@@ -9,42 +9,169 @@ from pyprojroot import here
 answer_markers = ["a)", "b)", "c)", "d)"]
 rationale_indices = [1, 5, 6, 9, 11, 13, 17, 21, 22, 25, 28]
 
-# set up the rationale dataframe
-df_rationales = pd.read_csv(here("data/prompts/katz/train-rationales.csv"))
-df_rationales = df_rationales.iloc[rationale_indices]
-df_inverse = pd.read_csv(here("data/katz-corpus/inverse-katz-corpus-train.csv"))
+
+class PromptCorpora:
+    """
+    The example rows that few-shot prompts are built from. Each corpus is read from disk the first time it is needed
+    (unless a dataframe is passed in directly, e.g. as a fixture), and each kind of rendered shot is memoized.
+    """
+
+    def __init__(
+            self,
+            rationales: pd.DataFrame = None,
+            inverse: pd.DataFrame = None,
+            rationales_path: str = "data/prompts/katz/train-rationales.csv",
+            inverse_path: str = "data/katz-corpus/inverse-katz-corpus-train.csv",
+        ):
+        self._rationales = rationales
+        self._inverse = inverse
+        self.rationales_path = rationales_path
+        self.inverse_path = inverse_path
+        self._shots = {}
+
+    @property
+    def rationales(self) -> pd.DataFrame:
+        if self._rationales is None:
+            self._rationales = pd.read_csv(here(self.rationales_path)).iloc[rationale_indices]
+        return self._rationales
+
+    @property
+    def inverse(self) -> pd.DataFrame:
+        if self._inverse is None:
+            self._inverse = pd.read_csv(here(self.inverse_path))
+        return self._inverse
+
+    def preload(self):
+        """
+        Read both corpora now. Call this in the parent process before starting a pool of forked workers so that they
+        all share one copy instead of each reading the CSVs.
+        """
+        self._rationales = self.rationales
+        self._inverse = self.inverse
+        return self
+
+    def _memoize(self, key, render):
+        if key not in self._shots:
+            self._shots[key] = render()
+        return self._shots[key]
+
+    def rationale_shots(self, rationale_type: str, step_by_step: bool) -> np.ndarray:
+        """
+        Render each rationale example into its final few-shot block once, so prompts can be assembled with a join
+        """
+        def render():
+            shots = []
+            for index, row in self.rationales.iterrows():
+                shot = row["prompt"] + "\n"
+                if step_by_step:  # in case we want "let's think step by step."
+                    shot += "Let's think step by step.\n"
+                # add the relevant rationale and denote the end of the example with ###
+                shot += row[f"{rationale_type}_rationale"] + "\n###\n"
+                shots.append(shot)
+            return np.array(shots, dtype=object)
+        return self._memoize(("rationale", rationale_type, step_by_step), render)
+
+    def k_shot_shots(self, options_only: bool, inverse: bool) -> np.ndarray:
+        """
+        Render each k-shot example (question and answer) into its final few-shot block once
+        """
+        def render():
+            shots = []
+            for index, row in (self.inverse if inverse else self.rationales).iterrows():
+                # write the prompt, removing the first line if we are in the options only baseline
+                shot = "\n".join(row["prompt"].split("\n")[2:]) if options_only else row["prompt"]
+                # write the answer
+                if inverse:
+                    answer = answer_markers[int(row["index"]) - 1] + " " + row["true_answer"]
+                else:
+                    answer = answer_markers[np.argmax(np.fromstring(row['values'][1:-1], dtype=int, sep=' '))] +\
+                             " " + row["Good (4)"]
+                shot += f"\nThe answer is {answer}\n###\n"
+                shots.append(shot)
+            return np.array(shots, dtype=object)
+        return self._memoize(("k_shot", options_only, inverse), render)
+
+    def free_response_shots(self) -> np.ndarray:
+        """
+        Render each free response example (metaphor and paraphrase) into its final few-shot block once
+        """
+        def render():
+            return np.array([f'"{metaphor}"\n{paraphrase}\n###\n' for metaphor, paraphrase
+                             in zip(self.rationales["Statement"], self.rationales["Good (4)"])], dtype=object)
+        return self._memoize(("free_response",), render)
+
+
+# the corpora used when none are passed in explicitly
+default_corpora = PromptCorpora()
+
+
+def get_corpora(corpora: PromptCorpora = None) -> PromptCorpora:
+    """
+    Get the corpora to build prompts from: the ones passed in, or the module-wide default
+    """
+    return default_corpora if corpora is None else corpora
+
+
+def set_corpora(corpora: PromptCorpora):
+    """
+    Swap out the module-wide default corpora (e.g. for an in-memory fixture, or as a pool worker initializer)
+    """
+    global default_corpora
+    default_corpora = corpora
+
+
+def __getattr__(name):
+    # the dataframes used to be module-level globals, so keep them available (loaded on first access)
+    if name == "df_rationales":
+        return default_corpora.rationales
+    if name == "df_inverse":
+        return default_corpora.inverse
+    raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
+
+
+def sample_shots(shots: np.ndarray, k: int, shot_seed: int = None, rng: np.random.Generator = None) -> list:
+    """
+    Draw k distinct shots in random order from rng (see seeding.py). Without one, this draws from the global RNG
+    exactly like DataFrame.sample(n=k) does, so the prompts match the ones built from the dataframes directly.
+    If a shot seed is given, the same shots are drawn in the same order every time, so every prompt built with that
+    seed starts with the same prefix.
+    """
+    if shot_seed is not None:
+        rng = np.random.default_rng(shot_seed)
+    elif rng is None:
+        rng = np.random
+    return list(shots[rng.choice(len(shots), size=k, replace=False)])
+
+
+def join_parts(parts: list, return_parts: bool = False):
+    """
+    Join the parts of a prompt (header, shots, and the test item) into the prompt, or return the parts themselves.
+    Every part but the last ends in a newline and the next part starts with a non-space character, so the parts
+    never share a GPT-2 token and the prompt's token count is the sum of the parts' token counts.
+    """
+    if return_parts:
+        return [part for part in parts if part != ""]
+    return "".join(parts)
+
 
 def make_rationale_prompt(
         main_question: str,
         task_description: str,
         rationale_type: str = "QUD",
         k: int = 10,
-        step_by_step: bool = True
+        step_by_step: bool = True,
+        corpora: PromptCorpora = None,
+        shot_seed: int = None,
+        rng: np.random.Generator = None,
+        return_parts: bool = False,
     ) -> str:
     """
     Make a prompt that encourages the model to generate a rationale alongside the answer
     """
-    # initialize the prompt with the task description
-    prompt = f"{task_description}\n###\n"
-
-    # add each of the k examples
-    for index, row in df_rationales.sample(n=k).iterrows():
-        prompt += row["prompt"] + "\n"
-        if step_by_step:  # in case we want "let's think step by step."
-            prompt += "Let's think step by step.\n"
-
-        # add the relevant rationale
-        prompt += row[f"{rationale_type}_rationale"] + "\n"
-        # denote the end of the exmaple with ###
-        prompt += "###\n"
-
-    # add the main question
-    prompt += main_question + "\n"
-    # add "let's think step by step" if necessary
-    if step_by_step:
-        prompt += "Let's think step by step.\n"
-
-    return prompt
+    # the task description, k examples, then the main question ("let's think step by step" if necessary)
+    shots = sample_shots(get_corpora(corpora).rationale_shots(rationale_type, step_by_step), k, shot_seed, rng)
+    ending = "Let's think step by step.\n" if step_by_step else ""
+    return join_parts([f"{task_description}\n###\n", *shots, main_question + "\n" + ending], return_parts)
 
 
 def make_k_shot_prompt(
@@ -53,51 +180,29 @@ def make_k_shot_prompt(
         k: int = 10,
         options_only: bool = False,
         inverse: bool = False,
+        corpora: PromptCorpora = None,
+        shot_seed: int = None,
+        rng: np.random.Generator = None,
+        return_parts: bool = False,
     ) -> str:
     """
     Make a k-shot prompt using the Katz corpus
     """
-    # initialize with the task description
-    full_prompt = ""
-    if not options_only:
-        full_prompt += f"{task_description}\n###\n"
-
-    # shuffle the rows and compile the prompts
-    if inverse:
-        df_shots = df_inverse.sample(n=k)
-    else:
-        df_shots = df_rationales.sample(n=k)
-    for index, row in df_shots.iterrows():
-        # write the prompt
-        if options_only:
-            # remove the first line if we are in the options only baseline
-            full_prompt += "\n".join(row["prompt"].split("\n")[2:])
-        else:
-            full_prompt += row["prompt"]
-        # write the answer
-        if inverse:
-            answer = answer_markers[int(row["index"]) - 1] + " " + row["true_answer"]
-        else:
-            answer = answer_markers[np.argmax(np.fromstring(row['values'][1:-1], dtype=int, sep=' '))] +\
-                     " " + row["Good (4)"]
-        full_prompt += f"\nThe answer is {answer}"
-        full_prompt += "\n###\n"
-
-    # add the test prompt
-    if options_only:
-        full_prompt += "\n".join(test_prompt.split("\n")[2:])
-    else:
-        full_prompt += test_prompt
+    # initialize with the task description, unless we are in the options only baseline
+    header = "" if options_only else f"{task_description}\n###\n"
+    shots = sample_shots(get_corpora(corpora).k_shot_shots(options_only, inverse), k, shot_seed, rng)
 
-    # add "the answer is"
-    full_prompt += "\nThe answer is "
+    # add the test prompt and "the answer is"
+    if options_only:
+        test_prompt = "\n".join(test_prompt.split("\n")[2:])
 
-    return full_prompt
+    return join_parts([header, *shots, test_prompt + "\nThe answer is "], return_parts)
 
 
-def make_katz_prompt(row) -> str:
+def make_katz_prompt(row, rng: np.random.Generator = None) -> str:
     """
-    This function turns a row of the Katz dataset into a prompt for GPT-3
+    This function turns a row of the Katz dataset into a prompt for GPT-3, shuffling the options with rng (or the
+    global RNG if there isn't one)
     """
     # extract the metaphorical statement and all paraphrases
     statement = row["Statement"]
@@ -108,7 +213,7 @@ def make_katz_prompt(row) -> str:
 
     # shuffle the responses
     responses = [bad, semantic, less_good, good]
-    response_indices = np.random.choice(range(len(responses)), size=4, replace=False)
+    response_indices = (np.random if rng is None else rng).choice(range(len(responses)), size=4, replace=False)
 
     # create a string with the statement and all the options
     prompt = f'"{statement}"\n\n'
@@ -119,9 +224,24 @@ def make_katz_prompt(row) -> str:
     return prompt, response_indices + 1
 
 
-def make_inverse_katz_prompt(row) -> str:
+def make_katz_prompts(df: pd.DataFrame, orders: np.ndarray) -> tuple:
     """
-    This function turns a row of the inverse Katz dataset into a prompt for GPT-3
+    Turn many rows of the Katz dataset into prompts at once (like make_katz_prompt), showing each row's options in the
+    given order: an (n, 4) array of indices into the bad, semantic, less good and good paraphrases.
+    Returns the prompts and the goodness scores of the options in the order they are shown.
+    """
+    responses = df[["Bad (1)", "Semantic (2) - category/desription", "Less good (3)", "Good (4)"]].to_numpy(dtype=object)
+    shown = np.take_along_axis(responses, orders, axis=1)
+    prompts = '"' + df["Statement"] + '"\n\n'
+    for marker_idx, marker in enumerate(answer_markers):
+        prompts = prompts + marker + " " + shown[:, marker_idx] + "\n"
+    return prompts, orders + 1
+
+
+def make_inverse_katz_prompt(row, rng: np.random.Generator = None) -> str:
+    """
+    This function turns a row of the inverse Katz dataset into a prompt for GPT-3, shuffling the options with rng (or
+    the global RNG if there isn't one)
     """
     # extract the metaphorical statement and all paraphrases
     statement = row["statement"]
@@ -130,7 +250,7 @@ def make_inverse_katz_prompt(row) -> str:
 
     # shuffle the responses
     responses = [true_answer] + distractors
-    response_indices = np.random.choice(range(len(responses)), size=4, replace=False)
+    response_indices = (np.random if rng is None else rng).choice(range(len(responses)), size=4, replace=False)
 
     # create a string with the statement and all the options
     prompt = f'"{statement}"\n\n'
@@ -145,21 +265,15 @@ def make_k_shot_free_response_prompt(
         test_row: str,
         task_description: str,
         k: int = 10,
+        corpora: PromptCorpora = None,
+        shot_seed: int = None,
+        rng: np.random.Generator = None,
+        return_parts: bool = False,
     ) -> str:
     """
     This function creates a free response prompt out of a row of the Katz corpus
     :param row:
     :return:
     """
-    # initialize with the task description
-    full_prompt = task_description + "\n###\n"
-
-    df_rows = df_rationales.sample(n=k)
-    for index, row in df_rows.iterrows():
-        metaphor = row["Statement"]
-        paraphrase = row["Good (4)"]
-        full_prompt += f'"{metaphor}"\n{paraphrase}\n###\n'
-
-    full_prompt += f'"{test_row["Statement"]}"\n'
-
-    return full_prompt
+    shots = sample_shots(get_corpora(corpora).free_response_shots(), k, shot_seed, rng)
+    return join_parts([task_description + "\n###\n", *shots, f'"{test_row["Statement"]}"\n'], return_parts)
@@ -0,0 +1,307 @@
+"""
+This file contains a concurrent engine for sending many completion requests at once while staying within rate limits
+"""
+import math
+import random
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import openai
+from instrumentation import get_metrics, submit_in_context
+
+# HTTP status codes that are worth retrying
+retryable_statuses = [429, 500, 502, 503, 504]
+# openai.error.Timeout only exists in newer versions of the openai package than the one pinned in environment.yml
+retryable_errors = tuple(error for error in (openai.error.RateLimitError, openai.error.ServiceUnavailableError,
+                                             openai.error.APIConnectionError, getattr(openai.error, "Timeout", None))
+                         if error is not None)
+
+
+class RateLimiter:
+    """
+    A token-bucket rate limiter that enforces both a requests-per-minute and a tokens-per-minute budget.
+    It is thread-safe, so a single limiter can be shared by all the workers (and all the conditions) of a run.
+    """
+
+    def __init__(self, requests_per_minute: float = 60, tokens_per_minute: float = 250000):
+        self.requests_per_minute = requests_per_minute
+        self.tokens_per_minute = tokens_per_minute
+        # both buckets start full
+        self.request_budget = float(requests_per_minute)
+        self.token_budget = float(tokens_per_minute)
+        self.last_refill = time.monotonic()
+        self.lock = threading.Lock()
+
+    def _refill(self):
+        """
+        Add back the budget that has accumulated since the last refill
+        """
+        now = time.monotonic()
+        elapsed = now - self.last_refill
+        self.last_refill = now
+        self.request_budget = min(self.requests_per_minute,
+                                  self.request_budget + elapsed * self.requests_per_minute / 60)
+        self.token_budget = min(self.tokens_per_minute,
+                                self.token_budget + elapsed * self.tokens_per_minute / 60)
+
+    def acquire(self, n_tokens: int = 0):
+        """
+        Block until there is budget for one request that uses n_tokens tokens, then spend it
+        """
+        # a single request can never need more than a full minute of tokens
+        n_tokens = min(n_tokens, self.tokens_per_minute)
+        while True:
+            with self.lock:
+                self._refill()
+                if self.request_budget >= 1 and self.token_budget >= n_tokens:
+                    self.request_budget -= 1
+                    self.token_budget -= n_tokens
+                    return
+                # figure out how long until both buckets have enough budget
+                request_wait = max(0, 1 - self.request_budget) * 60 / self.requests_per_minute
+                token_wait = max(0, n_tokens - self.token_budget) * 60 / self.tokens_per_minute
+                wait = max(request_wait, token_wait)
+            time.sleep(wait)
+
+
+def is_retryable(error: Exception) -> bool:
+    """
+    Decide whether an error from the API is transient (rate limits, server errors, dropped connections)
+    """
+    if isinstance(error, retryable_errors):
+        return True
+    return getattr(error, "http_status", None) in retryable_statuses
+
+
+def call_with_retries(fn, max_retries: int = 6, base_delay: float = 1.0, max_delay: float = 60.0):
+    """
+    Call fn, retrying transient errors with exponential backoff and jitter
+    """
+    for attempt in range(max_retries + 1):
+        try:
+            return fn()
+        except Exception as e:
+            if attempt == max_retries or not is_retryable(e):
+                raise
+            get_metrics().count("retries")
+            delay = min(max_delay, base_delay * 2 ** attempt)
+            time.sleep(delay * random.uniform(0.5, 1.5))
+
+
+def estimate_tokens(prompt: str) -> int:
+    """
+    Roughly estimate the number of tokens in a prompt (about 4 characters per token for English text)
+    """
+    return len(prompt) // 4 + 1
+
+
+def count_usage(response):
+    """
+    Add the tokens an API response says it used to the metrics
+    """
+    usage = response.get("usage", {})
+    get_metrics().count("prompt_tokens", usage.get("prompt_tokens", 0))
+    get_metrics().count("completion_tokens", usage.get("completion_tokens", 0))
+
+
+def make_openai_completion(engine: str, temperature: float, max_tokens: int = 256, n: int = 1):
+    """
+    Make a function that sends a batch of prompts to the OpenAI completions endpoint in a single request.
+    It returns one response per prompt: the text if n is 1, otherwise a list of n sampled texts.
+    """
+    def complete(prompts: list) -> list:
+        response = openai.Completion.create(
+            engine=engine,
+            prompt=prompts,
+            max_tokens=max_tokens,
+            n=n,
+            temperature=temperature,
+            frequency_penalty=0,
+            presence_penalty=0
+        )
+        count_usage(response)
+        return demultiplex_choices(response["choices"], len(prompts), n)
+
+    return complete
+
+
+def demultiplex_choices(choices: list, n_prompts: int, n: int = 1) -> list:
+    """
+    Sort the choices of a batched request back into their prompts. The choice for sample j of prompt i has index
+    i * n + j, but choices are not guaranteed to come back in order.
+    """
+    texts = [[None] * n for _ in range(n_prompts)]
+    for choice in choices:
+        prompt_index, sample_index = divmod(choice["index"], n)
+        texts[prompt_index][sample_index] = choice["text"]
+    if n == 1:
+        return [sample_texts[0] for sample_texts in texts]
+    return texts
+
+
+def order_choices(choices: list, n_prompts: int) -> list:
+    """
+    Sort the choices of a batched request with one choice per prompt back into prompt order
+    """
+    ordered = [None] * n_prompts
+    for choice in choices:
+        ordered[choice["index"]] = choice
+    return ordered
+
+
+def make_openai_next_token_scorer(engine: str, labels: list, top_logprobs: int = 5):
+    """
+    Make a function that asks for the distribution over the token after each prompt of a batch, without generating any
+    text. It returns, for each prompt, the log-probability of each label as the next token (adding up variants like
+    " a" and "a)"), with None for labels that aren't among the top_logprobs most likely tokens.
+    """
+    def score(prompts: list) -> list:
+        response = openai.Completion.create(
+            engine=engine,
+            prompt=prompts,
+            max_tokens=1,
+            temperature=0,
+            logprobs=top_logprobs,
+        )
+        count_usage(response)
+        label_logprobs = []
+        for choice in order_choices(response["choices"], len(prompts)):
+            probabilities = dict.fromkeys(labels, 0.0)
+            for token, logprob in choice["logprobs"]["top_logprobs"][0].items():
+                label = token.strip().lower().rstrip(")")
+                if label in probabilities:
+                    probabilities[label] += math.exp(logprob)
+            label_logprobs.append([math.log(probabilities[label]) if probabilities[label] > 0 else None
+                                   for label in labels])
+        return label_logprobs
+
+    return score
+
+
+def make_openai_echo_scorer(engine: str, continuation_length: int):
+    """
+    Make a function that scores each prompt of a batch without generating anything, by echoing it back with the
+    log-probability of each of its tokens. It returns, for each prompt, the total log-probability of the tokens that
+    make up its last continuation_length characters (the continuation being scored, e.g. an option letter).
+    """
+    def score(prompts: list) -> list:
+        response = openai.Completion.create(
+            engine=engine,
+            prompt=prompts,
+            max_tokens=0,
+            echo=True,
+            logprobs=0,
+        )
+        count_usage(response)
+        totals = []
+        for prompt, choice in zip(prompts, order_choices(response["choices"], len(prompts))):
+            logprobs = choice["logprobs"]
+            boundary = len(prompt) - continuation_length
+            # a token that straddles the boundary (like " a" after "The answer is") belongs to the continuation
+            totals.append(sum(logprob for token, offset, logprob
+                              in zip(logprobs["tokens"], logprobs["text_offset"], logprobs["token_logprobs"])
+                              if offset + len(token) > boundary))
+        return totals
+
+    return score
+
+
+def make_batches(prompts: list, token_budget: int = None, max_batch_size: int = 1,
+                 tokens_per_response: int = 256) -> list:
+    """
+    Greedily pack consecutive prompts into batches of at most max_batch_size prompts, where each batch's prompt and
+    response tokens fit in token_budget. Returns lists of prompt indices.
+    """
+    batches = []
+    current_batch, current_tokens = [], 0
+    for i, prompt in enumerate(prompts):
+        n_tokens = estimate_tokens(prompt) + tokens_per_response
+        batch_full = len(current_batch) >= max_batch_size or \
+            (token_budget is not None and current_tokens + n_tokens > token_budget)
+        if len(current_batch) > 0 and batch_full:
+            batches.append(current_batch)
+            current_batch, current_tokens = [], 0
+        current_batch.append(i)
+        current_tokens += n_tokens
+    if len(current_batch) > 0:
+        batches.append(current_batch)
+    return batches
+
+
+def run_queries(
+        prompts: list,
+        complete,
+        n_workers: int = 8,
+        rate_limiter: RateLimiter = None,
+        max_tokens: int = 256,
+        max_retries: int = 6,
+        cache=None,
+        engine: str = None,
+        sampling_params: dict = None,
+        on_response=None,
+        max_batch_size: int = 1,
+        batch_token_budget: int = None,
+        n: int = 1,
+    ) -> list:
+    """
+    Send every prompt through complete, which takes a batch of prompts and returns one response per prompt.
+    Prompts are packed into batches of up to max_batch_size (and batch_token_budget tokens), and up to n_workers
+    batches are kept in flight at once.
+    If a cache is given, prompts with a cached response (for this engine and these sampling parameters) are not sent.
+    If on_response is given, it is called with (index, response) as soon as each response arrives.
+    The responses are returned in the same order as the prompts.
+    """
+    if rate_limiter is None:
+        rate_limiter = RateLimiter()
+    if sampling_params is None:
+        sampling_params = {}
+
+    responses = [None] * len(prompts)
+
+    # answer what we can from the cache before spending any rate limit budget
+    uncached = []
+    for i, prompt in enumerate(prompts):
+        cached_response = cache.get(engine, prompt, **sampling_params) if cache is not None else None
+        if cached_response is None:
+            uncached.append(i)
+        else:
+            responses[i] = cached_response
+            if on_response is not None:
+                on_response(i, cached_response)
+    if cache is not None:
+        get_metrics().count("cache_hits", len(prompts) - len(uncached))
+        get_metrics().count("cache_misses", len(uncached))
+
+    def query(batch):
+        batch_prompts = [prompts[i] for i in batch]
+        batch_tokens = sum(estimate_tokens(prompt) + max_tokens * n for prompt in batch_prompts)
+
+        def attempt():
+            # every attempt (including retries) counts against the rate limits
+            rate_limiter.acquire(batch_tokens)
+            start = time.perf_counter()
+            attempt_responses = complete(batch_prompts)
+            get_metrics().observe("request_latency", time.perf_counter() - start, batch_size=len(batch_prompts))
+            return attempt_responses
+        batch_responses = call_with_retries(attempt, max_retries=max_retries)
+        get_metrics().count("requests")
+
+        for i, response in zip(batch, batch_responses):
+            responses[i] = response
+            if cache is not None:
+                cache.put(engine, prompts[i], response, **sampling_params)
+            if on_response is not None:
+                on_response(i, response)
+
+    batches = make_batches([prompts[i] for i in uncached], token_budget=batch_token_budget,
+                           max_batch_size=max_batch_size, tokens_per_response=max_tokens * n)
+    batches = [[uncached[j] for j in batch] for batch in batches]
+    with ThreadPoolExecutor(max_workers=n_workers) as executor:
+        # the workers record with the fields of the caller's context (e.g. its condition)
+        futures = [submit_in_context(executor, query, batch) for batch in batches]
+        # wait for the results in order so that errors from the workers are raised here
+        for future in futures:
+            future.result()
+
+    return responses
@@ -1,71 +1,382 @@
 """
 This file takes the processed question, asks GPT-3 about it, then saves the response
 """
+import json
+import math
 import os
+import threading
+import numpy as np
 import pandas as pd
 import openai
 from pyprojroot import here
-from prompt_generation import make_k_shot_prompt, make_rationale_prompt, make_k_shot_free_response_prompt
+from prompt_generation import make_k_shot_prompt, make_rationale_prompt, make_k_shot_free_response_prompt, \
+    answer_markers
+from query_engine import RateLimiter, run_queries
+from backends import Backend, OpenAIBackend, LocalBackend
+from answer_extraction import guess_labels
+from cost_planner import plan_queries, check_budget, format_plan
+from response_cache import ResponseCache
+from response_log import ResponseLog
+from results_catalog import ResultsCatalog
+from token_counting import TokenCounter
+from instrumentation import Metrics, set_metrics, stage, make_metrics_path, format_summary, record_fields
+from seeding import make_rng, make_run_key
 
 # global variables
-openai.api_key = os.environ["OPENAI_API_KEY"]
+openai.api_key = os.environ.get("OPENAI_API_KEY")
 task_type = "standard"
-corpus_name = "inverse-katz" if task_type == "inverse" else "katz"
 prompt_type = "options_only"
 gpt_version = "davinci"
 corpus_set = "test"
 temp = 0.2
 K = 10
+max_tokens = 256
+# the number of samples per prompt (more than 1 for self-consistency runs)
+n_samples = 1
 
-task_description = "State the literal meaning of the sentence in quotation marks." if prompt_type == "free_response" \
-    else "Choose the most appropriate paraphrase of the first sentence."
+# concurrency and rate limits for the API
+n_workers = 8
+requests_per_minute = 60
+tokens_per_minute = 250000
+
+# how many prompts to pack into a single request, and the most (estimated) prompt and response tokens per request
+max_batch_size = 20
+batch_token_budget = 60000
+
+# the response cache: set offline to True to only use cached responses and never call the API
+use_cache = True
+cache_path = "data/cache/responses.sqlite"
+cache_max_bytes = 1024 ** 3
+offline = False
+
+# estimate the cost of each run before sending anything, and refuse to run if it could cost more than this (None for
+# no limit)
+plan_before_querying = True
+max_budget_dollars = 50.0
+
+# stream each response to a log as it arrives, and skip rows that are already in the log when rerunning
+resume = True
+
+# how to get the model's answers: "generate" text and parse the letter out of it, or, for the prompts that end in
+# "The answer is " (scorable_prompt_types), score the options without generating any text: "next_token" asks for the
+# distribution over the next token, and "echo" scores each option letter appended to the prompt
+scoring_mode = "generate"
+scorable_prompt_types = ["basic", "options_only"]
+# the most likely tokens to ask for in "next_token" mode, and the tokens each scoring mode generates
+top_logprobs = 5
+scoring_max_tokens = {"next_token": 1, "echo": 0}
 
 gpt_version_codes = {
     "curie": "text-curie-001",
     "davinci": "text-davinci-002"
 }
 
-if __name__ == "__main__":
+# models that run locally on the CPU instead of through the API (see local_model.py), and how many prompts to hand
+# the local model at once (it batches prompts of similar lengths together within that)
+local_model_codes = {
+    "gpt2": "gpt2",
+    "gpt2_medium": "gpt2-medium",
+    "gpt_neo_125M": "EleutherAI/gpt-neo-125M",
+}
+local_batch_size = 64
+
+# give every item of a condition the same shots in the same order, drawn with this seed, so that all its prompts share
+# one long prefix (which a local model runs only once, see local_model.PrefixCache). None draws the shots per item.
+fixed_shot_seed = None
+
+# the backend for each model, created the first time the model is used so local models are only loaded once
+backends = {}
+backends_lock = threading.Lock()
+
+
+def get_backend(gpt_version: str) -> Backend:
+    """
+    Get the backend that runs the given model
+    """
+    with backends_lock:
+        if gpt_version not in backends:
+            if gpt_version in gpt_version_codes:
+                backends[gpt_version] = OpenAIBackend(gpt_version_codes[gpt_version])
+            elif gpt_version in local_model_codes:
+                backends[gpt_version] = LocalBackend(local_model_codes[gpt_version])
+            else:
+                raise ValueError(f"Unknown model: {gpt_version}")
+        return backends[gpt_version]
+
+
+def get_task_description(prompt_type: str) -> str:
+    """
+    Get the task description that goes at the top of the prompt
+    """
+    if prompt_type == "free_response":
+        return "State the literal meaning of the sentence in quotation marks."
+    return "Choose the most appropriate paraphrase of the first sentence."
 
+
+def make_prompt(row, prompt_type: str, task_type: str = "standard", k: int = 10, return_parts: bool = False,
+                shot_seed: int = None, rng: np.random.Generator = None) -> str:
+    """
+    Create the prompt of the given type for a row of the corpus (or its parts, for counting tokens), drawing the shots
+    from rng. With a shot seed, every row gets the same shots in the same order.
+    """
+    task_description = get_task_description(prompt_type)
+    if prompt_type == "basic":
+        return make_k_shot_prompt(row["prompt"], task_description, k=k, inverse = task_type == "inverse",
+                                  return_parts=return_parts, shot_seed=shot_seed, rng=rng)
+    elif prompt_type == "non_explanation":
+        return make_rationale_prompt(row["prompt"], task_description, rationale_type=prompt_type,
+                                     k=k, step_by_step=False, return_parts=return_parts, shot_seed=shot_seed, rng=rng)
+    elif prompt_type == "options_only":
+        return make_k_shot_prompt(row["prompt"], task_description, k=k, options_only=True, return_parts=return_parts,
+                                  shot_seed=shot_seed, rng=rng)
+    elif prompt_type == "free_response":
+        return make_k_shot_free_response_prompt(row, task_description, k=k, return_parts=return_parts,
+                                                shot_seed=shot_seed, rng=rng)
+    else:
+        return make_rationale_prompt(row["prompt"], task_description, rationale_type=prompt_type,
+                                     k=k, step_by_step=False, return_parts=return_parts, shot_seed=shot_seed, rng=rng)
+
+
+def get_output_name(task_type: str, corpus_set: str, gpt_version: str, prompt_type: str, K: int, temp: float) -> str:
+    """
+    Get the name (without extension) of the file the responses for a condition are saved to
+    """
+    if task_type == "inverse":
+        return f"model_responses_inverse_set={corpus_set}-gpt={gpt_version}-prompt={prompt_type}-k={K}-temp={temp}"
+    return f"model_responses_set={corpus_set}-gpt={gpt_version}-prompt={prompt_type}-k={K}-temp={temp}"
+
+
+def make_condition_prompts(task_type: str, corpus_set: str, prompt_type: str, K: int, shot_seed: int = None) -> tuple:
+    """
+    Read the corpus for a condition and make the prompt for each item, as lists of parts
+    """
+    corpus_name = "inverse-katz" if task_type == "inverse" else "katz"
     df_corpus = pd.read_csv(here(f"data/katz-corpus/{corpus_name}-corpus-{corpus_set}.csv"))
+    return df_corpus, make_corpus_prompts(df_corpus, task_type, corpus_set, prompt_type, K, shot_seed=shot_seed)
+
+
+def make_corpus_prompts(df_corpus: pd.DataFrame, task_type: str, corpus_set: str, prompt_type: str, K: int,
+                        shot_seed: int = None) -> list:
+    """
+    Make the prompt for each item of a condition's corpus, as lists of parts.
+    Each item's shots are drawn from its own stream (see seeding.py), so an item gets the same prompt every time the
+    condition is run, whichever model it is sent to.
+    """
+    run_key = make_run_key(task_type=task_type, corpus_set=corpus_set, prompt_type=prompt_type, K=K)
+    return [make_prompt(row, prompt_type, task_type=task_type, k=K, return_parts=True, shot_seed=shot_seed,
+                        rng=make_rng(run_key, "shots", get_item_key(row)))
+            for index, row in df_corpus.iterrows()]
+
+
+def get_item_key(row):
+    """
+    Get what identifies an item of the corpus: its statement (the Katz corpus's IDs aren't unique)
+    """
+    return row["Statement"] if "Statement" in row else row["statement"]
+
 
-    # iterate over examples
-    model_choices = []
-    for index, row in df_corpus.iterrows():
-
-        # create the relevant prompt
-        if prompt_type == "basic":
-            prompt = make_k_shot_prompt(row["prompt"], task_description, k=K, inverse = task_type == "inverse")
-        elif prompt_type == "non_explanation":
-            prompt = make_rationale_prompt(row["prompt"], task_description, rationale_type=prompt_type,
-                                           k=K, step_by_step=False)
-        elif prompt_type == "options_only":
-            prompt = make_k_shot_prompt(row["prompt"], task_description, k=K, options_only=True)
-        elif prompt_type == "free_response":
-            prompt = make_k_shot_free_response_prompt(row, task_description, k=K)
+def get_run_prompt_type(prompt_type: str, scoring_mode: str = "generate", shot_seed: int = None) -> str:
+    """
+    Get the prompt type that a condition's outputs are saved under: scored runs and runs with a fixed shot order are
+    saved apart from the others, e.g. as "basic+echo" or "basic+shots0"
+    """
+    if scoring_mode != "generate":
+        prompt_type += f"+{scoring_mode}"
+    if shot_seed is not None:
+        prompt_type += f"+shots{shot_seed}"
+    return prompt_type
+
+
+def make_scoring_parts(prompts_parts: list, scoring_mode: str = "generate") -> list:
+    """
+    Turn the prompts of a condition (as lists of parts) into the lists of queries sent for each of them
+    """
+    if scoring_mode == "generate":
+        return [[parts] for parts in prompts_parts]
+    if scoring_mode == "next_token":
+        # the prompts end in "The answer is ", but the letter's token carries the space (" a")
+        return [[parts[:-1] + [parts[-1].rstrip(" ")]] for parts in prompts_parts]
+    if scoring_mode == "echo":
+        # score each option letter appended to the prompt. the space the prompt ends in goes with the letter, since the
+        # tokenizer encodes them together (" a"), so the parts still split the query on token boundaries
+        return [[parts[:-1] + [parts[-1].rstrip(" "), parts[-1][len(parts[-1].rstrip(" ")):] + marker]
+                 for marker in answer_markers] for parts in prompts_parts]
+    raise ValueError(f"Unknown scoring mode: {scoring_mode}")
+
+
+def plan_condition(task_type: str, corpus_set: str, prompt_type: str, gpt_version: str, temp: float, K: int,
+                   token_counter, n_workers: int = 8, rows: list = None, prompts_parts: list = None,
+                   scoring_mode: str = "generate", shot_seed: int = None) -> dict:
+    """
+    Estimate the cost and time of querying a condition (or just the given rows of it)
+    """
+    if prompts_parts is None:
+        df_corpus, prompts_parts = make_condition_prompts(task_type, corpus_set, prompt_type, K, shot_seed=shot_seed)
+    if rows is not None:
+        prompts_parts = [prompts_parts[i] for i in rows]
+    query_parts = [parts for row_parts in make_scoring_parts(prompts_parts, scoring_mode) for parts in row_parts]
+    return plan_queries(query_parts, token_counter, prompt_type, gpt_version, task_type=task_type,
+                        n_samples=n_samples if scoring_mode == "generate" else 1,
+                        max_tokens=scoring_max_tokens.get(scoring_mode, max_tokens), n_workers=n_workers,
+                        requests_per_minute=requests_per_minute, tokens_per_minute=tokens_per_minute,
+                        max_batch_size=max_batch_size, batch_token_budget=batch_token_budget)
+
+
+def query_condition(
+        task_type: str,
+        corpus_set: str,
+        prompt_type: str,
+        gpt_version: str,
+        temp: float,
+        K: int,
+        rate_limiter: RateLimiter = None,
+        cache: ResponseCache = None,
+        n_workers: int = 8,
+        token_counter=None,
+        max_dollars: float = None,
+        catalog: ResultsCatalog = None,
+        scoring_mode: str = "generate",
+        shot_seed: int = None,
+    ) -> str:
+    """
+    Query the model on every item of the corpus for one condition and save the responses.
+    With a scoring mode other than "generate", the options are scored instead of generating text (see scoring_mode
+    above), and the log-probability of each option is saved along with the most likely one as the response.
+    With a shot seed, every item gets the same shots in the same order (see fixed_shot_seed above).
+    If a token counter is given, the cost is estimated first and the run is refused if it could cost more than
+    max_dollars. If a results catalog is given, the saved responses are recorded in it.
+    Returns the path of the saved responses.
+    """
+    if scoring_mode != "generate" and prompt_type not in scorable_prompt_types:
+        raise ValueError(f"Can't score {prompt_type} prompts, only {scorable_prompt_types}")
+
+    run_prompt_type = get_run_prompt_type(prompt_type, scoring_mode, shot_seed)
+    output_name = get_output_name(task_type, corpus_set, gpt_version, run_prompt_type, K, temp)
+
+    # every measurement of this condition (including the query engine's, from its worker threads) says which it is,
+    # since a grid run queries several conditions at once into the same metrics
+    with record_fields(task_type=task_type, corpus_set=corpus_set, gpt_version=gpt_version, prompt_type=run_prompt_type,
+                       K=K, temp=temp, output_name=output_name):
+        # create the prompt for each example, and the queries to send for it
+        with stage("make_prompts"):
+            df_corpus, prompts_parts = make_condition_prompts(task_type, corpus_set, prompt_type, K,
+                                                              shot_seed=shot_seed)
+            prompts = ["".join(parts) for parts in prompts_parts]
+            row_queries = [["".join(parts) for parts in row_parts]
+                           for row_parts in make_scoring_parts(prompts_parts, scoring_mode)]
+
+        # pick up the responses from an earlier, interrupted run
+        response_log = ResponseLog(here(f"data/model-outputs/partial/{output_name}.jsonl"))
+        if not resume:
+            response_log.remove()
+        completed = response_log.completed()
+        pending_rows = [i for i in range(len(prompts)) if i not in completed]
+        print(f"{output_name}: {len(completed)} rows already completed, {len(pending_rows)} to query")
+
+        # estimate what the remaining rows will cost before sending anything
+        if token_counter is not None:
+            with stage("plan"):
+                plan = plan_condition(task_type, corpus_set, prompt_type, gpt_version, temp, K, token_counter,
+                                      n_workers=n_workers, rows=pending_rows, prompts_parts=prompts_parts,
+                                      scoring_mode=scoring_mode, shot_seed=shot_seed)
+            print(f"{output_name}: {format_plan(plan)}")
+            check_budget(plan, max_dollars)
+
+        # every query of the pending rows, and the row each one belongs to
+        queries = [(row, query) for row in pending_rows for query in row_queries[row]]
+        row_responses = {}
+        log_lock = threading.Lock()
+
+        def log_response(query_index, response):
+            # a row is logged once all of its queries are in
+            row = queries[query_index][0]
+            with log_lock:
+                row_responses.setdefault(row, []).append((query_index, response))
+                if len(row_responses[row]) < len(row_queries[row]):
+                    return
+                responses = [response for query_index, response in sorted(row_responses[row])]
+            if scoring_mode == "generate":
+                response_log.write(row, prompt=prompts[row], model_response=responses[0])
+            elif scoring_mode == "next_token":
+                response_log.write(row, prompt=prompts[row], option_logprobs=responses[0])
+            else:
+                response_log.write(row, prompt=prompts[row], option_logprobs=responses)
+
+        # get the responses from the model (or the cache), keeping several requests in flight at once
+        backend = get_backend(gpt_version)
+        query_max_tokens = scoring_max_tokens.get(scoring_mode, max_tokens)
+        query_n = n_samples if scoring_mode == "generate" else 1
+        if scoring_mode == "generate":
+            complete = backend.make_completion(temperature=temp, max_tokens=max_tokens, n=n_samples)
+            sampling_params = {"temperature": temp, "max_tokens": max_tokens, "n": n_samples}
+        elif scoring_mode == "next_token":
+            complete = backend.make_next_token_scorer(guess_labels, top_logprobs=top_logprobs)
+            sampling_params = {"scoring_mode": scoring_mode, "top_logprobs": top_logprobs}
         else:
-            prompt = make_rationale_prompt(row["prompt"], task_description, rationale_type=prompt_type,
-                                           k=K, step_by_step=False)
-
-        print(prompt)
-
-        # get the response from GPT-3
-        response = openai.Completion.create(
-             engine=gpt_version_codes[gpt_version],
-             prompt=prompt,
-             max_tokens=256,
-             n=1,
-             temperature=temp,
-             frequency_penalty=0,
-             presence_penalty=0
-        )
-        # add the model's response to model_choices
-        choices = response["choices"]
-        model_choices.append(choices[0]["text"])
-
-    # save the model choices along with the corpus
-    df_corpus["model_response"] = model_choices
-    if task_type == "inverse":
-        df_corpus.to_csv(here(f"data/model-outputs/model_responses_inverse_set={corpus_set}-gpt={gpt_version}-prompt={prompt_type}-k={K}-temp={temp}.csv"))
-    else:
-        df_corpus.to_csv(here(f"data/model-outputs/model_responses_set={corpus_set}-gpt={gpt_version}-prompt={prompt_type}-k={K}-temp={temp}.csv"))
+            complete = backend.make_echo_scorer(continuation_length=len(answer_markers[0]))
+            sampling_params = {"scoring_mode": scoring_mode}
+        if backend.rate_limited:
+            if rate_limiter is None:
+                rate_limiter = RateLimiter(requests_per_minute=requests_per_minute, tokens_per_minute=tokens_per_minute)
+            batch_size, token_budget = max_batch_size, batch_token_budget
+        else:
+            # a local model has no rate limits, and batches as much as it can
+            rate_limiter = RateLimiter(requests_per_minute=math.inf, tokens_per_minute=math.inf)
+            batch_size, token_budget = local_batch_size, None
+        with stage("query", n_queries=len(queries)):
+            run_queries([query for row, query in queries], complete, n_workers=n_workers, rate_limiter=rate_limiter,
+                        max_tokens=query_max_tokens, cache=cache, engine=backend.name, sampling_params=sampling_params,
+                        on_response=log_response, max_batch_size=batch_size, batch_token_budget=token_budget, n=query_n)
+
+        # the log now has every row, from this run and any earlier ones
+        with stage("save"):
+            records = response_log.completed()
+            missing_rows = [i for i in range(len(prompts)) if i not in records]
+            if len(missing_rows) > 0:
+                # keep the log, so that running the condition again only queries the missing rows
+                raise RuntimeError(f"{output_name}: {len(missing_rows)} rows have no logged response, "
+                                   f"e.g. row {missing_rows[0]}; run again with resume to query them")
+
+            # save the model choices along with the corpus, with one row per sample if there are several
+            if scoring_mode == "generate":
+                df_corpus["model_response"] = [records[i]["model_response"] for i in range(len(prompts))]
+            else:
+                option_logprobs = [records[i]["option_logprobs"] for i in range(len(prompts))]
+                df_corpus["option_logprobs"] = [json.dumps(logprobs) for logprobs in option_logprobs]
+                # the most likely option stands in for the response, so the responses are parsed like generated ones
+                df_corpus["model_response"] = [get_most_likely_option(logprobs) for logprobs in option_logprobs]
+            if scoring_mode == "generate" and n_samples > 1:
+                df_corpus["sample"] = [list(range(n_samples))] * len(df_corpus)
+                df_corpus = df_corpus.explode(["model_response", "sample"])
+            output_path = here(f"data/model-outputs/{output_name}.csv")
+            df_corpus.to_csv(output_path)
+            response_log.remove()
+        if catalog is not None:
+            catalog.record(task_type, corpus_set, gpt_version, run_prompt_type, K, temp, stage="raw",
+                           path=output_path, n_rows=len(df_corpus))
+
+        return output_path
+
+
+def get_most_likely_option(logprobs: list) -> str:
+    """
+    Get the marker (e.g. "b)") of the option with the highest log-probability, or None if none of them have one
+    """
+    scored = [(logprob, marker) for logprob, marker in zip(logprobs, answer_markers) if logprob is not None]
+    return max(scored)[1] if len(scored) > 0 else None
+
+
+if __name__ == "__main__":
+
+    metrics = Metrics(make_metrics_path("query_gpt3"), task_type=task_type, corpus_set=corpus_set,
+                      gpt_version=gpt_version, prompt_type=prompt_type, K=K, temp=temp)
+    set_metrics(metrics)
+    cache = ResponseCache(here(cache_path), max_size_bytes=cache_max_bytes, offline=offline) if use_cache else None
+    token_counter = TokenCounter() if plan_before_querying else None
+    query_condition(task_type, corpus_set, prompt_type, gpt_version, temp, K, cache=cache, n_workers=n_workers,
+                    token_counter=token_counter, max_dollars=max_budget_dollars, catalog=ResultsCatalog(),
+                    scoring_mode=scoring_mode, shot_seed=fixed_shot_seed)
+    if cache is not None:
+        print(f"cache stats: {cache.stats()}")
+        cache.close()
+    print(format_summary(metrics.close()))
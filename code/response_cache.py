@@ -0,0 +1,121 @@
+"""
+This file contains a persistent on-disk cache of model responses, so that reruns only pay for prompts that changed
+"""
+import hashlib
+import json
+import os
+import sqlite3
+import threading
+import time
+
+
+class CacheMiss(KeyError):
+    """
+    Raised when the cache is offline and a prompt has no cached response
+    """
+
+
+class ResponseCache:
+    """
+    A SQLite-backed cache of completions keyed on a hash of the engine, the exact prompt text, and the sampling
+    parameters. Entries are evicted least-recently-used first once the cache grows past max_size_bytes.
+    """
+
+    def __init__(self, path: str, max_size_bytes: int = 1024 ** 3, offline: bool = False):
+        self.path = str(path)
+        self.max_size_bytes = max_size_bytes
+        self.offline = offline
+        self.hits = 0
+        self.misses = 0
+
+        if os.path.dirname(self.path):
+            os.makedirs(os.path.dirname(self.path), exist_ok=True)
+        # the connection is shared by the query threads, so guard it with a lock
+        self.lock = threading.Lock()
+        self.connection = sqlite3.connect(self.path, check_same_thread=False)
+        self.connection.execute(
+            "CREATE TABLE IF NOT EXISTS responses ("
+            "key TEXT PRIMARY KEY, engine TEXT, response TEXT, size INTEGER, created REAL, last_access REAL)"
+        )
+        self.connection.execute("CREATE INDEX IF NOT EXISTS last_access_index ON responses (last_access)")
+        self.connection.commit()
+
+    @staticmethod
+    def make_key(engine: str, prompt: str, **params) -> str:
+        """
+        Hash the engine, prompt and sampling parameters into a cache key
+        """
+        key_data = json.dumps({"engine": engine, "prompt": prompt, "params": params}, sort_keys=True)
+        return hashlib.sha256(key_data.encode("utf-8")).hexdigest()
+
+    def get(self, engine: str, prompt: str, **params):
+        """
+        Look up a cached response, returning None (or raising CacheMiss when offline) if there isn't one
+        """
+        key = self.make_key(engine, prompt, **params)
+        with self.lock:
+            row = self.connection.execute("SELECT response FROM responses WHERE key = ?", (key,)).fetchone()
+            if row is None:
+                self.misses += 1
+            else:
+                self.hits += 1
+                self.connection.execute("UPDATE responses SET last_access = ? WHERE key = ?", (time.time(), key))
+                self.connection.commit()
+
+        if row is None:
+            if self.offline:
+                raise CacheMiss(f"No cached response for {engine} prompt {key[:12]} and the cache is offline")
+            return None
+        return json.loads(row[0])
+
+    def put(self, engine: str, prompt: str, response, **params):
+        """
+        Store a response, then evict old entries if the cache is over its size limit
+        """
+        key = self.make_key(engine, prompt, **params)
+        response_json = json.dumps(response)
+        now = time.time()
+        with self.lock:
+            self.connection.execute(
+                "INSERT OR REPLACE INTO responses VALUES (?, ?, ?, ?, ?, ?)",
+                (key, engine, response_json, len(response_json), now, now)
+            )
+            self._evict()
+            self.connection.commit()
+
+    def _evict(self):
+        """
+        Delete the least recently used entries until the cache fits in max_size_bytes
+        """
+        total_size = self.connection.execute("SELECT COALESCE(SUM(size), 0) FROM responses").fetchone()[0]
+        if total_size <= self.max_size_bytes:
+            return
+        rows = self.connection.execute("SELECT key, size FROM responses ORDER BY last_access ASC")
+        to_delete = []
+        for key, size in rows:
+            if total_size <= self.max_size_bytes:
+                break
+            to_delete.append((key,))
+            total_size -= size
+        self.connection.executemany("DELETE FROM responses WHERE key = ?", to_delete)
+
+    def stats(self) -> dict:
+        """
+        Get the hit/miss counters along with the current size of the cache
+        """
+        with self.lock:
+            n_entries, total_size = self.connection.execute(
+                "SELECT COUNT(*), COALESCE(SUM(size), 0) FROM responses"
+            ).fetchone()
+        lookups = self.hits + self.misses
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": self.hits / lookups if lookups > 0 else 0.0,
+            "entries": n_entries,
+            "size_bytes": total_size,
+        }
+
+    def close(self):
+        with self.lock:
+            self.connection.close()
@@ -0,0 +1,67 @@
+"""
+This file contains an append-only JSONL log of model responses, so that an interrupted query run can be resumed
+"""
+import json
+import os
+import threading
+
+
+class ResponseLog:
+    """
+    An append-only log with one JSON line per completed row. Each line is flushed to disk as soon as the response
+    arrives, so at most the in-flight requests are lost if the process dies.
+    """
+
+    def __init__(self, path: str):
+        self.path = str(path)
+        if os.path.dirname(self.path):
+            os.makedirs(os.path.dirname(self.path), exist_ok=True)
+        self.lock = threading.Lock()
+        self.drop_torn_line()
+
+    def drop_torn_line(self):
+        """
+        Cut off a half-written last line, left if the process was killed mid-write, so that the next record starts on
+        a line of its own instead of being appended to it
+        """
+        if not os.path.exists(self.path):
+            return
+        with open(self.path, "rb+") as f:
+            content = f.read()
+            if len(content) > 0 and not content.endswith(b"\n"):
+                f.truncate(content.rfind(b"\n") + 1)
+
+    def completed(self) -> dict:
+        """
+        Read the log and return a dictionary from row number to the logged record
+        """
+        records = {}
+        if not os.path.exists(self.path):
+            return records
+        with open(self.path, "r", encoding="utf-8") as f:
+            for line in f:
+                try:
+                    record = json.loads(line)
+                except json.JSONDecodeError:
+                    # the last line may be half-written if the process was killed mid-write
+                    continue
+                records[record["row"]] = record
+        return records
+
+    def write(self, row: int, **fields):
+        """
+        Append the record for a row and make sure it reaches the disk
+        """
+        line = json.dumps({"row": row, **fields}) + "\n"
+        with self.lock:
+            with open(self.path, "a", encoding="utf-8") as f:
+                f.write(line)
+                f.flush()
+                os.fsync(f.fileno())
+
+    def remove(self):
+        """
+        Delete the log once the full results have been saved
+        """
+        if os.path.exists(self.path):
+            os.remove(self.path)
@@ -0,0 +1,162 @@
+"""
+This file contains a small SQLite index of every run: its parameters, where its output file is, how many rows it has,
+how many responses couldn't be parsed, and its summary statistics. Runs are recorded as their files are written, so
+tables and cross-condition queries can read the precomputed numbers instead of re-reading and re-bootstrapping CSVs.
+
+Run this file to index the results that already exist.
+"""
+import glob
+import hashlib
+import os
+import sqlite3
+import time
+
+import numpy as np
+import pandas as pd
+from pyprojroot import here
+
+catalog_path = "data/results-catalog.sqlite"
+
+# the columns that identify a run
+run_keys = ["task_type", "corpus_set", "gpt_version", "prompt_type", "K", "temp", "stage"]
+# the statistics recorded for processed runs (the expected appropriateness is only there for scored runs)
+stat_columns = ["n_rows", "n_parse_failures", "mean", "ci_lower", "ci_upper", "p_val",
+                "expected_mean", "expected_ci_lower", "expected_ci_upper"]
+# what a processed run was computed from, so that incremental analysis can tell whether it is out of date
+version_columns = ["input_hash", "parser_version", "figures_version"]
+
+
+def file_hash(path: str, chunk_size: int = 1 << 20) -> str:
+    """
+    Get the SHA-256 hash of a file's contents
+    """
+    digest = hashlib.sha256()
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(chunk_size), b""):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+class ResultsCatalog:
+    """
+    An index of runs, keyed on the run parameters and the stage ("raw" responses or "processed" scores)
+    """
+
+    def __init__(self, path: str = None):
+        self.path = str(path if path is not None else here(catalog_path))
+        if os.path.dirname(self.path):
+            os.makedirs(os.path.dirname(self.path), exist_ok=True)
+        with self._connect() as connection:
+            connection.execute(
+                "CREATE TABLE IF NOT EXISTS runs ("
+                "task_type TEXT, corpus_set TEXT, gpt_version TEXT, prompt_type TEXT, K INTEGER, temp REAL, "
+                "stage TEXT, path TEXT, n_rows INTEGER, n_parse_failures INTEGER, mean REAL, ci_lower REAL, "
+                "ci_upper REAL, p_val REAL, updated REAL, "
+                "input_hash TEXT, parser_version INTEGER, figures_version INTEGER, "
+                "expected_mean REAL, expected_ci_lower REAL, expected_ci_upper REAL, "
+                "PRIMARY KEY (task_type, corpus_set, gpt_version, prompt_type, K, temp, stage))"
+            )
+            # catalogs made before the version and expected appropriateness columns existed get them added
+            existing_columns = [row[1] for row in connection.execute("PRAGMA table_info(runs)")]
+            added_columns = version_columns + ["expected_mean", "expected_ci_lower", "expected_ci_upper"]
+            for column, column_type in zip(added_columns, ["TEXT", "INTEGER", "INTEGER", "REAL", "REAL", "REAL"]):
+                if column not in existing_columns:
+                    connection.execute(f"ALTER TABLE runs ADD COLUMN {column} {column_type}")
+
+    def _connect(self) -> sqlite3.Connection:
+        # a fresh connection per operation, so that runs on different threads can record at the same time
+        return sqlite3.connect(self.path, timeout=30)
+
+    def record(self, task_type: str, corpus_set: str, gpt_version: str, prompt_type: str, K: int, temp: float,
+               stage: str, path: str, **stats):
+        """
+        Add or update the entry for a run, with its statistics and the versions it was computed with
+        """
+        unknown = set(stats) - set(stat_columns) - set(version_columns)
+        if len(unknown) > 0:
+            raise ValueError(f"Unknown statistics for the results catalog: {sorted(unknown)}")
+        row = {
+            "task_type": task_type, "corpus_set": corpus_set, "gpt_version": gpt_version, "prompt_type": prompt_type,
+            "K": int(K), "temp": float(temp), "stage": stage, "path": os.path.relpath(here(str(path)), here()),
+            **{column: None if stats.get(column) is None else float(stats[column]) for column in stat_columns},
+            **{column: stats.get(column) for column in version_columns},
+            "updated": time.time(),
+        }
+        with self._connect() as connection:
+            connection.execute(
+                f"INSERT OR REPLACE INTO runs ({', '.join(row)}) VALUES ({', '.join('?' * len(row))})",
+                list(row.values())
+            )
+
+    def find(self, **filters) -> pd.DataFrame:
+        """
+        Get the runs matching the filters (a dictionary from column to a value or list of values)
+        """
+        clauses, parameters = [], []
+        for column, value in filters.items():
+            if column not in run_keys + ["path"]:
+                raise ValueError(f"Can't filter the results catalog on {column}")
+            values = list(value) if isinstance(value, (list, tuple, set)) else [value]
+            clauses.append(f"{column} IN ({', '.join('?' * len(values))})")
+            parameters.extend(values)
+        query = "SELECT * FROM runs" + (f" WHERE {' AND '.join(clauses)}" if len(clauses) > 0 else "")
+        with self._connect() as connection:
+            return pd.read_sql_query(query, connection, params=parameters)
+
+    def get(self, **run) -> dict:
+        """
+        Get the entry for a single run, or None if it hasn't been recorded
+        """
+        df_runs = self.find(**run)
+        return None if len(df_runs) == 0 else df_runs.iloc[0].to_dict()
+
+    def get_path(self, **run) -> str:
+        """
+        Get the absolute path of a run's file, or None if it hasn't been recorded
+        """
+        entry = self.get(**run)
+        return None if entry is None else str(here(entry["path"]))
+
+
+def index_existing_results(catalog: ResultsCatalog):
+    """
+    Record every model output file that already exists, computing the statistics for the processed ones
+    """
+    # imported here since the statistics modules aren't needed just to look things up in the catalog
+    from bootstrap import bootstrapped_ci
+    from baseline import random_baseline_summary
+    from storage import parse_run_name
+    from seeding import make_rng, make_run_key
+
+    paths = glob.glob(os.path.join(here("data/model-outputs"), "*.csv")) + \
+        glob.glob(os.path.join(here("data/model-outputs/processed"), "*.csv"))
+    for path in sorted(paths):
+        run = parse_run_name(path)
+        if run is None:
+            continue
+        processed = run.pop("processed")
+        df = pd.read_csv(path)
+        if not processed:
+            catalog.record(**run, stage="raw", path=path, n_rows=len(df))
+            continue
+
+        scores = df["appropriateness_score"].dropna().to_numpy()
+        # the same stream analyze_model_responses bootstraps the condition from, so the intervals match
+        mean, ci_lower, ci_upper = bootstrapped_ci(scores, rng=make_rng(make_run_key(**run), "bootstrap"))
+        rating_options = [0, 0, 0, 1] if run["task_type"] == "inverse" else [1, 2, 3, 4]
+        p_val = random_baseline_summary(mean, rating_options, n_questions=len(scores))["p_val"]
+        expected_mean, expected_ci_lower, expected_ci_upper = None, None, None
+        if "expected_appropriateness" in df.columns:
+            expected_mean, expected_ci_lower, expected_ci_upper = bootstrapped_ci(
+                df["expected_appropriateness"].dropna().to_numpy(),
+                rng=make_rng(make_run_key(**run), "bootstrap_expected_appropriateness"))
+        catalog.record(**run, stage="processed", path=path, n_rows=len(df),
+                       n_parse_failures=int(np.sum(df["appropriateness_score"].isna())), mean=mean,
+                       ci_lower=ci_lower, ci_upper=ci_upper, p_val=p_val, expected_mean=expected_mean,
+                       expected_ci_lower=expected_ci_lower, expected_ci_upper=expected_ci_upper)
+        print(f"indexed {os.path.basename(path)}")
+
+
+if __name__ == "__main__":
+
+    index_existing_results(ResultsCatalog())
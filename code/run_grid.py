@@ -0,0 +1,143 @@
+"""
+This file runs a whole grid of conditions (corpus set x prompt type x model x temperature x K), querying the model for
+every condition that doesn't have results yet and then analyzing each condition as it finishes.
+
+Usage: python run_grid.py [sweep.json]
+where sweep.json (optional) has the same keys as the default sweep below, each mapped to a list of values.
+"""
+import itertools
+import json
+import multiprocessing
+import os
+import sys
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor, as_completed
+
+from pyprojroot import here
+from analyze_model_responses import analyze_cell
+from query_engine import RateLimiter
+from cost_planner import combine_plans, format_plan, check_budget
+from query_gpt3 import query_condition, plan_condition, get_output_name, get_run_prompt_type, requests_per_minute, \
+    tokens_per_minute, cache_path, cache_max_bytes, offline, max_budget_dollars
+from response_cache import ResponseCache
+from results_catalog import ResultsCatalog
+from token_counting import TokenCounter
+from instrumentation import Metrics, set_metrics, make_metrics_path, format_summary
+
+# the default sweep: the grid that create_tables.py expects
+sweep = {
+    "task_type": ["standard"],
+    "corpus_set": ["test"],
+    "prompt_type": ["basic", "non_explanation", "subject_predicate", "QUD", "similarity", "options_only"],
+    "gpt_version": ["curie", "davinci"],
+    "temp": [0.2],
+    "K": [10],
+    # a seed to give every item the same shots in the same order (see query_gpt3.fixed_shot_seed), or None
+    "shot_seed": [None],
+}
+
+# how many conditions to query at once, and how many requests each condition keeps in flight.
+# all of them share one rate limiter, so the total request rate stays within the API quota.
+n_condition_workers = 4
+n_workers_per_condition = 8
+
+# whether to analyze each condition once its responses are in, and whether to skip the analysis of conditions that
+# haven't changed since they were last analyzed
+run_analysis = True
+incremental_analysis = True
+# how many processes analyze conditions at once (None for one per core)
+n_analysis_processes = None
+
+
+def make_cells(sweep: dict) -> list:
+    """
+    Expand a sweep specification into a list of conditions
+    """
+    keys = ["task_type", "corpus_set", "prompt_type", "gpt_version", "temp", "K", "shot_seed"]
+    return [dict(zip(keys, values)) for values in itertools.product(*[sweep.get(key, [None]) for key in keys])]
+
+
+def get_run(cell: dict) -> dict:
+    """
+    Get the parameters a condition's outputs are saved under (the shot seed goes into the prompt type)
+    """
+    run = {key: value for key, value in cell.items() if key != "shot_seed"}
+    run["prompt_type"] = get_run_prompt_type(cell["prompt_type"], shot_seed=cell["shot_seed"])
+    return run
+
+
+def run_grid(sweep: dict, rate_limiter: RateLimiter, cache: ResponseCache = None, token_counter=None,
+             max_dollars: float = None, catalog: ResultsCatalog = None, metrics_path: str = None) -> list:
+    """
+    Query every condition in the sweep that doesn't have an output file yet, then analyze every condition.
+    If a token counter is given, the cost of the whole grid is estimated first, and nothing is sent if it could cost
+    more than max_dollars. If a results catalog is given, every run is recorded in it. If a metrics path is given, the
+    analysis processes append their measurements to it.
+    Returns the conditions along with their summary statistics.
+    """
+    cells = make_cells(sweep)
+    pending_cells, done_cells = [], []
+    for cell in cells:
+        if os.path.exists(here(f"data/model-outputs/{get_output_name(**get_run(cell))}.csv")):
+            done_cells.append(cell)
+        else:
+            pending_cells.append(cell)
+    print(f"{len(cells)} conditions: {len(done_cells)} already have results, {len(pending_cells)} to query")
+
+    # estimate the cost of everything that still has to be queried before sending anything
+    if token_counter is not None and len(pending_cells) > 0:
+        plan = combine_plans([plan_condition(**cell, token_counter=token_counter, n_workers=n_workers_per_condition)
+                              for cell in pending_cells])
+        print(f"grid plan: {format_plan(plan)}")
+        check_budget(plan, max_dollars)
+
+    # analysis runs on a pool of processes, so conditions are analyzed while others are still being queried. the
+    # processes are spawned rather than forked, since forking while the query threads hold locks isn't safe.
+    analysis_executor = ProcessPoolExecutor(max_workers=n_analysis_processes,
+                                            mp_context=multiprocessing.get_context("spawn"))
+    analysis_futures = []
+
+    def analyze(cell):
+        if run_analysis:
+            analysis_futures.append(analysis_executor.submit(analyze_cell, get_run(cell), catalog=catalog,
+                                                             incremental=incremental_analysis,
+                                                             metrics_path=metrics_path))
+
+    # the conditions that are already done can be analyzed straight away
+    for cell in done_cells:
+        analyze(cell)
+
+    with analysis_executor, ThreadPoolExecutor(max_workers=n_condition_workers) as executor:
+        futures = {
+            executor.submit(query_condition, **cell, rate_limiter=rate_limiter, cache=cache,
+                            n_workers=n_workers_per_condition, catalog=catalog): cell
+            for cell in pending_cells
+        }
+        for future in as_completed(futures):
+            cell = futures[future]
+            future.result()
+            print(f"finished querying {get_output_name(**get_run(cell))}")
+            analyze(cell)
+
+        results = [future.result() for future in analysis_futures]
+
+    return results
+
+
+if __name__ == "__main__":
+
+    if len(sys.argv) > 1:
+        with open(sys.argv[1], "r") as f:
+            sweep = {**sweep, **json.load(f)}
+
+    metrics = Metrics(make_metrics_path("run_grid"))
+    set_metrics(metrics)
+    rate_limiter = RateLimiter(requests_per_minute=requests_per_minute, tokens_per_minute=tokens_per_minute)
+    cache = ResponseCache(here(cache_path), max_size_bytes=cache_max_bytes, offline=offline)
+    results = run_grid(sweep, rate_limiter, cache=cache, token_counter=TokenCounter(), max_dollars=max_budget_dollars,
+                       catalog=ResultsCatalog(), metrics_path=metrics.path)
+    print(f"cache stats: {cache.stats()}")
+    cache.close()
+    print(format_summary(metrics.close()))
+
+    for result in results:
+        print(result)
@@ -0,0 +1,84 @@
+"""
+This file derives the random number generators that the pipeline draws from. Each kind of draw gets its own stream.
+The stream comes from one root seed and a key that names what the draws are for:
+- the run (e.g. the condition)
+- the stage (e.g. "shots" or "bootstrap")
+- the item, for draws made per item
+
+Streams with different keys are independent. A stream depends only on its key, not on how many draws were made before
+it or in which process. So rerunning the pipeline, sequentially or in parallel, gives bit-identical prompts and
+statistics.
+"""
+import hashlib
+
+import numpy as np
+
+# the seed every stream is derived from (change it to draw a different, but still reproducible, set of samples)
+root_seed = 0
+
+
+def key_to_int(key) -> int:
+    """
+    Turn part of a stream's key into a non-negative int for the seed sequence. Anything other than a non-negative int
+    is hashed from its string form with a fixed hash. Python's own hash() can't be used, since it changes from one
+    process to the next.
+    """
+    if isinstance(key, (int, np.integer)) and key >= 0:
+        return int(key)
+    return int.from_bytes(hashlib.blake2b(str(key).encode("utf-8"), digest_size=8).digest(), "little")
+
+
+def make_run_key(**run) -> str:
+    """
+    Describe a run by its parameters in a fixed order, e.g. "K=10|prompt_type=basic", for keying its streams
+    """
+    return "|".join(f"{name}={run[name]}" for name in sorted(run))
+
+
+def make_seed_sequence(*keys, seed: int = None) -> np.random.SeedSequence:
+    """
+    Get the seed sequence of the stream with the given key. This is the same seed sequence that repeatedly calling
+    spawn() on the root seed sequence would reach at that key.
+    """
+    return np.random.SeedSequence(root_seed if seed is None else seed, spawn_key=tuple(key_to_int(key) for key in keys))
+
+
+def make_rng(*keys, seed: int = None) -> np.random.Generator:
+    """
+    Get a generator for the stream with the given key, e.g. make_rng(run_key, "shots", item_id). It is cheap enough to
+    make a new generator for every item.
+    """
+    return np.random.default_rng(make_seed_sequence(*keys, seed=seed))
+
+
+def keys_to_ints(keys) -> np.ndarray:
+    """
+    Turn a column of item keys (e.g. IDs or statements) into unsigned 64-bit ints, like key_to_int does for one key
+    """
+    keys = np.asarray(keys)
+    if np.issubdtype(keys.dtype, np.integer) and np.all(keys >= 0):
+        return keys.astype(np.uint64)
+    return np.array([key_to_int(key) for key in keys], dtype=np.uint64)
+
+
+def splitmix64(x: np.ndarray) -> np.ndarray:
+    """
+    Scramble an array of unsigned 64-bit ints with the SplitMix64 finalizer (arithmetic wraps around, as intended)
+    """
+    x = x + np.uint64(0x9E3779B97F4A7C15)
+    x = (x ^ (x >> np.uint64(30))) * np.uint64(0xBF58476D1CE4E5B9)
+    x = (x ^ (x >> np.uint64(27))) * np.uint64(0x94D049BB133111EB)
+    return x ^ (x >> np.uint64(31))
+
+
+def hash_uniforms(item_keys, n: int, *keys, seed: int = None) -> np.ndarray:
+    """
+    Draw n uniform numbers in [0, 1) for each of many items at once, returning an (items, n) array. Each item's draws
+    are a hash of the stream's key, the item's key and the draw's number, so (like make_rng's streams) they only depend
+    on those: the same item gets the same draws however the items are split into chunks.
+    """
+    with np.errstate(over="ignore"):
+        stream = make_seed_sequence(*keys, seed=seed).generate_state(1, dtype=np.uint64)[0]
+        item_states = splitmix64(keys_to_ints(item_keys) ^ stream)
+        hashes = splitmix64(item_states[:, None] + np.arange(n, dtype=np.uint64)[None, :])
+    return (hashes >> np.uint64(11)) * 2.0 ** -53
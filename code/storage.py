@@ -0,0 +1,168 @@
+"""
+This file contains a typed, columnar (Parquet) storage layer for the corpora and model outputs.
+The "values" arrays are stored as native list<int> columns, and the model outputs are stored as one dataset per task
+type, partitioned by corpus set, model, prompt type, K and temperature, so a whole grid of results can be read with one
+filtered read instead of a CSV parse per condition.
+
+Run this file to convert the existing CSVs.
+"""
+import glob
+import os
+import re
+
+import numpy as np
+import pandas as pd
+import pyarrow as pa
+import pyarrow.compute as pc
+import pyarrow.dataset as ds
+import pyarrow.parquet as pq
+from pyprojroot import here
+
+corpora_root = "data/parquet/katz-corpus"
+outputs_root = "data/parquet/model-outputs"
+
+# the partition columns of the model output datasets, in directory order
+partition_schema = pa.schema([
+    ("corpus_set", pa.string()),
+    ("gpt_version", pa.string()),
+    ("prompt_type", pa.string()),
+    ("K", pa.int32()),
+    ("temp", pa.float64()),
+])
+partitioning = ds.partitioning(partition_schema, flavor="hive")
+
+# the columns that hold text. Any of them can be entirely missing in a run (e.g. parse_failure when every response
+# parsed), which a CSV reads back as floats, so they are always stored as strings to keep the datasets' schemas in line
+text_columns = ["Type", "Statement", "Good (4)", "Less good (3)", "Semantic (2) - category/desription", "Bad (1)",
+                "NOTE", "statement", "true_answer", "distractor_1", "distractor_2", "distractor_3", "prompt",
+                "model_response", "option_logprobs", "raw_guess", "parse_source", "parse_failure"]
+
+run_name_pattern = re.compile(
+    r"model_responses(?P<inverse>_inverse)?_set=(?P<corpus_set>[^-]+)-gpt=(?P<gpt_version>[^-]+)"
+    r"-prompt=(?P<prompt_type>[^-]+)-k=(?P<K>\d+)-temp=(?P<temp>[\d.]+)(?P<processed>-processed)?\.csv$"
+)
+
+
+def parse_run_name(path: str) -> dict:
+    """
+    Get the parameters of a run from the name of its output file, or None if it isn't a model output file
+    """
+    match = run_name_pattern.search(os.path.basename(str(path)))
+    if match is None:
+        return None
+    return {
+        "task_type": "inverse" if match["inverse"] else "standard",
+        "corpus_set": match["corpus_set"],
+        "gpt_version": match["gpt_version"],
+        "prompt_type": match["prompt_type"],
+        "K": int(match["K"]),
+        "temp": float(match["temp"]),
+        "processed": match["processed"] is not None,
+    }
+
+
+def to_typed_table(df: pd.DataFrame) -> pa.Table:
+    """
+    Convert a corpus or output dataframe to an Arrow table, parsing the stringified "values" arrays into list<int>
+    and dropping the unnamed index columns left behind by earlier CSV round trips
+    """
+    df = df.drop(columns=[column for column in df.columns if str(column).startswith("Unnamed")])
+    if "values" in df.columns and len(df) > 0 and isinstance(df["values"].iloc[0], str):
+        values = np.fromstring(" ".join(df["values"].str[1:-1]), dtype=int, sep=" ").reshape(len(df), -1)
+        df = df.assign(values=list(values))
+    table = pa.Table.from_pandas(df, preserve_index=False)
+
+    # columns that happen to be all missing have no type, and text columns that are all missing come back from a CSV as
+    # floats; store both as strings so the datasets' schemas agree
+    for i, field in enumerate(table.schema):
+        is_text = pa.types.is_string(field.type) or pa.types.is_large_string(field.type)
+        if pa.types.is_null(field.type) or (field.name in text_columns and not is_text):
+            table = table.set_column(i, pa.field(field.name, pa.string()), table.column(i).cast(pa.string()))
+    return table
+
+
+def write_corpus(df: pd.DataFrame, name: str):
+    """
+    Save a corpus split (e.g. "katz-corpus-test") as a Parquet file
+    """
+    path = here(f"{corpora_root}/{name}.parquet")
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    pq.write_table(to_typed_table(df), path)
+
+
+def read_corpus(name: str, columns: list = None) -> pd.DataFrame:
+    """
+    Read a corpus split saved with write_corpus
+    """
+    return pd.read_parquet(here(f"{corpora_root}/{name}.parquet"), columns=columns)
+
+
+def get_outputs_path(task_type: str = "standard", processed: bool = True) -> str:
+    """
+    Get the root directory of a model output dataset
+    """
+    return str(here(f"{outputs_root}/{'processed' if processed else 'raw'}/{task_type}"))
+
+
+def write_outputs(df: pd.DataFrame, task_type: str, corpus_set: str, gpt_version: str, prompt_type: str, K: int,
+                  temp: float, processed: bool = True):
+    """
+    Save the outputs of one run into its partition of the dataset, replacing whatever was there for that run
+    """
+    table = to_typed_table(df)
+    for name, value in [("corpus_set", corpus_set), ("gpt_version", gpt_version), ("prompt_type", prompt_type),
+                        ("K", K), ("temp", temp)]:
+        table = table.append_column(pa.field(name, partition_schema.field(name).type),
+                                    pa.array([value] * len(table), type=partition_schema.field(name).type))
+    ds.write_dataset(table, get_outputs_path(task_type, processed), format="parquet", partitioning=partitioning,
+                     existing_data_behavior="delete_matching")
+
+
+def read_outputs(task_type: str = "standard", processed: bool = True, filters: dict = None,
+                 columns: list = None) -> pd.DataFrame:
+    """
+    Read model outputs, keeping only the partitions that match filters (a dictionary from partition column to a value
+    or list of values), so only the matching files are opened
+    """
+    dataset = ds.dataset(get_outputs_path(task_type, processed), format="parquet", partitioning=partitioning)
+    # the runs don't all have exactly the same columns, so read them with the union of their schemas
+    schema = pa.unify_schemas([fragment.physical_schema for fragment in dataset.get_fragments()] + [partition_schema],
+                              promote_options="permissive")
+    dataset = ds.dataset(get_outputs_path(task_type, processed), format="parquet", partitioning=partitioning,
+                         schema=schema)
+
+    expression = None
+    for name, value in (filters or {}).items():
+        if isinstance(value, (list, tuple, set)):
+            condition = pc.field(name).isin(list(value))
+        else:
+            condition = pc.field(name) == value
+        expression = condition if expression is None else expression & condition
+
+    return dataset.to_table(filter=expression, columns=columns).to_pandas()
+
+
+def convert_csvs():
+    """
+    Convert all the existing corpus and model output CSVs to Parquet
+    """
+    for path in sorted(glob.glob(os.path.join(here("data/katz-corpus"), "*.csv"))):
+        name = os.path.splitext(os.path.basename(path))[0]
+        write_corpus(pd.read_csv(path), name)
+        print(f"converted {name}")
+
+    output_paths = glob.glob(os.path.join(here("data/model-outputs"), "*.csv")) + \
+        glob.glob(os.path.join(here("data/model-outputs/processed"), "*.csv"))
+    for path in sorted(output_paths):
+        run = parse_run_name(path)
+        if run is None:
+            print(f"skipping {path}: not a model output file")
+            continue
+        write_outputs(pd.read_csv(path), run["task_type"], run["corpus_set"], run["gpt_version"],
+                      run["prompt_type"], run["K"], run["temp"], processed=run["processed"])
+        print(f"converted {os.path.basename(path)}")
+
+
+if __name__ == "__main__":
+
+    convert_csvs()
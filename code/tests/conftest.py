@@ -0,0 +1,7 @@
+"""
+Shared setup for the tests: the pipeline's modules live in code/, so make them importable from here
+"""
+import os
+import sys
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
@@ -0,0 +1,71 @@
+"""
+Tests for analyzing the model responses of a condition
+"""
+import json
+import math
+import os
+from pathlib import Path
+
+import numpy as np
+import pandas as pd
+import pytest
+
+import analyze_model_responses
+import results_catalog
+from analyze_model_responses import analyze_condition, expected_appropriateness, get_figure_paths
+from bootstrap import bootstrapped_ci
+from results_catalog import ResultsCatalog
+from seeding import make_rng, make_run_key
+
+
+@pytest.fixture
+def project(tmp_path, monkeypatch):
+    """
+    A scratch project directory that the analysis reads from and writes to instead of the real one
+    """
+    def here(path: str = "") -> Path:
+        return tmp_path / path
+    monkeypatch.setattr(analyze_model_responses, "here", here)
+    monkeypatch.setattr(results_catalog, "here", here)
+    for directory in ["data/model-outputs/processed", "figures"]:
+        os.makedirs(tmp_path / directory)
+    return tmp_path
+
+
+def test_figure_paths_differ_between_tasks_and_corpus_sets():
+    run = {"gpt_version": "davinci", "prompt_type": "QUD", "K": 10, "temp": 0.2}
+    paths = [tuple(get_figure_paths(task_type, corpus_set, **run))
+             for task_type in ["standard", "inverse"] for corpus_set in ["test", "dev"]]
+    assert len({path for condition_paths in paths for path in condition_paths}) == 2 * len(paths)
+
+
+def test_scored_run_summary_has_the_expected_appropriateness(project):
+    rng = np.random.default_rng(0)
+    n_items = 30
+    option_logprobs = [[math.log(p) if p > 0.05 else None for p in rng.dirichlet(np.ones(4))] for _ in range(n_items)]
+    df_raw = pd.DataFrame({
+        "ID": np.arange(n_items),
+        "values": [f"[{' '.join(map(str, rng.permutation(4) + 1))}]" for _ in range(n_items)],
+        "option_logprobs": [json.dumps(logprobs) for logprobs in option_logprobs],
+        "model_response": [f"{'abcd'[i % 4]})" for i in range(n_items)],
+    })
+    df_raw.to_csv(project / "data/model-outputs/model_responses_set=test-gpt=stub-prompt=basic-k=10-temp=0.2.csv",
+                  index=False)
+    run = {"task_type": "standard", "corpus_set": "test", "gpt_version": "stub", "prompt_type": "basic", "K": 10,
+           "temp": 0.2}
+    catalog = ResultsCatalog(project / "catalog.sqlite")
+
+    summary = analyze_condition(run["corpus_set"], run["gpt_version"], run["prompt_type"], run["task_type"], run["K"],
+                                run["temp"], catalog=catalog)
+    expected = bootstrapped_ci(expected_appropriateness(df_raw, "standard"),
+                               rng=make_rng(make_run_key(**run), "bootstrap_expected_appropriateness"))
+    assert (summary["expected_mean"], summary["expected_ci_lower"], summary["expected_ci_upper"]) == expected
+
+    entry = catalog.get(**run, stage="processed")
+    assert (entry["expected_mean"], entry["expected_ci_lower"], entry["expected_ci_upper"]) == pytest.approx(expected)
+
+    # nothing changed, so the incremental analysis reads the same summary back from the catalog
+    incremental_summary = analyze_condition(run["corpus_set"], run["gpt_version"], run["prompt_type"],
+                                            run["task_type"], run["K"], run["temp"], catalog=catalog,
+                                            incremental=True)
+    assert incremental_summary == pytest.approx(summary)
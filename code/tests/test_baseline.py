@@ -0,0 +1,29 @@
+"""
+Tests for the paired comparison of two conditions item by item
+"""
+import pandas as pd
+import pytest
+
+from baseline import compare_conditions
+
+
+def make_responses(scores: list) -> pd.DataFrame:
+    # the corpus reuses IDs, so two different statements share ID 7
+    return pd.DataFrame({"ID": [7, 7, 8, 9], "Statement": ["A tree is an umbrella.", "A lawyer is a shark.",
+                                                           "Time is money.", "Words are daggers."],
+                         "appropriateness_score": scores})
+
+
+def test_items_with_the_same_id_are_paired_by_statement():
+    df_a, df_b = make_responses([4, 1, 3, 2]), make_responses([3, 1, 3, 1])
+    # shuffled, to check that items are matched rather than lined up
+    mean_difference, p_val = compare_conditions(df_a, df_b.sample(frac=1, random_state=0))
+    # four pairs, not the six a merge on ID would make
+    assert mean_difference == pytest.approx((1 + 0 + 0 + 1) / 4)
+    # flipping the signs of the two nonzero differences gives a sum at least as far from 0 in 2 of the 4 patterns
+    assert p_val == pytest.approx(0.5)
+
+
+def test_ambiguous_keys_are_rejected():
+    with pytest.raises(pd.errors.MergeError):
+        compare_conditions(make_responses([4, 1, 3, 2]), make_responses([3, 1, 3, 1]), on="ID")
@@ -0,0 +1,41 @@
+"""
+Tests for the bootstrap: every way of drawing the resampled means has to agree with plain resampling
+"""
+import numpy as np
+import pytest
+
+from bootstrap import bootstrap_many, bootstrap_means, bootstrapped_ci
+
+scores = np.array([1, 1, 2, 2, 2, 3, 4, 4, 4, 4, 3, 2, 1, 4, 4, 3, 3, 2, 4, 4], dtype=float)
+
+
+def resample_means(scores, n, seed):
+    """
+    Resample the mean the obvious way, materializing every resample
+    """
+    rng = np.random.default_rng(seed)
+    return scores[rng.integers(0, len(scores), size=(n, len(scores)))].mean(axis=1)
+
+
+@pytest.mark.parametrize("scores", [scores, scores + 0.5, scores + np.linspace(0, 0.1, len(scores))],
+                         ids=["integer", "chained", "resampled"])
+def test_means_match_plain_resampling(scores):
+    means = bootstrap_means(scores, n=200000, rng=0)
+    expected = resample_means(scores, 200000, 1)
+    assert means.mean() == pytest.approx(expected.mean(), abs=0.005)
+    assert means.std() == pytest.approx(expected.std(), rel=0.02)
+    assert np.percentile(means, [2.5, 97.5]) == pytest.approx(np.percentile(expected, [2.5, 97.5]), abs=0.05)
+
+
+def test_batched_conditions_match_one_at_a_time():
+    score_lists = [scores, scores[:12], np.ones(5), scores + 0.5]
+    results = bootstrap_many(score_lists, n=20000, rng=[np.random.default_rng(i) for i in range(4)])
+    for scores_i, result, seed in zip(score_lists, results, range(4)):
+        assert tuple(result) == bootstrapped_ci(scores_i, n=20000, rng=np.random.default_rng(seed))
+
+
+def test_shared_generator_is_reproducible():
+    score_lists = [scores, scores[:12]]
+    first = bootstrap_many(score_lists, n=20000, rng=0, method="bca")
+    assert np.array_equal(first, bootstrap_many(score_lists, n=20000, rng=0, method="bca"))
+    assert np.all((first[:, 1] <= first[:, 0]) & (first[:, 0] <= first[:, 2]))
@@ -0,0 +1,29 @@
+"""
+Tests for aggregating the conditions into the tables
+"""
+import numpy as np
+import pandas as pd
+
+from bootstrap import bootstrapped_ci
+from create_tables import summarize_conditions
+from seeding import make_rng, make_run_key
+
+
+def test_tables_match_each_condition_bootstrapped_on_its_own():
+    rng = np.random.default_rng(0)
+    responses_by_condition, runs = {}, {}
+    for model_type in ["curie", "davinci"]:
+        for prompt_type in ["basic", "QUD"]:
+            scores = rng.integers(1, 5, size=40).astype(float)
+            scores[:3] = np.nan
+            responses_by_condition[(model_type, prompt_type)] = pd.DataFrame({"appropriateness_score": scores})
+            runs[(model_type, prompt_type)] = {"task_type": "standard", "corpus_set": "test", "gpt_version": model_type,
+                                               "prompt_type": prompt_type, "K": 10, "temp": 0.2}
+
+    results, non_parsed_guesses = summarize_conditions(responses_by_condition, runs)
+    for condition, df_responses in responses_by_condition.items():
+        # the interval analyze_model_responses and the results catalog get for the same run
+        expected = bootstrapped_ci(df_responses["appropriateness_score"].dropna(),
+                                   rng=make_rng(make_run_key(**runs[condition]), "bootstrap"))
+        assert tuple(results[condition]) == expected
+        assert non_parsed_guesses[condition] == 3
@@ -0,0 +1,62 @@
+"""
+Tests for the instrumentation: the records of conditions run at the same time into one metrics file have to say which
+condition they belong to
+"""
+import json
+import threading
+
+import pytest
+
+import instrumentation
+from analyze_model_responses import analyze_cell
+from instrumentation import Metrics, get_metrics, record_fields, set_metrics, stage
+from query_engine import RateLimiter, run_queries
+
+
+def read_records(path) -> list:
+    with open(path, "r", encoding="utf-8") as f:
+        return [json.loads(line) for line in f]
+
+
+@pytest.fixture
+def metrics(tmp_path, monkeypatch):
+    monkeypatch.setattr(instrumentation, "default_metrics", instrumentation.default_metrics)
+    metrics = Metrics(tmp_path / "metrics.jsonl", run_name="grid")
+    set_metrics(metrics)
+    return metrics
+
+
+def test_concurrent_conditions_tag_their_records(metrics):
+    def query_condition(output_name):
+        with record_fields(output_name=output_name):
+            with stage("query"):
+                run_queries([f"{output_name} prompt {i}" for i in range(20)], lambda prompts: prompts, n_workers=4,
+                            rate_limiter=RateLimiter(requests_per_minute=10 ** 9, tokens_per_minute=10 ** 12))
+
+    threads = [threading.Thread(target=query_condition, args=(f"condition-{i}",)) for i in range(3)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    # records written outside of any condition don't get one
+    with stage("report"):
+        pass
+
+    records = read_records(metrics.path)
+    latencies = [record for record in records if record.get("name") == "request_latency"]
+    assert len(latencies) == 3 * 20
+    for i in range(3):
+        assert sum(record["output_name"] == f"condition-{i}" for record in latencies) == 20
+    stages = {record["stage"]: record for record in records if record["type"] == "stage"}
+    assert "output_name" in stages["query"] and "output_name" not in stages["report"]
+    assert all(record["run_name"] == "grid" for record in records)
+
+
+def test_failed_analysis_still_writes_its_summary(metrics, tmp_path):
+    cell = {"task_type": "standard", "corpus_set": "missing", "gpt_version": "none", "prompt_type": "basic", "K": 10,
+            "temp": 0.2}
+    with pytest.raises(FileNotFoundError):
+        analyze_cell(cell, metrics_path=tmp_path / "analysis.jsonl")
+    records = read_records(tmp_path / "analysis.jsonl")
+    assert records[-1]["type"] == "summary" and records[-1]["corpus_set"] == "missing"
+    assert get_metrics() is not metrics
@@ -0,0 +1,87 @@
+"""
+Tests for the local model backend on a tiny Hugging Face model. They need torch and transformers, and the model in the
+Hugging Face cache (set DOWNLOAD_TEST_MODELS to download it), and are skipped otherwise.
+"""
+import os
+
+import pytest
+
+torch = pytest.importorskip("torch")
+pytest.importorskip("transformers")
+
+test_model_name = "sshleifer/tiny-gpt2"
+
+prompts = [
+    "Task: pick the paraphrase.\nA tree is an umbrella.\nThe answer is a)",
+    "Task: pick the paraphrase.\nMy lawyer is a shark.\nThe answer is b)",
+    "Task: pick the paraphrase.\nTime is money, or so they say.\nThe answer is c)",
+    "Task: pick the paraphrase.\nHer words were daggers.\nThe answer is d)",
+    "Something else entirely",
+]
+
+
+@pytest.fixture(scope="module")
+def model():
+    from huggingface_hub import try_to_load_from_cache
+    if not isinstance(try_to_load_from_cache(test_model_name, "config.json"), str) and \
+            os.environ.get("DOWNLOAD_TEST_MODELS") is None:
+        pytest.skip(f"{test_model_name} isn't in the Hugging Face cache")
+    from local_model import LocalModel
+    return LocalModel(test_model_name)
+
+
+def run_unbatched(model, run):
+    """
+    Run with every prompt in a batch of its own and nothing in the prefix cache
+    """
+    max_batch_size, model.max_batch_size = model.max_batch_size, 1
+    model.prefix_cache.entries.clear()
+    model.prefix_cache.size = 0
+    try:
+        return run()
+    finally:
+        model.max_batch_size = max_batch_size
+
+
+def test_batched_generation_matches_unbatched(model):
+    def generate():
+        return model.generate(prompts, temperature=0, max_tokens=8)
+    assert generate() == run_unbatched(model, generate)
+
+
+def test_batched_scores_match_unbatched(model):
+    def score():
+        return model.next_token_logprobs(prompts, ["a", "b", "c", "d"]), model.echo_logprobs(prompts, 2)
+    (batched_next_token, batched_echo), (next_token, echo) = score(), run_unbatched(model, score)
+    for batched_logprobs, logprobs in zip(batched_next_token, next_token):
+        assert batched_logprobs == pytest.approx(logprobs, rel=1e-4)
+    assert batched_echo == pytest.approx(echo, rel=1e-4)
+
+
+@torch.no_grad()
+def test_echo_logprobs_score_the_continuation_tokens(model):
+    totals = model.echo_logprobs(prompts, 2)
+    for prompt, total in zip(prompts, totals):
+        encoding = model.tokenizer(prompt, return_offsets_mapping=True)
+        token_ids = encoding["input_ids"]
+        logprobs = torch.log_softmax(model.model(torch.tensor([token_ids])).logits[0], dim=-1)
+        # the whole sequence at once, without batching or the prefix cache
+        expected = sum(logprobs[j - 1, token_ids[j]].item() for j, (start, end)
+                       in enumerate(encoding["offset_mapping"]) if j > 0 and end > len(prompt) - 2)
+        assert total == pytest.approx(expected, rel=1e-4)
+
+
+@torch.no_grad()
+def test_generation_with_cached_prefix_matches_generation_without(model):
+    first = model.generate(prompts[:4], temperature=0, max_tokens=8)
+    hits = model.prefix_cache.hits
+    second = model.generate(prompts[:4], temperature=0, max_tokens=8)
+    # the shared task description came out of the cache the second time
+    assert model.prefix_cache.hits > hits
+    assert second == first
+    for prompt, text in zip(prompts[:4], second):
+        # plain greedy decoding of the prompt on its own, without any cached or shared prefix
+        input_ids = model.tokenizer(prompt, return_tensors="pt")["input_ids"]
+        output = model.model.generate(input_ids, attention_mask=torch.ones_like(input_ids), max_new_tokens=8,
+                                      do_sample=False, pad_token_id=model.pad_token_id)
+        assert text == model.tokenizer.decode(output[0, input_ids.shape[1]:], skip_special_tokens=True)
@@ -0,0 +1,38 @@
+"""
+Tests for parsing which option a model response chose
+"""
+import pandas as pd
+
+from analyze_model_responses import extract_guess
+from answer_extraction import extract_answers
+
+def test_extract_guess_prefers_the_stated_answer():
+    cases = {
+        " The answer is b.": "b",
+        "c) The speaker is saying the answer is d": "d",
+        "The speaker is saying a) that the tree is tall": "a",
+        "b) A tree is an umbrella.": "b",
+        "I don't know": None,
+        "": None,
+    }
+    assert [extract_guess(response) for response in cases] == list(cases.values())
+
+
+def test_extract_answers_resolves_each_kind_of_answer():
+    prompt = "Q\na) A tree is tall.\nb) A tree is an umbrella.\nc) Trees are green.\nd) na"
+    cases = {
+        "The speaker is saying a) but the answer is c.": ("c", "answer_is", None),
+        "The answer is b. On reflection the answer is (d)": ("d", "answer_is", None),
+        "The speaker is saying b) that trees shelter": ("b", "speaker_is_saying", None),
+        "The speaker is saying a) or the speaker is saying b)": (None, None, "ambiguous"),
+        "(c) trees are green ### next example: a) ": ("c", "leading_letter", None),
+        "I think (b) fits best": ("b", "inline_letter", None),
+        "A tree is an umbrella": ("b", "option_text", None),
+        "I am unable to answer this": (None, None, "declined"),
+        "Trees are old\nand wise": (None, None, "unfinished_rationale"),
+        "   ": (None, None, "empty"),
+    }
+    extractions = extract_answers(pd.Series(list(cases)), pd.Series([prompt] * len(cases)))
+    for extraction, expected in zip(extractions.astype(object).where(extractions.notna(), None).itertuples(index=False),
+                                    cases.values()):
+        assert tuple(extraction) == expected
@@ -0,0 +1,73 @@
+"""
+Tests for the prefix cache, on fake tensors (numpy arrays with the tensor methods the cache uses), so they run without
+torch
+"""
+import numpy as np
+
+from prefix_cache import PrefixCache, common_prefix_length, past_nbytes
+
+
+class FakeTensor(np.ndarray):
+    def numel(self) -> int:
+        return self.size
+
+    def element_size(self) -> int:
+        return self.itemsize
+
+
+def make_past(prefix_ids: list, n_layers: int = 2, n_heads: int = 2, head_size: int = 4) -> tuple:
+    """
+    Make attention keys and values of shape (1, heads, tokens, head size) for each layer, where the values at each
+    position are that position's token ID, so slicing can be checked
+    """
+    tensor = np.broadcast_to(np.array(prefix_ids, dtype=np.float32)[None, None, :, None],
+                             (1, n_heads, len(prefix_ids), head_size)).copy().view(FakeTensor)
+    return tuple((tensor, tensor.copy()) for _ in range(n_layers))
+
+
+def test_common_prefix_length():
+    assert common_prefix_length([[1, 2, 3], [1, 2, 4], [1, 2]]) == 2
+    assert common_prefix_length([[5, 2], [1, 2]]) == 0
+    assert common_prefix_length([[1, 2, 3]]) == 3
+
+
+def test_past_nbytes():
+    # 2 layers of a key and a value, each 2 heads x 3 tokens x 4 floats of 4 bytes
+    assert past_nbytes(make_past([1, 2, 3])) == 2 * 2 * 2 * 3 * 4 * 4
+
+
+def test_longest_prefix_hit():
+    cache = PrefixCache()
+    cache.put([1, 2, 3, 4], make_past([1, 2, 3, 4]))
+    cache.put([1, 2, 9], make_past([1, 2, 9]))
+
+    length, past = cache.longest([1, 2, 3, 7, 8])
+    assert length == 3
+    for key, value in past:
+        assert key.shape[2] == 3 and np.all(key[0, 0, :, 0] == [1, 2, 3])
+
+    assert cache.longest([1, 2, 9, 9])[0] == 3
+    assert cache.longest([7, 1, 2]) == (0, None)
+    assert cache.stats() == {"entries": 2, "size_bytes": past_nbytes(make_past([1, 2, 3, 4])) +
+                             past_nbytes(make_past([1, 2, 9])), "hits": 2, "misses": 1}
+
+
+def test_least_recently_used_prefixes_are_evicted_by_size():
+    entry_size = past_nbytes(make_past([0, 0, 0]))
+    cache = PrefixCache(max_bytes=2 * entry_size)
+    cache.put([1, 1, 1], make_past([1, 1, 1]))
+    cache.put([2, 2, 2], make_past([2, 2, 2]))
+    # using the first prefix makes the second one the least recently used
+    assert cache.longest([1, 1, 1])[0] == 3
+    cache.put([3, 3, 3], make_past([3, 3, 3]))
+    assert list(cache.entries) == [(1, 1, 1), (3, 3, 3)]
+    assert cache.size == 2 * entry_size
+
+    # a longer prefix takes up more room, so both of the others have to go
+    cache.put([4] * 6, make_past([4] * 6))
+    assert list(cache.entries) == [(4,) * 6]
+    assert cache.size == 2 * entry_size
+
+    # a prefix bigger than the whole cache isn't cached at all
+    cache.put([5] * 7, make_past([5] * 7))
+    assert list(cache.entries) == [(4,) * 6]
@@ -0,0 +1,160 @@
+"""
+Tests for the concurrent query engine, against a stub of the completions endpoint
+"""
+import importlib
+import random
+import threading
+import time
+
+import openai
+import pytest
+import query_engine
+from query_engine import RateLimiter, call_with_retries, make_openai_completion, run_queries
+from response_cache import ResponseCache
+
+
+class StubCompletions:
+    """
+    A stand-in for openai.Completion.create that answers each prompt with "response to <prompt>", after a random
+    delay and with the choices shuffled. It can be told to fail the first few calls with an error.
+    """
+
+    def __init__(self, errors: list = None):
+        self.errors = list(errors or [])
+        self.calls = []
+        self.lock = threading.Lock()
+
+    def create(self, **kwargs):
+        with self.lock:
+            self.calls.append(kwargs)
+            if len(self.errors) > 0:
+                raise self.errors.pop(0)
+        time.sleep(random.uniform(0, 0.01))
+        n = kwargs.get("n", 1)
+        choices = [{"index": i * n + j, "text": f"response to {prompt}"}
+                   for i, prompt in enumerate(kwargs["prompt"]) for j in range(n)]
+        random.shuffle(choices)
+        return {"choices": choices, "usage": {"prompt_tokens": len(kwargs["prompt"]), "completion_tokens": 1}}
+
+
+@pytest.fixture
+def stub(monkeypatch):
+    stub = StubCompletions()
+    monkeypatch.setattr(openai.Completion, "create", stub.create)
+    return stub
+
+
+def unlimited():
+    return RateLimiter(requests_per_minute=10 ** 9, tokens_per_minute=10 ** 12)
+
+
+@pytest.mark.parametrize("max_batch_size", [1, 3])
+def test_responses_come_back_in_prompt_order(stub, max_batch_size):
+    prompts = [f"prompt {i}" for i in range(50)]
+    complete = make_openai_completion("stub", temperature=0)
+    responses = run_queries(prompts, complete, n_workers=8, rate_limiter=unlimited(), max_batch_size=max_batch_size)
+    assert responses == [f"response to {prompt}" for prompt in prompts]
+
+
+def test_samples_come_back_with_their_prompts(stub):
+    prompts = [f"prompt {i}" for i in range(10)]
+    complete = make_openai_completion("stub", temperature=0.7, n=2)
+    responses = run_queries(prompts, complete, n_workers=4, rate_limiter=unlimited(), max_batch_size=3, n=2)
+    assert responses == [[f"response to {prompt}"] * 2 for prompt in prompts]
+
+
+@pytest.mark.parametrize("error", [
+    openai.error.RateLimitError("slow down", http_status=429),
+    openai.error.APIError("server error", http_status=500),
+    openai.error.ServiceUnavailableError("overloaded", http_status=503),
+])
+def test_transient_errors_are_retried(stub, error):
+    stub.errors = [error, error]
+    complete = make_openai_completion("stub", temperature=0)
+    assert call_with_retries(lambda: complete(["hi"]), base_delay=0) == ["response to hi"]
+    assert len(stub.calls) == 3
+
+
+def test_bad_requests_are_not_retried(stub):
+    stub.errors = [openai.error.InvalidRequestError("bad prompt", "prompt", http_status=400)]
+    complete = make_openai_completion("stub", temperature=0)
+    with pytest.raises(openai.error.InvalidRequestError):
+        call_with_retries(lambda: complete(["hi"]), base_delay=0)
+    assert len(stub.calls) == 1
+
+
+@pytest.fixture
+def without_timeout_error():
+    """
+    Reload the query engine as if openai.error had no Timeout, as in the openai version pinned in environment.yml
+    """
+    timeout = openai.error.__dict__.pop("Timeout", None)
+    try:
+        yield importlib.reload(query_engine)
+    finally:
+        if timeout is not None:
+            openai.error.Timeout = timeout
+        importlib.reload(query_engine)
+
+
+def test_errors_are_classified_without_a_timeout_error(without_timeout_error):
+    is_retryable = without_timeout_error.is_retryable
+    assert is_retryable(openai.error.RateLimitError("slow down", http_status=429))
+    assert is_retryable(openai.error.APIConnectionError("connection reset"))
+    assert is_retryable(openai.error.APIError("bad gateway", http_status=502))
+    assert not is_retryable(openai.error.InvalidRequestError("bad prompt", "prompt", http_status=400))
+
+
+def test_retries_give_up_eventually(stub):
+    stub.errors = [openai.error.RateLimitError("slow down", http_status=429)] * 3
+    complete = make_openai_completion("stub", temperature=0)
+    with pytest.raises(openai.error.RateLimitError):
+        call_with_retries(lambda: complete(["hi"]), max_retries=2, base_delay=0)
+    assert len(stub.calls) == 3
+
+
+def test_rate_limiter_throttles_requests():
+    # 1200 requests per minute is 20 per second, and the bucket starts with a minute's worth
+    rate_limiter = RateLimiter(requests_per_minute=1200, tokens_per_minute=10 ** 12)
+    start = time.monotonic()
+    for _ in range(1200):
+        rate_limiter.acquire()
+    assert time.monotonic() - start < 0.5
+    for _ in range(10):
+        rate_limiter.acquire()
+    assert time.monotonic() - start >= 0.4
+
+
+def test_rate_limiter_throttles_tokens():
+    # 6000 tokens per minute is 100 per second
+    rate_limiter = RateLimiter(requests_per_minute=10 ** 9, tokens_per_minute=6000)
+    start = time.monotonic()
+    rate_limiter.acquire(6000)
+    assert time.monotonic() - start < 0.1
+    rate_limiter.acquire(50)
+    assert time.monotonic() - start >= 0.4
+
+
+def test_cache_hits_skip_the_network(stub, tmp_path):
+    cache = ResponseCache(tmp_path / "cache.sqlite")
+    prompts = [f"prompt {i}" for i in range(6)]
+    complete = make_openai_completion("stub", temperature=0)
+    sampling_params = {"temperature": 0}
+
+    first = run_queries(prompts[:4], complete, n_workers=2, rate_limiter=unlimited(), cache=cache, engine="stub",
+                        sampling_params=sampling_params)
+    assert len(stub.calls) == 4
+
+    second = run_queries(prompts, complete, n_workers=2, rate_limiter=unlimited(), cache=cache, engine="stub",
+                         sampling_params=sampling_params)
+    assert second[:4] == first
+    assert second == [f"response to {prompt}" for prompt in prompts]
+    # only the two new prompts were sent
+    assert len(stub.calls) == 6
+    assert sorted(call["prompt"][0] for call in stub.calls[4:]) == prompts[4:]
+
+    # a different temperature is a different cache entry
+    run_queries(prompts[:1], complete, n_workers=1, rate_limiter=unlimited(), cache=cache, engine="stub",
+                sampling_params={"temperature": 0.7})
+    assert len(stub.calls) == 7
+    cache.close()
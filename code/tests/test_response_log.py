@@ -0,0 +1,32 @@
+"""
+Tests for resuming an interrupted run from its response log
+"""
+import json
+
+from response_log import ResponseLog
+
+
+def test_resuming_after_a_torn_write_logs_every_row(tmp_path):
+    path = tmp_path / "partial.jsonl"
+    log = ResponseLog(path)
+    log.write(0, model_response="a)")
+    # the process was killed in the middle of writing row 1
+    with open(path, "a", encoding="utf-8") as f:
+        f.write(json.dumps({"row": 1, "model_response": "b)"})[:12])
+    assert list(log.completed()) == [0]
+
+    resumed = ResponseLog(path)
+    assert list(resumed.completed()) == [0]
+    resumed.write(1, model_response="b)")
+    resumed.write(2, model_response="c)")
+    records = resumed.completed()
+    assert sorted(records) == [0, 1, 2]
+    assert [records[i]["model_response"] for i in range(3)] == ["a)", "b)", "c)"]
+
+
+def test_complete_logs_are_left_as_they_are(tmp_path):
+    path = tmp_path / "partial.jsonl"
+    ResponseLog(path).write(0, model_response="a)")
+    content = path.read_bytes()
+    ResponseLog(path)
+    assert path.read_bytes() == content
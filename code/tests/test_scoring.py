@@ -0,0 +1,119 @@
+"""
+Tests for scoring the options without generating text (the next_token and echo scoring modes), against a stub of the
+completions endpoint that returns log-probabilities
+"""
+import math
+import random
+import re
+
+import openai
+import pytest
+from prompt_generation import answer_markers
+from query_engine import (RateLimiter, make_openai_echo_scorer, make_openai_next_token_scorer, order_choices,
+                          run_queries)
+from query_gpt3 import get_most_likely_option, make_scoring_parts
+
+
+def favored_label(prompt: str) -> str:
+    """
+    The option the stub's model prefers for a prompt like "question 5": a, b, c, d, a, ...
+    """
+    return "abcd"[int(re.search(r"\d+", prompt)[0]) % 4]
+
+
+def tokenize(text: str) -> list:
+    """
+    Split text into tokens that carry their leading whitespace, like GPT-2's
+    """
+    return re.findall(r"\s*\S+", text)
+
+
+def create(**kwargs):
+    """
+    A stand-in for openai.Completion.create in the two scoring modes, with the choices shuffled. With echo, every
+    token but the first has a log-probability of minus its length. Otherwise, the next token is the prompt's favored
+    letter with probability 0.6 as " x" and 0.1 as "x)", " the" with 0.2 and the following letter with 0.05.
+    """
+    choices = []
+    for i, prompt in enumerate(kwargs["prompt"]):
+        if kwargs.get("echo"):
+            tokens = tokenize(prompt)
+            offsets = [sum(len(token) for token in tokens[:j]) for j in range(len(tokens))]
+            logprobs = {"tokens": tokens, "text_offset": offsets,
+                        "token_logprobs": [None] + [-len(token) for token in tokens[1:]]}
+        else:
+            label = favored_label(prompt)
+            next_label = "abcd"[("abcd".index(label) + 1) % 4]
+            top = {f" {label}": math.log(0.6), f"{label})": math.log(0.1), " the": math.log(0.2),
+                   f" {next_label.upper()}": math.log(0.05)}
+            logprobs = {"top_logprobs": [top]}
+        choices.append({"index": i, "text": "", "logprobs": logprobs})
+    random.shuffle(choices)
+    return {"choices": choices, "usage": {"prompt_tokens": len(kwargs["prompt"]), "completion_tokens": 0}}
+
+
+@pytest.fixture
+def calls(monkeypatch):
+    calls = []
+
+    def record_and_create(**kwargs):
+        calls.append(kwargs)
+        return create(**kwargs)
+    monkeypatch.setattr(openai.Completion, "create", record_and_create)
+    return calls
+
+
+def unlimited():
+    return RateLimiter(requests_per_minute=10 ** 9, tokens_per_minute=10 ** 12)
+
+
+def test_order_choices():
+    choices = [{"index": 2, "text": "c"}, {"index": 0, "text": "a"}, {"index": 1, "text": "b"}]
+    assert [choice["text"] for choice in order_choices(choices, 3)] == ["a", "b", "c"]
+
+
+def test_next_token_scores_add_up_label_variants_in_prompt_order(calls):
+    prompts = [f"question {i}\nThe answer is" for i in range(12)]
+    score = make_openai_next_token_scorer("stub", ["a", "b", "c", "d"])
+    label_logprobs = run_queries(prompts, score, n_workers=4, rate_limiter=unlimited(), max_tokens=1,
+                                 max_batch_size=5)
+
+    assert all(call["max_tokens"] == 1 and call["temperature"] == 0 for call in calls)
+    for prompt, logprobs in zip(prompts, label_logprobs):
+        label = favored_label(prompt)
+        next_label = "abcd"[("abcd".index(label) + 1) % 4]
+        for option, logprob in zip("abcd", logprobs):
+            if option == label:
+                assert logprob == pytest.approx(math.log(0.7))
+            elif option == next_label:
+                assert logprob == pytest.approx(math.log(0.05))
+            else:
+                assert logprob is None
+        assert get_most_likely_option(logprobs) == f"{label})"
+
+
+def test_echo_scores_the_continuation_tokens(calls):
+    prompts = [f"question {i}\nThe answer is {marker}" for i in range(3) for marker in answer_markers]
+    score = make_openai_echo_scorer("stub", continuation_length=len(answer_markers[0]))
+    totals = run_queries(prompts, score, n_workers=4, rate_limiter=unlimited(), max_tokens=0, max_batch_size=4)
+
+    assert all(call["echo"] and call["max_tokens"] == 0 for call in calls)
+    # the last token (" a)" and so on) straddles the boundary, so it counts, with its leading space
+    assert totals == [-3] * len(prompts)
+
+
+def test_echo_scores_a_continuation_split_over_several_tokens(calls):
+    score = make_openai_echo_scorer("stub", continuation_length=4)
+    assert score(["The answer is b) c)"]) == [-3 - 3]
+
+
+def test_most_likely_option():
+    assert get_most_likely_option([None, -2.0, -0.5, -1.0]) == answer_markers[2]
+    assert get_most_likely_option([None] * 4) is None
+
+
+def test_echo_queries_keep_the_space_with_the_option_letter():
+    prompts_parts = [["Task.\n", "Q: A tree is an umbrella.\n", "The answer is "]]
+    queries = make_scoring_parts(prompts_parts, "echo")[0]
+    assert ["".join(parts) for parts in queries] == ["".join(prompts_parts[0]) + marker for marker in answer_markers]
+    assert [parts[-1] for parts in queries] == [f" {marker}" for marker in answer_markers]
@@ -0,0 +1,43 @@
+"""
+Tests for the Parquet storage of the model outputs
+"""
+from pathlib import Path
+
+import numpy as np
+import pandas as pd
+import pytest
+
+import storage
+from storage import read_outputs, write_outputs
+
+
+@pytest.fixture
+def project(tmp_path, monkeypatch):
+    """
+    A scratch project directory that the datasets are written to instead of the real one
+    """
+    def here(path: str = "") -> Path:
+        return tmp_path / path
+    monkeypatch.setattr(storage, "here", here)
+    return tmp_path
+
+
+def make_processed(parse_failures: list, tmp_path) -> pd.DataFrame:
+    df = pd.DataFrame({"Statement": ["A tree is an umbrella.", "A lawyer is a shark."], "model_response": ["a)", "?"],
+                       "appropriateness_score": [4, np.nan], "parse_failure": parse_failures})
+    # read back from a CSV, as storage.py converts them
+    df.to_csv(tmp_path / "processed.csv")
+    return pd.read_csv(tmp_path / "processed.csv")
+
+
+def test_runs_where_every_response_parsed_read_back_with_the_others(project):
+    write_outputs(make_processed([None, "declined"], project), "standard", "test", "curie", "basic", 10, 0.2)
+    # every response parsed, so the CSV has nothing but NaN in parse_failure
+    df_all_parsed = make_processed([None, None], project)
+    assert df_all_parsed["parse_failure"].dtype == float
+    write_outputs(df_all_parsed, "standard", "test", "curie", "QUD", 10, 0.2)
+
+    df = read_outputs("standard", filters={"gpt_version": "curie"})
+    assert len(df) == 4
+    assert sorted(df["parse_failure"].dropna()) == ["declined"]
+    assert df.loc[df["prompt_type"] == "QUD", "parse_failure"].isna().all()
@@ -0,0 +1,59 @@
+"""
+Tests for counting prompt tokens from the prompts' parts, which only adds up if the parts split every prompt on token
+boundaries. The comparison with the real GPT-2 tokenizer needs it in the Hugging Face cache (set DOWNLOAD_TEST_MODELS to
+download it), and is skipped otherwise.
+"""
+import os
+
+import pytest
+
+from query_gpt3 import make_condition_prompts, make_scoring_parts, scorable_prompt_types
+
+conditions = [("standard", "basic"), ("standard", "QUD"), ("standard", "options_only"), ("inverse", "basic")]
+# every condition is generated, and all but the QUD prompts can be scored
+queried_conditions = [(task_type, prompt_type, scoring_mode) for task_type, prompt_type in conditions
+                      for scoring_mode in ["generate", "next_token", "echo"]
+                      if scoring_mode == "generate" or prompt_type in scorable_prompt_types]
+
+# GPT-2's pre-tokenization: byte-pair merges never cross the boundaries between these pieces
+pretokenize_pattern = r"""'s|'t|'re|'ve|'m|'ll|'d| ?\p{L}+| ?\p{N}+| ?[^\s\p{L}\p{N}]+|\s+(?!\S)|\s+"""
+
+
+def make_queries(task_type: str, prompt_type: str, scoring_mode: str, n_items: int = 40) -> list:
+    """
+    Get the queries (as lists of parts) sent for the first few items of a condition
+    """
+    df_corpus, prompts_parts = make_condition_prompts(task_type, "test", prompt_type, 10)
+    return [parts for row_parts in make_scoring_parts(prompts_parts[:n_items], scoring_mode) for parts in row_parts]
+
+
+@pytest.fixture(scope="module")
+def token_counter():
+    from huggingface_hub import try_to_load_from_cache
+    if not isinstance(try_to_load_from_cache("gpt2", "tokenizer.json"), str) and \
+            os.environ.get("DOWNLOAD_TEST_MODELS") is None:
+        pytest.skip("the GPT-2 tokenizer isn't in the Hugging Face cache")
+    from token_counting import TokenCounter
+    return TokenCounter()
+
+
+@pytest.mark.parametrize("task_type, prompt_type, scoring_mode", queried_conditions)
+def test_parts_split_on_pretokenization_boundaries(task_type, prompt_type, scoring_mode):
+    regex = pytest.importorskip("regex")
+    pattern = regex.compile(pretokenize_pattern)
+    for parts in make_queries(task_type, prompt_type, scoring_mode):
+        text = "".join(parts)
+        boundaries = {0} | {match.end() for match in pattern.finditer(text)}
+        offset = 0
+        for part in parts[:-1]:
+            offset += len(part)
+            assert offset in boundaries, f"a part ends inside a token: {text[offset - 20:offset + 20]!r}"
+
+
+@pytest.mark.parametrize("task_type, prompt_type, scoring_mode", queried_conditions)
+def test_counts_from_parts_match_counts_of_whole_prompts(token_counter, task_type, prompt_type, scoring_mode):
+    query_parts = make_queries(task_type, prompt_type, scoring_mode)
+    counts = token_counter.count_prompts(query_parts)
+    # every part is counted on its own, so this only holds if the parts split the prompts on token boundaries
+    expected = [len(token_counter.tokenizer("".join(parts))["input_ids"]) for parts in query_parts]
+    assert counts == expected
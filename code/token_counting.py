@@ -0,0 +1,52 @@
+"""
+This file contains a token counter that deduplicates texts, encodes them in batches with the fast GPT-2 tokenizer, and
+remembers every count so that shared few-shot blocks are only ever encoded once
+"""
+from transformers import GPT2TokenizerFast
+from instrumentation import stage
+
+
+class TokenCounter:
+    """
+    Counts GPT-2 tokens, caching the count for every text it has seen.
+    Prompts are counted from their parts (see prompt_generation.join_parts): the few-shot blocks are shared across
+    prompts, so after the first few prompts only the test item has to be encoded.
+    """
+
+    def __init__(self, tokenizer_name: str = "gpt2", batch_size: int = 1024):
+        self.tokenizer = GPT2TokenizerFast.from_pretrained(tokenizer_name)
+        self.batch_size = batch_size
+        self.counts = {}
+
+    def count_many(self, texts) -> list:
+        """
+        Count the tokens in each text, encoding each distinct uncached text once, in batches
+        """
+        texts = list(texts)
+        uncached = list({text: None for text in texts if text not in self.counts})
+        for start in range(0, len(uncached), self.batch_size):
+            batch = uncached[start:start + self.batch_size]
+            with stage("tokenize", n_texts=len(batch)):
+                batch_ids = self.tokenizer(batch)["input_ids"]
+            for text, input_ids in zip(batch, batch_ids):
+                self.counts[text] = len(input_ids)
+        return [self.counts[text] for text in texts]
+
+    def count(self, text: str) -> int:
+        """
+        Count the tokens in a single text
+        """
+        return self.count_many([text])[0]
+
+    def count_parts(self, parts: list) -> int:
+        """
+        Count the tokens in a prompt from its parts, which must split the prompt on token boundaries
+        """
+        return sum(self.count_many(parts))
+
+    def count_prompts(self, prompts_parts: list) -> list:
+        """
+        Count the tokens in many prompts given as lists of parts, encoding all the distinct parts in one pass
+        """
+        self.count_many(part for parts in prompts_parts for part in parts)
+        return [sum(self.counts[part] for part in parts) for parts in prompts_parts]